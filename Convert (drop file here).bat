@@ -7,8 +7,13 @@ if "%~1"=="" (
     exit /b 1
 )
 
-REM Run the Python script with the dropped file as an argument
-python "%~dp0\main.py" "%~1"
+REM Run the Python script with the dropped file as an argument, several
+REM dropped files are converted together as a batch
+if "%~2"=="" (
+    python "%~dp0\main.py" "%~1"
+) else (
+    python "%~dp0\main.py" batch %*
+)
 
 REM Leave the window open to see the output
 echo.
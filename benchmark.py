@@ -0,0 +1,203 @@
+import argparse, json, logging, os, platform, shutil, sys, tempfile, time
+import numpy as np
+from pxr import Usd
+import instrumentation
+from x_file_generator import generate_scene, iter_frames, write_scene
+from x_file_parser import XFileParser
+from usd_exporter import USDExporter
+from usda_exporter import USDAExporter
+from x_file_writer import USDToXConverter
+
+# Times each step of converting synthetic Recettear-style files, at a few
+# sizes, and saves the results as JSON so runs can be compared:
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --compare before.json
+#
+# Each step is timed on its own, taking the quickest of --repeat runs, then
+# run once more with tracemalloc on for its peak memory. tracemalloc sees
+# Python and numpy allocations, not pxr's own, nor anything in worker
+# processes.
+
+RESULTS_VERSION = 1
+
+# generate_scene() settings for each size
+TIERS = {
+    'small': dict(materials=4, depth=1, children=4, vertices=100),
+    'medium': dict(materials=16, depth=2, children=4, vertices=2500),
+    'large': dict(materials=32, depth=3, children=4, vertices=3000, animation_sets=2, animated_frames=16),
+}
+STEPS = ('parse', 'export', 'stream', 'stream_usda', 'extract_mesh', 'write_x_file')
+# increases smaller than these are noise rather than regressions
+MIN_SECONDS = 0.005
+MIN_BYTES = 1 << 20
+
+def run_steps(directory, tier, binary, workers, trace_memory):
+    # Converts the tier's .x file to USD and back, returning each step's
+    # Recorder. The steps share the files they make.
+    x_file = os.path.join(directory, tier + '.x')
+    usd_file = os.path.join(directory, tier + '.usdc')
+    output_x_file = os.path.join(directory, tier + '_out.x')
+    recorders = {}
+
+    with instrumentation.record(trace_memory) as recorders['parse']:
+        parser = XFileParser(x_file, workers=workers)
+        parser.parse()
+
+    with instrumentation.record(trace_memory) as recorders['export']:
+        USDExporter(parser.frames, parser.materials, parser.animations).export(usd_file)
+    del parser
+
+    # parsing and exporting together, writing each mesh as it's parsed like
+    # main.py does, over the same .usdc
+    with instrumentation.record(trace_memory) as recorders['stream']:
+        USDExporter([], [], {}).export(usd_file, XFileParser(x_file, workers=workers).events())
+    # and again as .usda text, without pxr
+    with instrumentation.record(trace_memory) as recorders['stream_usda']:
+        USDAExporter([], [], {}).export(os.path.join(directory, tier + '.usda'), XFileParser(x_file, workers=workers).events())
+
+    # extract_frames() runs extract_mesh() over every mesh prim and waits
+    # for the pool to build them
+    converter = USDToXConverter(usd_file, workers=workers)
+    converter.extract_materials()
+    with instrumentation.record(trace_memory) as recorders['extract_mesh']:
+        converter.extract_frames()
+
+    shutil.copyfile(os.path.join(directory, tier + '_frames.json'), os.path.join(directory, tier + '_out_frames.json'))
+    with instrumentation.record(trace_memory) as recorders['write_x_file']:
+        converter.write_x_file(output_x_file, binary)
+    return recorders
+
+def benchmark_tier(directory, tier, settings, repeat, binary, workers, trace_memory):
+    frames, materials, animations = generate_scene(**settings)
+    x_file = os.path.join(directory, tier + '.x')
+    write_scene(x_file, frames, materials, animations, binary)
+    meshes = [mesh for frame in iter_frames(frames) for mesh in frame.meshes]
+    result = {
+        'settings': settings,
+        'scene': {
+            'bytes': os.path.getsize(x_file),
+            'frames': sum(1 for _ in iter_frames(frames)),
+            'meshes': len(meshes),
+            'vertices': sum(len(mesh.vertices) for mesh in meshes),
+            'faces': sum(len(mesh.faces) for mesh in meshes),
+        },
+        'steps': {step: {'runs': []} for step in STEPS},
+    }
+    del frames, materials, animations, meshes
+
+    for _ in range(repeat):
+        for step, recorder in run_steps(directory, tier, binary, workers, False).items():
+            result['steps'][step]['runs'].append(recorder.seconds)
+            # the stages of the quickest run
+            if recorder.seconds <= min(result['steps'][step]['runs']):
+                result['steps'][step]['stages'] = {name: stats['seconds'] for name, stats in recorder.stages.items()}
+    if trace_memory:
+        for step, recorder in run_steps(directory, tier, binary, workers, True).items():
+            result['steps'][step]['peak_bytes'] = recorder.peak_bytes
+    for step in result['steps'].values():
+        step['seconds'] = min(step['runs'])
+    return result
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'usd': '.'.join(map(str, Usd.GetVersion())),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+def run(tiers, repeat=3, binary=False, workers=None, trace_memory=True, keep=None):
+    results = {
+        'version': RESULTS_VERSION,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'options': {'repeat': repeat, 'binary': binary, 'workers': workers or os.cpu_count() or 1},
+        'tiers': {},
+    }
+    directory = keep or tempfile.mkdtemp(prefix='xtools-benchmark-')
+    os.makedirs(directory, exist_ok=True)
+    try:
+        for tier in tiers:
+            print(f"Running {tier}...", flush=True)
+            results['tiers'][tier] = benchmark_tier(directory, tier, TIERS[tier], repeat, binary, workers, trace_memory)
+    finally:
+        if keep is None:
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+def report(results):
+    lines = [f"{'Tier':<8}{'Step':<14}{'Time':>10}{'Peak memory':>14}"]
+    for tier, result in results['tiers'].items():
+        scene = result['scene']
+        lines.append(f"{tier:<8}{scene['bytes'] / (1 << 20):.1f} MB, {scene['meshes']:,} meshes, {scene['vertices']:,} vertices, {scene['faces']:,} faces")
+        for step, stats in result['steps'].items():
+            memory = f"{stats['peak_bytes'] / (1 << 20):>11.1f} MB" if 'peak_bytes' in stats else ''
+            lines.append(f"{'':<8}{step:<14}{stats['seconds']:>9.3f}s{memory}")
+    return '\n'.join(lines)
+
+def compare(results, baseline, threshold):
+    # Lists each step's change from the baseline, returning the report and
+    # whether anything got slower or bigger by more than the threshold
+    lines = [f"{'Tier':<8}{'Step':<14}{'Time':>10}{'Change':>9}{'Peak memory':>14}{'Change':>9}"]
+    regressed = False
+
+    def change(new, old, least):
+        nonlocal regressed
+        if new is None or not old:
+            return f"{'':>9}"
+        ratio = new / old - 1.0
+        flag = ratio > threshold and new - old > least
+        regressed |= flag
+        return f"{ratio:>+8.0%}" + ('!' if flag else ' ')
+
+    for tier, result in results['tiers'].items():
+        old_tier = baseline['tiers'].get(tier)
+        if old_tier is None:
+            continue
+        if old_tier['settings'] != result['settings']:
+            lines.append(f"{tier:<8}settings differ from the baseline, skipped")
+            continue
+        for step, stats in result['steps'].items():
+            old = old_tier['steps'].get(step, {})
+            memory = f"{stats['peak_bytes'] / (1 << 20):>11.1f} MB" if 'peak_bytes' in stats else f"{'':>14}"
+            lines.append(f"{tier:<8}{step:<14}{stats['seconds']:>9.3f}s{change(stats['seconds'], old.get('seconds'), MIN_SECONDS)}"
+                         f"{memory}{change(stats.get('peak_bytes'), old.get('peak_bytes'), MIN_BYTES)}")
+    if baseline['environment'] != results['environment']:
+        lines.append("The baseline was run somewhere else, changes may not be down to the code.")
+    return '\n'.join(lines), regressed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time converting synthetic Recettear-style .x files to USD and back.")
+    parser.add_argument("--tiers", nargs="+", choices=list(TIERS), default=list(TIERS), help="Sizes to run (defaults to all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each step, the quickest is kept")
+    parser.add_argument("--binary", action="store_true", help="Read and write binary .x files instead of text")
+    parser.add_argument("--jobs", type=int, help="Workers for the parser and writer (defaults to the number of CPUs)")
+    parser.add_argument("--no-memory", dest="trace_memory", action="store_false", help="Skip the extra run that measures peak memory")
+    parser.add_argument("--output", metavar="FILE", help="Save the results to FILE as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="Compare with results saved by an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Fractional increase in time or memory counted as a regression with --compare (default 0.1)")
+    parser.add_argument("--keep", metavar="DIR", help="Generate the files in DIR and leave them there")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('version') != RESULTS_VERSION:
+            raise ValueError(f"{args.compare} was saved by a different version of the benchmark.")
+
+    results = run(args.tiers, args.repeat, args.binary, args.jobs, args.trace_memory, args.keep)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is None:
+        print(report(results))
+    else:
+        text, regressed = compare(results, baseline, args.threshold)
+        print(text)
+        if regressed:
+            sys.exit(1)
@@ -0,0 +1,120 @@
+import contextlib, getpass, io, json, logging, os, tempfile, time
+from multiprocessing.connection import Client, Listener, AuthenticationError
+
+# A long running process that keeps numpy, pxr and the converters imported,
+# so converting a small file takes milliseconds rather than the second or
+# so it takes to start Python and import them. main.py sends it conversions
+# when it's running and converts in-process when it isn't.
+#
+# It listens on a Unix socket, or a named pipe on Windows. The address and
+# a random key that clients have to prove they know are kept in a file in
+# the temp folder only this user can read. Nothing here imports numpy or
+# pxr, so the client side stays quick to start.
+
+# bump whenever requests or replies change, clients skip a daemon that differs
+PROTOCOL_VERSION = 1
+
+def info_file():
+    return os.path.join(tempfile.gettempdir(), f"xtools-daemon-{getpass.getuser()}.json")
+
+def read_info():
+    try:
+        with open(info_file(), encoding='utf-8') as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return info if info.get('version') == PROTOCOL_VERSION else None
+
+def write_info(address, authkey):
+    info = {'version': PROTOCOL_VERSION, 'address': address, 'authkey': authkey.hex(), 'pid': os.getpid()}
+    fd = os.open(info_file(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+
+def remove_info():
+    # Only if it's still ours, another daemon may have been started since
+    info = read_info()
+    if info is not None and info['pid'] == os.getpid():
+        os.remove(info_file())
+
+def request(message):
+    # Sends a request to the daemon and returns its reply, or None if there's
+    # no daemon running
+    info = read_info()
+    if info is None:
+        return None
+    try:
+        with Client(info['address'], authkey=bytes.fromhex(info['authkey'])) as connection:
+            connection.send(message)
+            return connection.recv()
+    except (OSError, EOFError, AuthenticationError):
+        return None
+
+def convert(filename, options):
+    # Converts a file on the daemon. Returns (output_file, error), where the
+    # daemon's output has already been printed, or None if no daemon is running
+    reply = request({'convert': os.path.abspath(filename), 'options': list(options)})
+    if reply is None:
+        return None
+    print(reply['output'], end='')
+    return reply['output_file'], reply['error']
+
+def serve(convert_file):
+    # Runs conversions one at a time until a stop request or Ctrl+C. Each
+    # one's output is captured and sent back to be printed by the client.
+    if request({'ping': True}) is not None:
+        raise ValueError("The conversion daemon is already running.")
+
+    # only clients that read the key from the info file are let in
+    authkey = os.urandom(32)
+    with Listener(None, authkey=authkey) as listener:
+        write_info(listener.address, authkey)
+        print(f"Conversion daemon listening on {listener.address}, press Ctrl+C to stop.")
+        try:
+            while True:
+                try:
+                    connection = listener.accept()
+                except (OSError, EOFError, AuthenticationError) as e:
+                    print(f"Refused a connection: {e}")
+                    continue
+                with connection:
+                    try:
+                        message = connection.recv()
+                    except (OSError, EOFError):
+                        continue
+                    if 'stop' in message:
+                        connection.send({'stopped': True})
+                        return
+                    elif 'ping' in message:
+                        connection.send({'pid': os.getpid()})
+                    elif 'convert' in message:
+                        reply = run_conversion(convert_file, message['convert'], message['options'])
+                        print(f"{reply['seconds']:8.2f}s  {message['convert']}" + (f"  FAILED: {reply['error']}" if reply['error'] else ""))
+                        try:
+                            connection.send(reply)
+                        except OSError:
+                            # the client gave up waiting
+                            pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            remove_info()
+
+def run_conversion(convert_file, filename, options):
+    # The converters' log messages are captured along with what's printed
+    output = io.StringIO()
+    root = logging.getLogger()
+    handlers = root.handlers
+    handler = logging.StreamHandler(output)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    root.handlers = [handler]
+    start = time.perf_counter()
+    output_file = error = None
+    try:
+        with contextlib.redirect_stdout(output):
+            output_file = convert_file(filename, *options)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        root.handlers = handlers
+    return {'output': output.getvalue(), 'output_file': output_file, 'error': error, 'seconds': time.perf_counter() - start}
@@ -0,0 +1,102 @@
+import hashlib, json, logging, os, tempfile
+
+log = logging.getLogger(__name__)
+
+# Remembers what every output was converted from, so a rebuild only converts
+# files whose output is stale. An entry holds a hash of the input and of each
+# sidecar file the conversion reads, plus the options and converter version
+# used, and the size and time of the output so a replaced output is noticed.
+# Files are only hashed again when their size or modified time changes.
+
+# bump whenever the same input and options convert to something different
+CONVERTER_VERSION = 1
+MANIFEST_VERSION = 1
+DEFAULT_MANIFEST = '.xtools_manifest.json'
+
+class ConversionManifest:
+    def __init__(self, path=DEFAULT_MANIFEST):
+        self.path = path
+        self.entries = {}
+        # filename -> [size, mtime_ns, digest] of every file hashed so far
+        self.hashes = {}
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.entries = data['entries']
+                self.hashes = data['hashes']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            log.warning("Ignoring unreadable manifest %s: %s", path, e)
+
+    def file_hash(self, filename):
+        # None for a file that doesn't exist
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        known = self.hashes.get(filename)
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+        digest = hashlib.blake2b(digest_size=20)
+        with open(filename, 'rb') as file:
+            while chunk := file.read(1 << 20):
+                digest.update(chunk)
+        self.hashes[filename] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def state(self, filename, output_file, options):
+        # Everything the output depends on, to be passed to record() once
+        # the conversion succeeds. The parser, and numpy with it, is only
+        # imported once there's a file to look at.
+        from x_file_parser import PARSER_VERSION
+        return {
+            'version': [CONVERTER_VERSION, PARSER_VERSION],
+            'options': list(options),
+            'files': {dependency: self.file_hash(dependency) for dependency in dependencies(filename, output_file)},
+        }
+
+    def is_current(self, filename, output_file, state):
+        entry = self.entries.get(os.path.abspath(filename))
+        if entry is None or entry['output'] != os.path.abspath(output_file):
+            return False
+        try:
+            stat = os.stat(output_file)
+        except FileNotFoundError:
+            return False
+        if [stat.st_size, stat.st_mtime_ns] != entry['output_stat']:
+            return False
+        return entry['state'] == state
+
+    def record(self, filename, output_file, state):
+        stat = os.stat(output_file)
+        self.entries[os.path.abspath(filename)] = {
+            'output': os.path.abspath(output_file),
+            'output_stat': [stat.st_size, stat.st_mtime_ns],
+            'state': state,
+        }
+
+    def save(self):
+        # Only hashes of files still in use are kept
+        used = {dependency for entry in self.entries.values() for dependency in entry['state']['files']}
+        self.hashes = {filename: known for filename, known in self.hashes.items() if filename in used}
+        data = {'version': MANIFEST_VERSION, 'entries': self.entries, 'hashes': self.hashes}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False, encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+        os.replace(f.name, self.path)
+
+def dependencies(filename, output_file):
+    # The input and the sidecar files its conversion reads. A .x file is
+    # read on its own, a .usd also needs the _frames.json and
+    # _speculars.json for its output, and any payload layers next to it.
+    filename = os.path.abspath(filename)
+    if filename.lower().endswith('.x'):
+        return [filename]
+    stem = os.path.splitext(os.path.abspath(output_file))[0]
+    files = [filename, stem + '_frames.json', stem + '_speculars.json']
+    payloads = os.path.splitext(filename)[0] + '_payloads'
+    if os.path.isdir(payloads):
+        files.extend(os.path.join(payloads, name) for name in sorted(os.listdir(payloads)))
+    return files
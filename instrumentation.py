@@ -0,0 +1,138 @@
+import contextlib, cProfile, json, os, threading, time, tracemalloc
+
+# Times the stages of a conversion and counts what goes through them, e.g.
+#
+#   with instrumentation.stage('parse meshes'):
+#       ...
+#   instrumentation.count('parse meshes', vertices=len(vertices))
+#
+# Stages nest, and time goes to the innermost one running, so the stage
+# times add up to the total. Only the thread that started recording is
+# timed: work handed to a pool shows up as time spent waiting for it in
+# whichever stage waits. When nothing is recording, stage() and count()
+# do nothing beyond checking for a recorder.
+
+NO_STAGE = contextlib.nullcontext()
+# the Recorder started by record(), if any
+recorder = None
+
+class Recorder:
+    def __init__(self, trace_memory=False, profile=False):
+        self.stages = {}
+        self.stack = []
+        self.thread = threading.get_ident()
+        self.trace_memory = trace_memory
+        # a cProfile.Profile per stage, only switched on while it's innermost
+        self.profiles = {} if profile else None
+        self.started = self.since = time.perf_counter()
+        self.seconds = None
+        self.peak_bytes = 0
+
+    def stats(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'seconds': 0.0, 'calls': 0, 'peak_bytes': 0, 'counts': {}}
+        return self.stages[name]
+
+    def switch(self, leaving, entering):
+        # Gives the time (and peak memory) since the last switch to the stage
+        # being left, and hands the profiler over to the one being entered
+        now = time.perf_counter()
+        if leaving is not None:
+            self.stats(leaving)['seconds'] += now - self.since
+        self.since = now
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peak_bytes = max(self.peak_bytes, peak)
+            if leaving is not None:
+                stats = self.stats(leaving)
+                stats['peak_bytes'] = max(stats['peak_bytes'], peak)
+            tracemalloc.reset_peak()
+        if self.profiles is not None:
+            if leaving is not None:
+                self.profiles[leaving].disable()
+            if entering is not None:
+                self.profiles.setdefault(entering, cProfile.Profile()).enable()
+
+    def enter(self, name):
+        self.switch(self.stack[-1] if self.stack else None, name)
+        self.stack.append(name)
+        self.stats(name)['calls'] += 1
+
+    def exit(self):
+        name = self.stack.pop()
+        self.switch(name, self.stack[-1] if self.stack else None)
+
+    def stop(self):
+        while self.stack:
+            self.exit()
+        self.switch(None, None)
+        self.seconds = time.perf_counter() - self.started
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def report(self):
+        lines = [f"{'Stage':<14}{'Time':>9}{'Calls':>8}" + (f"{'Peak memory':>13}" if self.trace_memory else '') + "  Counted"]
+        for name, stats in self.stages.items():
+            counts = ', '.join(f"{key} {value:,}" for key, value in stats['counts'].items())
+            memory = f"{stats['peak_bytes'] / (1 << 20):>10.1f} MB" if self.trace_memory else ''
+            lines.append(f"{name:<14}{stats['seconds']:>8.3f}s{stats['calls']:>8}{memory}  {counts}")
+        other = self.seconds - sum(stats['seconds'] for stats in self.stages.values())
+        lines.append(f"{'other':<14}{other:>8.3f}s")
+        lines.append(f"{'total':<14}{self.seconds:>8.3f}s" + (f"{'':>8}{self.peak_bytes / (1 << 20):>10.1f} MB" if self.trace_memory else ''))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        data = {'seconds': self.seconds, 'stages': self.stages}
+        if self.trace_memory:
+            data['peak_bytes'] = self.peak_bytes
+        return data
+
+    def dump_profiles(self, directory):
+        # One .prof file per stage, for python -m pstats or snakeviz
+        os.makedirs(directory, exist_ok=True)
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(directory, name.replace(' ', '_') + '.prof'))
+
+class Stage:
+    __slots__ = ('recorder', 'name', 'entered')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        # other threads aren't timed, they'd interleave with the stage stack
+        self.entered = threading.get_ident() == self.recorder.thread
+        if self.entered:
+            self.recorder.enter(self.name)
+
+    def __exit__(self, *exc_info):
+        if self.entered:
+            self.recorder.exit()
+        return False
+
+def stage(name):
+    return NO_STAGE if recorder is None else Stage(recorder, name)
+
+def count(name, **counts):
+    if recorder is not None:
+        totals = recorder.stats(name)['counts']
+        for key, value in counts.items():
+            totals[key] = totals.get(key, 0) + int(value)
+
+@contextlib.contextmanager
+def record(trace_memory=False, profile=False):
+    # Records everything run inside it, yielding the Recorder
+    global recorder
+    if trace_memory:
+        tracemalloc.start()
+    recorder = Recorder(trace_memory, profile)
+    try:
+        yield recorder
+    finally:
+        recorder.stop()
+        recorder = None
+
+def write_json(recorder, filename):
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(recorder.to_json(), f, indent=2)
@@ -1,37 +1,312 @@
 import argparse
+import glob
+import logging
 import os
-from x_file_parser import XFileParser
-from x_file_writer import USDToXConverter
-from usd_exporter import USDExporter
+import signal
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import conversion_daemon
 
-def convert_x_to_usd(input_x_file, output_usd_file):
+log = logging.getLogger(__name__)
+
+# The converters, and numpy and pxr with them, are only imported once there's
+# something to convert, so handing a file to the daemon starts quickly.
+
+def convert_x_to_usd(input_x_file, output_usd_file, cache_dir=None, instance_meshes=False, payload_faces=None, workers=None):
+    import instrumentation
+    # .usda is written as text without loading pxr, unless instancing or
+    # payloads are wanted
+    text_usda = output_usd_file.endswith('.usda') and not instance_meshes and payload_faces is None
+    with instrumentation.stage('import'):
+        from x_file_parser import XFileParser
+        if text_usda:
+            from usda_exporter import USDAExporter
+        else:
+            from usd_exporter import USDExporter
+    parser = XFileParser(input_x_file, cache_dir, workers)
+    log.debug("Making %s", output_usd_file)
+    # each mesh is written as soon as it's parsed, rather than after the whole file
+    if text_usda:
+        exporter = USDAExporter([], [], {})
+    else:
+        exporter = USDExporter([], [], {}, instance_meshes, payload_faces)
+    exporter.export(output_usd_file, parser.events())
+
+def convert_usd_to_x(input_file, output_x_file, binary=False, weld_tolerance=0.0, workers=None):
+    import instrumentation
+    with instrumentation.stage('import'):
+        from x_file_writer import USDToXConverter
+    converter = USDToXConverter(input_file, weld_tolerance, workers)
+    converter.convert(output_x_file, binary)
+
+def list_x_file(input_x_file):
+    from x_file_parser import XFileParser
     parser = XFileParser(input_x_file)
-    parser.parse()
-    print('making usd')
-    exporter = USDExporter(parser.frames, parser.materials, parser.animations)
-    exporter.export(output_usd_file)
-
-def convert_usd_to_x(input_file, output_x_file):
-    converter = USDToXConverter(input_file)
-    converter.convert(output_x_file)
-
-def main(filename):
-    file_ext = os.path.splitext(filename)[1].lower()
-    if file_ext == '.x':
-        output_usd_file = os.path.splitext(filename)[0] + '.usd'
-        convert_x_to_usd(filename, output_usd_file)
-        print(f"Converted {filename} to {output_usd_file}")
-
-    elif file_ext == '.usd':
-        output_x_file = os.path.splitext(filename)[0] + '.x'
-        convert_usd_to_x(filename, output_x_file)
-        print(f"Converted {filename} to {output_x_file}")
+    parser.print_index()
+
+USD_EXTENSIONS = ('.usd', '.usda', '.usdc', '.usdz')
+
+def output_filename(filename, usd_format='usd'):
+    base, file_ext = os.path.splitext(filename)
+    if file_ext.lower() == '.x':
+        return base + '.' + usd_format
+    elif file_ext.lower() in USD_EXTENSIONS:
+        return base + '.x'
+    raise ValueError("Unsupported file extension. Only .x and .usd/.usda/.usdc/.usdz files are supported.")
 
+def convert_file(filename, binary=False, cache_dir=None, weld_tolerance=0.0, usd_format='usd', instance_meshes=False, payload_faces=None, workers=None):
+    # Converts a .x file to USD or a USD file to .x, returning the file written
+    output_file = output_filename(filename, usd_format)
+    if output_file.endswith('.x'):
+        convert_usd_to_x(filename, output_file, binary, weld_tolerance, workers)
     else:
-        raise ValueError("Unsupported file extension. Only .x and .usd files are supported.")
+        convert_x_to_usd(filename, output_file, cache_dir, instance_meshes, payload_faces, workers)
+    return output_file
+
+def main(filename, binary=False, list_blocks=False, cache_dir=None, weld_tolerance=0.0, usd_format='usd', instance_meshes=False, payload_faces=None, workers=None, use_daemon=True):
+    if list_blocks:
+        if os.path.splitext(filename)[1].lower() != '.x':
+            raise ValueError("--list only works on .x files.")
+        list_x_file(filename)
+        return
+
+    options = (binary, cache_dir and os.path.abspath(cache_dir), weld_tolerance, usd_format, instance_meshes, payload_faces, workers)
+    result = conversion_daemon.convert(filename, options) if use_daemon else None
+    if result is None:
+        output_file = convert_file(filename, *options)
+    else:
+        output_file, error = result
+        if error is not None:
+            raise ValueError(f"Converting {filename} failed: {error}")
+    print(f"Converted {filename} to {output_file}")
+
+def daemon_main(stop=False):
+    if stop:
+        if conversion_daemon.request({'stop': True}) is None:
+            raise ValueError("The conversion daemon isn't running.")
+        print("Stopped the conversion daemon.")
+        return
+    # imported up front so the first conversion is as quick as the rest
+    import x_file_parser, x_file_writer, usd_exporter, usda_exporter  # noqa: F401
+    import worker_pools
+    # pools are started by the first conversion that needs one and kept
+    with worker_pools.keep_pools():
+        conversion_daemon.serve(convert_file)
+
+def find_inputs(patterns, manifest=None, to_format=None):
+    # Expands files, directories (searched recursively) and glob patterns,
+    # plus the lines of a manifest file, into the files to convert in order
+    patterns = list(patterns)
+    if manifest is not None:
+        manifest_dir = os.path.dirname(manifest)
+        with open(manifest, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    patterns.append(os.path.join(manifest_dir, line))
+
+    extensions = ('.x',) if to_format == 'usd' else USD_EXTENSIONS if to_format == 'x' else ('.x',) + USD_EXTENSIONS
+    inputs = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                dirs.sort()
+                inputs.extend(os.path.join(root, name) for name in sorted(files))
+        elif glob.has_magic(pattern):
+            inputs.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            inputs.append(pattern)
+    inputs = [os.path.normpath(filename) for filename in inputs if os.path.splitext(filename)[1].lower() in extensions]
+    return list(dict.fromkeys(inputs))
+
+def timed_convert(filename, *options):
+    # Runs in a batch worker. Errors are returned rather than raised so one
+    # bad file doesn't stop the batch, and as text as not every exception
+    # pxr raises can be sent back from a worker.
+    start = time.perf_counter()
+    try:
+        output_file = convert_file(filename, *options)
+        error = None
+    except Exception as e:
+        output_file = None
+        error = f"{type(e).__name__}: {e}"
+    return output_file, time.perf_counter() - start, error
+
+def convert_batch(pool, inputs, options, conversions=None, failed=None):
+    # Converts the inputs on the pool and prints how each went. With a
+    # ConversionManifest, files whose output is up to date are skipped. In
+    # failed, files are kept with the state they failed in, and only tried
+    # again once something they depend on changes. Returns the failures.
+    usd_format = options[3]
+    jobs, failures, states = [], {}, {}
+    skipped = converted = 0
+    # a file and its output in the same batch would overwrite each other, as
+    # would two files with the same output (a.usd and a.usda)
+    input_set = set(inputs)
+    output_counts = Counter(output_filename(filename, usd_format) for filename in inputs)
+    for filename in inputs:
+        output_file = output_filename(filename, usd_format)
+        if output_file in input_set or output_counts[output_file] > 1:
+            if failed is None or failed.get(filename) != 'conflict':
+                reason = "is also in the batch, use --to to pick a direction" if output_file in input_set else "would also be written by another file"
+                failures[filename] = f"its output {output_file} {reason}"
+                if failed is not None:
+                    failed[filename] = 'conflict'
+            else:
+                skipped += 1
+            continue
+        if conversions is not None:
+            # everything but the cache folder can change the output
+            state = conversions.state(filename, output_file, options[:1] + options[2:])
+            if conversions.is_current(filename, output_file, state) or (failed is not None and failed.get(filename) == state):
+                skipped += 1
+                continue
+            states[filename] = state
+        jobs.append(filename)
+
+    if not (jobs or failures):
+        if failed is None:
+            print(f"All {skipped} files are up to date")
+        return failures
+    start = time.perf_counter()
+    # meshes within a file are processed one at a time, as the files already fill every CPU
+    futures = {pool.submit(timed_convert, filename, *options, 1): filename for filename in jobs}
+    for future in as_completed(futures):
+        filename = futures[future]
+        try:
+            output_file, seconds, error = future.result()
+        except Exception as e:
+            # the worker itself died
+            output_file, seconds, error = None, 0.0, f"{type(e).__name__}: {e}"
+        if error is None:
+            print(f"{seconds:8.2f}s  {filename} -> {output_file}")
+            converted += 1
+            if conversions is not None:
+                conversions.record(filename, output_file, states[filename])
+            if failed is not None:
+                failed.pop(filename, None)
+        else:
+            failures[filename] = error
+            if failed is not None and filename in states:
+                failed[filename] = states[filename]
+    if conversions is not None:
+        conversions.save()
+
+    for filename, error in failures.items():
+        print(f"  FAILED  {filename}: {error}")
+    print(f"Converted {converted} files in {time.perf_counter() - start:.2f}s"
+          + (f", {skipped} up to date" if skipped else "") + (f", {len(failures)} failed" if failures else ""))
+    return failures
+
+def batch_main(patterns, manifest=None, to_format=None, workers=None, binary=False, cache_dir=None, weld_tolerance=0.0, usd_format='usd', instance_meshes=False, payload_faces=None, incremental=None, watch=False, interval=1.0):
+    # Converts every file found across a pool of processes. Each worker
+    # imports pxr once and converts file after file with it. With watch, the
+    # files are looked at again every interval seconds and converted as
+    # they change, on the same pool, until Ctrl+C is pressed.
+    options = (binary, cache_dir, weld_tolerance, usd_format, instance_meshes, payload_faces)
+    conversions = None
+    if watch or incremental is not None:
+        # an empty incremental is --incremental without a manifest given
+        from conversion_manifest import ConversionManifest, DEFAULT_MANIFEST
+        conversions = ConversionManifest(incremental or DEFAULT_MANIFEST)
+
+    if not watch:
+        inputs = find_inputs(patterns, manifest, to_format)
+        if not inputs:
+            raise ValueError("No .x or .usd files found to convert.")
+        with ProcessPoolExecutor(min(workers or os.cpu_count() or 1, len(inputs)), initializer=init_worker, initargs=(logging.getLogger().level,)) as pool:
+            return not convert_batch(pool, inputs, options, conversions)
+
+    print("Watching for changes, press Ctrl+C to stop.")
+    failed = {}
+    last_stats = {}
+    with ProcessPoolExecutor(workers or os.cpu_count() or 1, initializer=init_worker, initargs=(logging.getLogger().level,)) as pool:
+        try:
+            while True:
+                inputs = find_inputs(patterns, manifest, to_format)
+                # files that changed since the last look may still be being
+                # written, e.g. by Blender, so they're left until they settle
+                stats = {filename: file_stat(filename) for filename in inputs}
+                settled = [filename for filename in inputs if stats[filename] is not None and stats[filename] == last_stats.get(filename)]
+                last_stats = stats
+                convert_batch(pool, settled, options, conversions, failed)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            return True
+
+def init_worker(log_level):
+    # Ctrl+C is left to the main process, which stops the batch
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging(log_level)
+
+def setup_logging(level=logging.INFO):
+    # The converters log to stdout alongside everything else printed, debug
+    # messages (every frame and mesh) only show with --verbose
+    logging.basicConfig(level=level, format='%(message)s', stream=sys.stdout)
+
+def file_stat(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def add_conversion_arguments(parser):
+    parser.add_argument("--binary", action="store_true", help="Write a binary .x file when converting from .usd")
+    parser.add_argument("--cache", default=os.environ.get("XTOOLS_CACHE_DIR"), help="Directory to cache parsed .x files in, so unchanged files aren't parsed again (defaults to XTOOLS_CACHE_DIR)")
+    parser.add_argument("--format", choices=[ext[1:] for ext in USD_EXTENSIONS], default="usd", help="USD file format to write when converting from .x, usdz packages the textures with it")
+    parser.add_argument("--instance", action="store_true", help="Write meshes that appear more than once as instances of a single copy when converting from .x")
+    parser.add_argument("--payloads", type=int, nargs="?", const=0, metavar="FACES", help="Write each child frame of Frame_World (or only those with at least FACES faces) to its own layer, loaded as a payload, when converting from .x")
+    parser.add_argument("--weld", type=float, default=0.0, help="Merge vertices whose position, normal, UV and colour are all within this distance when converting from .usd")
+    parser.add_argument("-v", "--verbose", action="store_const", const=logging.DEBUG, default=logging.INFO, dest="log_level", help="Show every frame and mesh as it's converted")
+    parser.add_argument("-q", "--quiet", action="store_const", const=logging.WARNING, dest="log_level", help="Only show warnings and errors from the converters")
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Convert between .x and .usd files.")
-    parser.add_argument("filename", help="Path to the .x or .usd file")
-    args = parser.parse_args()
-    main(args.filename)
+    if sys.argv[1:2] == ["batch"]:
+        parser = argparse.ArgumentParser(prog="main.py batch", description="Convert many .x and .usd files at once, one file per CPU.")
+        parser.add_argument("inputs", nargs="*", help="Files, directories (searched recursively) or glob patterns to convert")
+        parser.add_argument("--manifest", help="A text file listing more files, directories or patterns, one per line, relative to the file")
+        parser.add_argument("--to", choices=["usd", "x"], help="Only convert .x files to USD, or only USD files to .x")
+        parser.add_argument("--jobs", type=int, help="Number of files to convert at once (defaults to the number of CPUs)")
+        parser.add_argument("--incremental", nargs="?", const='', metavar="MANIFEST", help="Only convert files whose output is out of date, keeping track in MANIFEST (defaults to .xtools_manifest.json)")
+        parser.add_argument("--watch", action="store_true", help="Keep running and convert files again whenever they change, implies --incremental")
+        parser.add_argument("--interval", type=float, default=1.0, help="Seconds between looking for changes with --watch")
+        add_conversion_arguments(parser)
+        args = parser.parse_args(sys.argv[2:])
+        setup_logging(args.log_level)
+        if not batch_main(args.inputs, args.manifest, args.to, args.jobs, args.binary, args.cache, args.weld, args.format, args.instance, args.payloads, args.incremental, args.watch, args.interval):
+            sys.exit(1)
+    elif sys.argv[1:2] == ["daemon"]:
+        parser = argparse.ArgumentParser(prog="main.py daemon", description="Keep a converter running in the background, which main.py hands files to so they convert without starting up each time.")
+        parser.add_argument("--stop", action="store_true", help="Stop the running daemon")
+        args = parser.parse_args(sys.argv[2:])
+        setup_logging()
+        daemon_main(args.stop)
+    else:
+        parser = argparse.ArgumentParser(description="Convert between .x and .usd files. Use 'main.py batch' to convert many at once, or 'main.py daemon' to keep a converter running.")
+        parser.add_argument("filename", help="Path to the .x or .usd file")
+        parser.add_argument("--list", action="store_true", help="List the frames and meshes in a .x file without converting it")
+        parser.add_argument("--jobs", type=int, help="Number of meshes to process at once (defaults to the number of CPUs)")
+        parser.add_argument("--no-daemon", action="store_true", help="Convert in this process even if the conversion daemon is running")
+        parser.add_argument("--stats", action="store_true", help="Print how long each stage of the conversion took and how much it processed")
+        parser.add_argument("--stats-json", metavar="FILE", help="Write the --stats report to FILE as JSON")
+        parser.add_argument("--trace-memory", action="store_true", help="Add the peak memory used in each stage to the report, this slows conversion down")
+        parser.add_argument("--profile", metavar="DIR", help="Write cProfile stats for each stage to DIR, for python -m pstats or snakeviz")
+        add_conversion_arguments(parser)
+        args = parser.parse_args()
+        setup_logging(args.log_level)
+        if args.stats or args.stats_json or args.trace_memory or args.profile:
+            # measured here, the daemon's work wouldn't show up
+            import instrumentation
+            with instrumentation.record(args.trace_memory, args.profile is not None) as recorder:
+                main(args.filename, args.binary, args.list, args.cache, args.weld, args.format, args.instance, args.payloads, args.jobs, False)
+            if args.stats or args.trace_memory:
+                print(recorder.report())
+            if args.stats_json:
+                instrumentation.write_json(recorder, args.stats_json)
+            if args.profile:
+                recorder.dump_profiles(args.profile)
+        else:
+            main(args.filename, args.binary, args.list, args.cache, args.weld, args.format, args.instance, args.payloads, args.jobs, not args.no_daemon)
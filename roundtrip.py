@@ -0,0 +1,358 @@
+import argparse, json, logging, os, re, shutil, sys, tempfile
+import numpy as np
+import instrumentation
+from main import find_inputs
+from x_file_generator import generate_scene, iter_frames, write_scene
+from x_file_parser import XFileParser
+from usd_exporter import USDExporter
+from usda_exporter import USDAExporter
+from x_file_writer import USDToXConverter
+
+# Converts .x files to USD and back, and checks the .x that comes out holds
+# the same scene as the one that went in:
+#
+#   python roundtrip.py                     # the synthetic fixtures
+#   python roundtrip.py models/*.x          # and some real files
+#
+# Scenes are compared after both files are parsed, so vertex numbering and
+# de-duplication don't matter: each mesh becomes a list of faces, every
+# corner with its position, normal, UV and colour, plus the face's material
+# name. Faces are compared in order, then sorted if that fails, in case
+# they were reordered. Frame names, transforms and mesh counts, materials
+# and the collision indentation of text files must match too. Collision is
+# set in _frames.json from how the input is indented, as a user would.
+#
+# Each step must also stay within a time and Python memory budget for the
+# size of the file. Animations aren't checked, they aren't exported yet.
+# --usda goes through the .usda USDAExporter writes without pxr instead of a
+# .usdc.
+
+# What the converters change on purpose: the writer turns normals from
+# Blender's axes to the game's, sets Frame_World's transform to identity,
+# and gives textured materials a white colour, as Blender keeps none
+NORMAL_AXES = np.array([1.0, -1.0, -1.0])
+TEXTURED_COLOR = (1.0, 1.0, 1.0)
+
+# generate_scene() settings and non-colliding frames of each synthetic fixture
+FIXTURES = {
+    'props': (dict(materials=6, depth=2, children=3, vertices=150), ['Frame_Obj1', 'Frame_Obj2_0']),
+    'plain': (dict(materials=1, textures=False, depth=1, children=2, vertices=64, colors=False, materials_per_mesh=1), []),
+    'layered': (dict(materials=12, depth=3, children=2, meshes_per_frame=2, vertices=300, materials_per_mesh=4), ['Frame_Obj0', 'Frame_Obj1_1']),
+    'shop': (dict(materials=16, depth=2, children=4, vertices=2500), ['Frame_Obj3']),
+}
+# fixtures also written as binary .x, which has no indentation
+BINARY_FIXTURES = ('props',)
+
+# Seconds and peak MB of Python memory allowed for each step, as a fixed
+# part plus a part per MB of .x input. Stage names from instrumentation,
+# e.g. 'dedupe', can be given budgets too. These are loose, to catch
+# something going badly wrong rather than small changes; use benchmark.py
+# for those.
+BUDGETS = {
+    'parse': {'seconds': [0.5, 0.3], 'peak_mb': [16, 4.0]},
+    'export': {'seconds': [0.5, 0.1], 'peak_mb': [16, 1.0]},
+    'usd_to_x': {'seconds': [1.0, 0.3], 'peak_mb': [32, 16.0]},
+}
+
+def frame_indentation(x_file):
+    # Whether each frame of a text .x file is collision indented, i.e. its
+    # meshes and child frames sit at its own indent. Frames holding nothing
+    # are left out, as are all of a binary file's.
+    with open(x_file, 'rb') as file:
+        if file.read(16)[8:12] not in (b'txt ',):
+            return {}
+        text = file.read().decode('shift_jis', errors='replace')
+    collision = {}
+    # open frames as (name, indent, brace depth inside it)
+    frames = []
+    depth = 0
+    for line in text.splitlines():
+        match = re.match(r'(\t*)(Frame|Mesh)\s+(\S+)\s*\{', line)
+        if match:
+            indent = len(match.group(1))
+            if frames and frames[-1][2] == depth and frames[-1][0] not in collision:
+                collision[frames[-1][0]] = indent == frames[-1][1]
+            if match.group(2) == 'Frame':
+                frames.append((match.group(3), indent, depth + 1))
+        depth += line.count('{') - line.count('}')
+        while frames and depth < frames[-1][2]:
+            frames.pop()
+    return collision
+
+def set_collision(json_frame, collision):
+    if json_frame['name'] in collision:
+        json_frame['collision'] = str(collision[json_frame['name']])
+    for child in json_frame.get('children', []):
+        set_collision(child, collision)
+
+def round_trip(x_file, directory, collision, binary, workers, trace_memory, usda=False):
+    # Converts x_file to USD and back inside directory, returning the parsed
+    # input, the .x file written and each step's Recorder
+    name = os.path.splitext(os.path.basename(x_file))[0]
+    input_dir = os.path.join(directory, 'in')
+    output_dir = os.path.join(directory, 'out')
+    os.makedirs(input_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    # the parser writes _frames.json next to its input
+    input_x_file = os.path.join(input_dir, name + '.x')
+    if os.path.abspath(x_file) != os.path.abspath(input_x_file):
+        shutil.copyfile(x_file, input_x_file)
+    usd_file = os.path.join(input_dir, name + ('.usda' if usda else '.usdc'))
+    output_x_file = os.path.join(output_dir, name + '.x')
+    recorders = {}
+
+    with instrumentation.record(trace_memory) as recorders['parse']:
+        parser = XFileParser(input_x_file, workers=workers)
+        parser.parse()
+    with instrumentation.record(trace_memory) as recorders['export']:
+        exporter = USDAExporter if usda else USDExporter
+        exporter(parser.frames, parser.materials, parser.animations).export(usd_file)
+
+    with open(os.path.join(input_dir, name + '_frames.json'), encoding='utf-8') as f:
+        json_root = json.load(f)
+    set_collision(json_root, collision)
+    with open(os.path.join(output_dir, name + '_frames.json'), 'w', encoding='utf-8') as f:
+        json.dump(json_root, f, indent=2)
+    shutil.copyfile(os.path.join(input_dir, name + '_speculars.json'), os.path.join(output_dir, name + '_speculars.json'))
+
+    with instrumentation.record(trace_memory) as recorders['usd_to_x']:
+        USDToXConverter(usd_file, workers=workers).convert(output_x_file, binary)
+    return parser, output_x_file, recorders
+
+def face_corners(mesh):
+    # (faces, 3, values) arrays of each corner's attributes, by attribute
+    corners = {'positions': mesh.vertices[mesh.faces]}
+    if len(mesh.normals):
+        corners['normals'] = mesh.normals[mesh.normal_faces]
+    if len(mesh.uvs):
+        corners['UVs'] = mesh.uvs[mesh.faces]
+    if len(mesh.colors):
+        corners['colours'] = mesh.colors[mesh.faces]
+    return {attribute: values.astype(np.float64) for attribute, values in corners.items()}
+
+def face_materials(mesh):
+    # The material name of each face, '' where it has none
+    indices = mesh.material_indices
+    if len(indices) != len(mesh.faces):
+        # one material for the whole mesh
+        indices = np.zeros(len(mesh.faces), dtype=np.int64)
+    names = np.array(list(mesh.materials) + [''], dtype=object)
+    return names[np.minimum(indices, len(mesh.materials))]
+
+def sorted_faces(corners, materials, tolerance):
+    # The faces in an order that doesn't depend on the file's, each one's
+    # corners turned to start at its smallest, keeping the winding
+    keys = np.round(corners / (tolerance * 100)).astype(np.int64)
+    flat = keys.reshape(-1, keys.shape[2])
+    rank = np.empty(len(flat), dtype=np.int64)
+    rank[np.lexsort(flat.T[::-1])] = np.arange(len(flat))
+    start = rank.reshape(-1, 3).argmin(axis=1)
+    turn = (start[:, None] + np.arange(3)) % 3
+    faces = np.arange(len(corners))[:, None]
+    corners, keys = corners[faces, turn], keys[faces, turn]
+    order = np.lexsort(np.column_stack((keys.reshape(len(keys), -1), materials)).T[::-1])
+    return corners[order], materials[order]
+
+def compare_meshes(path, expected_mesh, actual_mesh, tolerance):
+    expected = face_corners(expected_mesh)
+    actual = face_corners(actual_mesh)
+    if 'normals' in expected:
+        expected['normals'] *= NORMAL_AXES
+    differences = [f"{path}: {attribute} are missing" for attribute in expected if attribute not in actual]
+    if len(expected_mesh.faces) != len(actual_mesh.faces):
+        differences.append(f"{path}: {len(expected_mesh.faces)} faces became {len(actual_mesh.faces)}")
+    if differences:
+        return differences
+
+    # attributes the input doesn't have are written with defaults, and
+    # aren't compared
+    attributes = {attribute: values.shape[2] for attribute, values in expected.items()}
+    expected_corners = np.concatenate(list(expected.values()), axis=2)
+    actual_corners = np.concatenate([actual[attribute] for attribute in attributes], axis=2)
+    # compared by name, as material numbers can change
+    _, materials = np.unique(np.concatenate((face_materials(expected_mesh), face_materials(actual_mesh))).astype(str), return_inverse=True)
+    expected_materials, actual_materials = materials[:len(expected_corners)], materials[len(expected_corners):]
+
+    # faces in the order they're written, and if that finds differences,
+    # sorted in case they were reordered, reporting whichever differs less
+    in_order = face_differences(expected_corners, expected_materials, actual_corners, actual_materials, attributes, tolerance)
+    if not in_order:
+        return []
+    in_sorted = face_differences(*sorted_faces(expected_corners, expected_materials, tolerance),
+                                 *sorted_faces(actual_corners, actual_materials, tolerance), attributes, tolerance)
+    found = min(in_order, in_sorted, key=lambda found: sum(count for _, count, _ in found))
+    return [f"{path}: {attribute} differ on {count} of {len(expected_corners)} faces{example}" for attribute, count, example in found]
+
+def face_differences(expected_corners, expected_materials, actual_corners, actual_materials, attributes, tolerance):
+    # (attribute, faces that differ, an example) for each attribute that
+    # doesn't match
+    found = []
+    wrong = expected_materials != actual_materials
+    if wrong.any():
+        found.append(('materials', wrong.sum(), ''))
+    start = 0
+    for attribute, size in attributes.items():
+        columns = slice(start, start + size)
+        start = columns.stop
+        wrong = ~np.all(np.isclose(expected_corners[:, :, columns], actual_corners[:, :, columns], rtol=0, atol=tolerance), axis=(1, 2))
+        if wrong.any():
+            face = np.flatnonzero(wrong)[0]
+            found.append((attribute, wrong.sum(), f", e.g. {expected_corners[face, :, columns].tolist()} became {actual_corners[face, :, columns].tolist()}"))
+    return found
+
+def compare_materials(expected, actual, tolerance):
+    # Alpha isn't kept, USD diffuse colours have none
+    differences = []
+    actual_by_name = {material.name: material for material in actual}
+    for material in expected:
+        other = actual_by_name.get(material.name)
+        if other is None:
+            differences.append(f"Material {material.name} is missing")
+            continue
+        for attribute, values, other_values in (
+            ('colour', TEXTURED_COLOR if material.texture_filename else material.face_color[:3], other.face_color[:3]),
+            ('specular colour', material.specular_color, other.specular_color),
+            ('emissive colour', material.emissive_color, other.emissive_color),
+        ):
+            if not np.allclose(values, other_values, rtol=0, atol=tolerance):
+                differences.append(f"Material {material.name}: {attribute} {tuple(values)} became {tuple(other_values)}")
+        if not np.isclose(material.power, other.power, rtol=1e-5, atol=tolerance):
+            differences.append(f"Material {material.name}: power {material.power} became {other.power}")
+        if material.texture_filename != other.texture_filename:
+            differences.append(f"Material {material.name}: texture {material.texture_filename!r} became {other.texture_filename!r}")
+    extra = set(actual_by_name) - {material.name for material in expected}
+    if extra:
+        differences.append(f"Materials {sorted(extra)} weren't in the input")
+    return differences
+
+def compare_frames(expected, actual, tolerance, path=''):
+    differences = []
+    if [frame.name for frame in expected] != [frame.name for frame in actual]:
+        return [f"{path or '/'}: frames {[frame.name for frame in expected]} became {[frame.name for frame in actual]}"]
+    for frame, other in zip(expected, actual):
+        frame_path = f"{path}/{frame.name}"
+        if frame.name != 'Frame_World' and (frame.transform_matrix is None) != (other.transform_matrix is None):
+            differences.append(f"{frame_path}: transform missing")
+        elif frame.name != 'Frame_World' and frame.transform_matrix is not None and not np.allclose(frame.transform_matrix, other.transform_matrix, rtol=0, atol=tolerance):
+            differences.append(f"{frame_path}: transform {frame.transform_matrix.tolist()} became {other.transform_matrix.tolist()}")
+        if len(frame.meshes) != len(other.meshes):
+            differences.append(f"{frame_path}: {len(frame.meshes)} meshes became {len(other.meshes)}")
+        else:
+            for mesh, other_mesh in zip(frame.meshes, other.meshes):
+                differences.extend(compare_meshes(f"{frame_path}/{mesh.name}", mesh, other_mesh, tolerance))
+        differences.extend(compare_frames(frame.frames, other.frames, tolerance, frame_path))
+    return differences
+
+def check_budgets(recorders, size, budgets):
+    # Returns the budgets exceeded, for steps or the stages inside them
+    megabytes = size / (1 << 20)
+    exceeded = []
+    for name, budget in budgets.items():
+        if name in recorders:
+            recorder = recorders[name]
+            seconds, peak_bytes = recorder.seconds, recorder.peak_bytes
+        else:
+            recorder = next((recorder for recorder in recorders.values() if name in recorder.stages), None)
+            if recorder is None:
+                continue
+            seconds, peak_bytes = recorder.stages[name]['seconds'], recorder.stages[name]['peak_bytes']
+        if 'seconds' in budget:
+            allowed = budget['seconds'][0] + budget['seconds'][1] * megabytes
+            if seconds > allowed:
+                exceeded.append(f"{name} took {seconds:.2f}s, over its {allowed:.2f}s budget")
+        if 'peak_mb' in budget and recorder.trace_memory:
+            allowed = budget['peak_mb'][0] + budget['peak_mb'][1] * megabytes
+            if peak_bytes / (1 << 20) > allowed:
+                exceeded.append(f"{name} peaked at {peak_bytes / (1 << 20):.1f} MB, over its {allowed:.1f} MB budget")
+    return exceeded
+
+def check_file(x_file, directory, expected_collision, binary, workers, tolerance, budgets, trace_memory, usda=False):
+    # Round trips one file, returning what went wrong and a summary line
+    parser, output_x_file, recorders = round_trip(x_file, directory, expected_collision, binary, workers, False, usda)
+    result = XFileParser(output_x_file, workers=1)
+    result.parse()
+
+    problems = compare_materials(parser.materials, result.materials, tolerance)
+    problems += compare_frames(parser.frames, result.frames, tolerance)
+    if not binary:
+        collision = frame_indentation(output_x_file)
+        for frame in iter_frames(parser.frames):
+            expected = expected_collision.get(frame.name, True)
+            if frame.name in collision and collision[frame.name] != expected:
+                problems.append(f"Frame {frame.name} is {'' if collision[frame.name] else 'not '}collision indented, "
+                                f"it should{'' if expected else ' not'} be")
+    del parser, result
+
+    size = os.path.getsize(x_file)
+    problems += check_budgets(recorders, size, budgets)
+    if trace_memory and budgets:
+        # peak memory is measured on a second run, tracemalloc slows everything down
+        problems += check_budgets(round_trip(x_file, directory, expected_collision, binary, workers, True, usda)[2], size,
+                                  {name: {'peak_mb': budget['peak_mb']} for name, budget in budgets.items() if 'peak_mb' in budget})
+    summary = '  '.join(f"{name} {recorder.seconds:.2f}s" for name, recorder in recorders.items())
+    return problems, summary
+
+def fixtures(directory, names):
+    # Writes the synthetic fixtures, yielding each file and its collision
+    os.makedirs(directory, exist_ok=True)
+    for name in names:
+        settings, non_colliding = FIXTURES[name]
+        frames, materials, animations = generate_scene(**settings)
+        collision = {frame.name: frame.name not in non_colliding for frame in iter_frames(frames)}
+        x_file = os.path.join(directory, name + '.x')
+        write_scene(x_file, frames, materials, animations, non_colliding=non_colliding)
+        yield x_file, collision
+        if name in BINARY_FIXTURES:
+            x_file = os.path.join(directory, name + '_bin.x')
+            write_scene(x_file, frames, materials, animations, binary=True)
+            yield x_file, collision
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert .x files to USD and back, and check nothing changed on the way.")
+    parser.add_argument("inputs", nargs="*", help=".x files, directories or patterns to check as well as the synthetic fixtures")
+    parser.add_argument("--fixtures", nargs="+", choices=list(FIXTURES), default=list(FIXTURES), help="Synthetic fixtures to check (defaults to all)")
+    parser.add_argument("--no-fixtures", dest="fixtures", action="store_const", const=[], help="Only check the files given")
+    parser.add_argument("--binary", action="store_true", help="Write binary .x files on the way back, which skips the collision check")
+    parser.add_argument("--usda", action="store_true", help="Go through a .usda written without pxr instead of a .usdc")
+    parser.add_argument("--jobs", type=int, help="Workers for the parser and writer (defaults to the number of CPUs)")
+    parser.add_argument("--tolerance", type=float, default=1e-5, help="Largest difference allowed between values (default 1e-5)")
+    parser.add_argument("--budgets", metavar="FILE", help="A JSON file of budgets to use instead of the built in ones, laid out like BUDGETS")
+    parser.add_argument("--no-budgets", action="store_true", help="Only check the output, not time or memory")
+    parser.add_argument("--no-memory", dest="trace_memory", action="store_false", help="Skip the extra run that checks peak memory")
+    parser.add_argument("--keep", metavar="DIR", help="Work in DIR and leave the files there")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    budgets = {} if args.no_budgets else BUDGETS
+    if args.budgets:
+        with open(args.budgets, encoding='utf-8') as f:
+            budgets = json.load(f)
+
+    directory = args.keep or tempfile.mkdtemp(prefix='xtools-roundtrip-')
+    os.makedirs(directory, exist_ok=True)
+    failed = 0
+    try:
+        checks = list(fixtures(os.path.join(directory, 'fixtures'), args.fixtures)) if args.fixtures else []
+        checks += [(x_file, frame_indentation(x_file)) for x_file in find_inputs(args.inputs, to_format='usd')]
+        for number, (x_file, collision) in enumerate(checks):
+            try:
+                problems, summary = check_file(x_file, os.path.join(directory, str(number)), collision, args.binary,
+                                               args.jobs, args.tolerance, budgets, args.trace_memory, args.usda)
+            except Exception as e:
+                problems, summary = [f"{type(e).__name__}: {e}"], ''
+            if problems:
+                failed += 1
+                print(f"FAILED {x_file}")
+                for problem in problems[:20]:
+                    print(f"    {problem}")
+                if len(problems) > 20:
+                    print(f"    and {len(problems) - 20} more")
+            else:
+                print(f"ok     {x_file}  {summary}")
+    finally:
+        if args.keep is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"{len(checks) - failed} of {len(checks)} round trips passed")
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,147 @@
+import numpy as np
+
+# The scene model shared by the .x parser, the USD exporter and the .x writer.
+# Geometry lives in typed numpy arrays rather than lists of tuples, so a mesh
+# costs a handful of buffers instead of a Python object per vertex.
+
+# What XFileParser.events() yields, in file order, each a tuple starting with
+# one of these:
+#   (MATERIAL, material)          top level and inline materials
+#   (FRAME_BEGIN, frame)          its transform isn't read yet
+#   (MESH, mesh)                  a mesh of the innermost open frame
+#   (FRAME_END, frame)            the frame with its transform, but no meshes or children
+#   (ANIMATION_SET, name, animation_set)
+MATERIAL = 'material'
+FRAME_BEGIN = 'frame begin'
+MESH = 'mesh'
+FRAME_END = 'frame end'
+ANIMATION_SET = 'animation set'
+
+def index_dtype(count):
+    # 16 bit indices cover nearly every Recettear mesh
+    return np.uint16 if count < 65536 else np.uint32
+
+def vector_array(values, dim):
+    if values is None or len(values) == 0:
+        return np.empty((0, dim), dtype=np.float32)
+    # float64 arrays, like the .x writer's flipped normals and UVs, stay
+    # float64 so they're only rounded once, when they're written out
+    dtype = np.float64 if getattr(values, 'dtype', None) == np.float64 else np.float32
+    # views into binary .x data are only copied when they aren't aligned
+    return np.require(values, dtype=dtype, requirements='CA').reshape(-1, dim)
+
+def face_array(faces, vertex_count):
+    dtype = index_dtype(vertex_count)
+    if faces is None or len(faces) == 0:
+        return np.empty((0, 3), dtype=dtype)
+    return np.require(faces, dtype=dtype, requirements='CA').reshape(-1, 3)
+
+def triangulate(faces):
+    # Fan triangulates a list of polygons. Returns the triangles and, for each
+    # triangle, the index of the polygon it came from.
+    triangles = []
+    source = []
+    for face_index, face in enumerate(faces):
+        for i in range(1, len(face) - 1):
+            triangles.append((face[0], face[i], face[i + 1]))
+            source.append(face_index)
+    return np.array(triangles, dtype=np.int64).reshape(-1, 3), np.array(source, dtype=np.int64)
+
+class Material:
+    __slots__ = ('name', 'face_color', 'power', 'specular_color', 'emissive_color', 'texture_filename')
+
+    def __init__(self, name, face_color, power, specular_color, emissive_color, texture_filename=None):
+        self.name = name
+        self.face_color = face_color
+        self.power = power
+        self.specular_color = specular_color
+        self.emissive_color = emissive_color
+        self.texture_filename = texture_filename
+
+    def __repr__(self):
+        return (f"Material(name={self.name!r}, face_color={self.face_color}, power={self.power}, "
+                f"specular_color={self.specular_color}, emissive_color={self.emissive_color}, "
+                f"texture_filename={self.texture_filename!r})")
+
+class Mesh:
+    __slots__ = ('name', 'vertices', 'faces', 'normals', 'normal_faces', 'uvs', 'colors', 'material_indices', 'materials')
+
+    def __init__(self, name, vertices=None, faces=None, normals=None, normal_faces=None, uvs=None, colors=None, material_indices=None, materials=None):
+        self.name = name
+        self.vertices = vector_array(vertices, 3)
+        self.faces = face_array(faces, len(self.vertices))
+        self.normals = vector_array(normals, 3)
+        self.normal_faces = face_array(normal_faces, len(self.normals))
+        self.uvs = vector_array(uvs, 2)
+        self.colors = vector_array(colors, 3)
+        # material index per face, into the material names in self.materials
+        self.material_indices = np.asarray(material_indices if material_indices is not None else [], dtype=np.uint16)
+        self.materials = materials if materials is not None else []
+
+    def __repr__(self):
+        return f"Mesh(name={self.name!r}, vertices={len(self.vertices)}, faces={len(self.faces)}, materials={self.materials})"
+
+class Frame:
+    __slots__ = ('name', 'transform_matrix', 'meshes', 'frames')
+
+    def __init__(self, name, transform_matrix=None):
+        self.name = name
+        # row-major (4, 4) float64, as written in FrameTransformMatrix
+        self.transform_matrix = transform_matrix
+        self.meshes = []
+        self.frames = []
+
+    def __repr__(self):
+        return f"Frame(name={self.name!r}, meshes={len(self.meshes)}, frames={len(self.frames)})"
+
+class AnimationKey:
+    # One AnimationKey block: the keys of one type for one bone, as a column
+    # of frame numbers and a row of values per key
+    __slots__ = ('type', 'bone_name', 'frames', 'values')
+
+    def __init__(self, type, bone_name, frames, values):
+        self.type = type
+        self.bone_name = bone_name
+        self.frames = np.asarray(frames, dtype=np.int32)
+        # (keys, dim) float32, in the order the file lists them
+        self.values = np.asarray(values, dtype=np.float32)
+
+    def __repr__(self):
+        return f"AnimationKey(type={self.type!r}, bone_name={self.bone_name!r}, keys={len(self.frames)})"
+
+def build_scene(events):
+    # Puts the frames, materials and animations back together from a stream
+    # of events, into new Frames
+    frames, materials, animations = [], [], {}
+    open_frames = []
+    for event in events:
+        kind = event[0]
+        if kind == MATERIAL:
+            materials.append(event[1])
+        elif kind == FRAME_BEGIN:
+            frame = Frame(event[1].name)
+            (open_frames[-1].frames if open_frames else frames).append(frame)
+            open_frames.append(frame)
+        elif kind == MESH:
+            open_frames[-1].meshes.append(event[1])
+        elif kind == FRAME_END:
+            open_frames.pop().transform_matrix = event[1].transform_matrix
+        elif kind == ANIMATION_SET:
+            animations[event[1]] = event[2]
+    return frames, materials, animations
+
+def scene_events(frames, materials, animations):
+    # The events for a scene that's already been read, as if it was parsed
+    for material in materials:
+        yield MATERIAL, material
+    yield from frame_events(frames)
+    for name, animation_set in animations.items():
+        yield ANIMATION_SET, name, animation_set
+
+def frame_events(frames):
+    for frame in frames:
+        yield FRAME_BEGIN, frame
+        for mesh in frame.meshes:
+            yield MESH, mesh
+        yield from frame_events(frame.frames)
+        yield FRAME_END, frame
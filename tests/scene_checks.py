@@ -0,0 +1,33 @@
+import numpy as np
+from scene_model import Material, Mesh, Frame, AnimationKey
+
+# Checks that two parsed scenes hold the same frames, meshes, materials and
+# animations, array for array. Binary files keep float32s where values from
+# text files are float64, so those are compared as float32 with float32=True.
+
+def assert_same_values(expected, actual, path, float32=False):
+    if isinstance(expected, (Material, Mesh, Frame, AnimationKey)):
+        assert type(expected) is type(actual), path
+        for slot in type(expected).__slots__:
+            assert_same_values(getattr(expected, slot), getattr(actual, slot), f"{path}.{slot}", float32)
+    elif isinstance(expected, dict):
+        assert list(expected) == list(actual), path
+        for key in expected:
+            assert_same_values(expected[key], actual[key], f"{path}[{key!r}]", float32)
+    elif isinstance(expected, (list, tuple)) and not all(np.isscalar(value) for value in expected):
+        assert len(expected) == len(actual), path
+        for i, (a, b) in enumerate(zip(expected, actual)):
+            assert_same_values(a, b, f"{path}[{i}]", float32)
+    elif expected is None or isinstance(expected, str):
+        assert expected == actual, path
+    else:
+        expected, actual = np.asarray(expected), np.asarray(actual)
+        if float32 and expected.dtype.kind == 'f':
+            expected, actual = expected.astype(np.float32), actual.astype(np.float32)
+        assert np.array_equal(expected, actual), path
+
+def assert_same_scene(expected, actual, float32=False):
+    # expected and actual are XFileParsers that have parsed their files
+    assert_same_values(expected.materials, actual.materials, 'materials', float32)
+    assert_same_values(expected.frames, actual.frames, 'frames', float32)
+    assert_same_values(expected.animations, actual.animations, 'animations', float32)
@@ -0,0 +1,86 @@
+import os
+import pytest
+import main
+from x_file_generator import generate_scene, write_scene
+from x_file_writer import SerialExecutor
+
+# binary, cache_dir, weld_tolerance, usd_format, instance_meshes, payload_faces
+OPTIONS = (False, None, 0.0, 'usda', False, None)
+
+def write_x(x_file, seed=0):
+    frames, materials, animations = generate_scene(seed, materials=2, depth=1, children=2, vertices=16)
+    write_scene(str(x_file), frames, materials, animations)
+
+def test_batch_reports_conflicts_and_failures(tmp_path, capsys):
+    write_x(tmp_path / 'good.x')
+    main.convert_file(str(tmp_path / 'good.x'), *OPTIONS)
+    # a .usd without a lonely_frames.json for its output
+    os.replace(tmp_path / 'good.usda', tmp_path / 'lonely.usda')
+    (tmp_path / 'broken.x').write_bytes(b'xof 0303txt 0032\nFrame Frame_World {\n\tMesh Broken {\n\t\tthree;')
+    # same output, and a file whose output is also in the batch
+    (tmp_path / 'same.usd').write_bytes(b'')
+    (tmp_path / 'same.usdc').write_bytes(b'')
+    (tmp_path / 'both.x').write_bytes(b'')
+    (tmp_path / 'both.usda').write_bytes(b'')
+
+    inputs = main.find_inputs([str(tmp_path)])
+    failures = main.convert_batch(SerialExecutor(), inputs, OPTIONS)
+
+    names = {os.path.basename(filename) for filename in failures}
+    assert names == {'lonely.usda', 'broken.x', 'same.usd', 'same.usdc', 'both.x', 'both.usda'}
+    assert 'would also be written by another file' in failures[str(tmp_path / 'same.usd')]
+    assert 'is also in the batch' in failures[str(tmp_path / 'both.x')]
+    assert failures[str(tmp_path / 'lonely.usda')].startswith('ValueError')
+    # the rest of the batch still ran
+    assert (tmp_path / 'good.usda').exists()
+    assert 'Converted 1 files' in capsys.readouterr().out
+
+def test_incremental_batch_only_redoes_stale_files(tmp_path, capsys, monkeypatch):
+    from conversion_manifest import ConversionManifest
+    import x_file_parser
+    write_x(tmp_path / 'a.x')
+    write_x(tmp_path / 'b.x', seed=1)
+    inputs = main.find_inputs([str(tmp_path)])
+
+    def run():
+        # a new manifest each time, as a new run of main.py would load
+        assert main.convert_batch(SerialExecutor(), inputs, OPTIONS, ConversionManifest(str(tmp_path / 'manifest.json'))) == {}
+        return capsys.readouterr().out
+
+    assert 'Converted 2 files' in run()
+    assert 'All 2 files are up to date' in run()
+
+    write_x(tmp_path / 'a.x', seed=2)
+    out = run()
+    assert 'Converted 1 files' in out and '1 up to date' in out
+    assert str(tmp_path / 'a.x') in out
+
+    monkeypatch.setattr(x_file_parser, 'PARSER_VERSION', x_file_parser.PARSER_VERSION + 1)
+    assert 'Converted 2 files' in run()
+    assert 'All 2 files are up to date' in run()
+
+def test_converts_in_process_without_a_daemon(tmp_path, capsys, monkeypatch):
+    import tempfile
+    import conversion_daemon
+    # the daemon's info file goes in here rather than the real temp folder
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    x_file = tmp_path / 'scene.x'
+    write_x(x_file)
+
+    def convert(use_daemon=True):
+        usda_file = tmp_path / 'scene.usda'
+        if usda_file.exists():
+            usda_file.unlink()
+        main.main(str(x_file), usd_format='usda', use_daemon=use_daemon)
+        assert usda_file.exists()
+        assert f"Converted {x_file} to {usda_file}" in capsys.readouterr().out
+
+    # no daemon has been started
+    convert()
+    # one that died without removing its info file
+    conversion_daemon.write_info(str(tmp_path / 'gone.sock'), os.urandom(32))
+    assert conversion_daemon.request({'ping': True}) is None
+    convert()
+    # --no-daemon doesn't look for one at all
+    monkeypatch.setattr(conversion_daemon, 'request', lambda message: pytest.fail("asked the daemon"))
+    convert(use_daemon=False)
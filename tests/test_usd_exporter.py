@@ -0,0 +1,51 @@
+import logging
+import numpy as np
+from pxr import Sdf, Usd, UsdSkel
+from x_file_generator import generate_scene
+from usd_exporter import USDExporter
+
+def test_usdz_with_missing_textures(tmp_path, caplog):
+    frames, materials, animations = generate_scene(materials=4, depth=1, children=2, vertices=16)
+    textures = sorted({material.texture_filename for material in materials if material.texture_filename})
+    # only the first texture is next to the output
+    (tmp_path / textures[0]).write_bytes(b'BM')
+    usdz_file = tmp_path / 'scene.usdz'
+
+    with caplog.at_level(logging.WARNING, logger='usd_exporter'):
+        USDExporter(frames, materials, animations, payload_faces=0).export(str(usdz_file))
+
+    names = Sdf.ZipFile.Open(str(usdz_file)).GetFileNames()
+    assert names[0] == 'scene.usdc'
+    assert textures[0] in names
+    assert not any(texture in names for texture in textures[1:])
+    assert all(texture in caplog.text for texture in textures[1:])
+    # the crate file and payload layers were only there to be packed
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([textures[0], 'scene.usdz', 'scene_speculars.json'])
+
+def test_skeleton_samples_match_the_keys(tmp_path):
+    frames, materials, animations = generate_scene(materials=1, depth=1, children=3, vertices=16, animation_sets=1, keys=8)
+    usda_file = tmp_path / 'scene.usda'
+    exporter = USDExporter(frames, materials, animations)
+    exporter.skipAnimations = False
+    exporter.export(str(usda_file))
+
+    stage = Usd.Stage.Open(str(usda_file))
+    anim = UsdSkel.Animation(stage.GetPrimAtPath('/AnimationSet_0/Anim'))
+    joints = list(anim.GetJointsAttr().Get())
+    keys = [key for keys in animations['AnimationSet_0']['animations'].values() for key in keys]
+    # the bones are keyed at different frames, so most samples are interpolated
+    assert len({tuple(key.frames) for key in keys}) > 1
+
+    attrs = {'Rotation': anim.GetRotationsAttr(), 'Scale': anim.GetScalesAttr(), 'Position': anim.GetTranslationsAttr()}
+    for key in keys:
+        joint = joints.index(key.bone_name)
+        # before its first key a joint holds it
+        times = [0] + key.frames.tolist() if key.frames[0] > 0 else key.frames.tolist()
+        values = np.concatenate((key.values[:1], key.values)) if key.frames[0] > 0 else key.values
+        for time, value in zip(times, values):
+            sample = attrs[key.type].Get(time)[joint]
+            if key.type == 'Rotation':
+                sample = np.array([*sample.GetImaginary(), sample.GetReal()])
+                assert np.allclose(sample, value, atol=1e-5) or np.allclose(sample, -value, atol=1e-5), (key.bone_name, time)
+            else:
+                assert np.allclose(np.array(sample, dtype=np.float32), value, rtol=1e-3), (key.type, key.bone_name, time)
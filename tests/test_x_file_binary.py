@@ -0,0 +1,64 @@
+import pytest
+import roundtrip
+from scene_checks import assert_same_scene
+from x_file_binary import MSZipReader, mszip_compress
+from x_file_generator import generate_scene, write_scene
+from x_file_parser import XFileParser
+
+# text, binary and MSZIP compressed forms of the same scene, by file format
+FORMATS = {'txt': (False, False), 'bin': (True, False), 'tzip': (False, True), 'bzip': (True, True)}
+
+def parse(filename):
+    parser = XFileParser(str(filename))
+    parser.parse()
+    return parser
+
+@pytest.fixture(scope='module')
+def scene():
+    # big enough for a few dozen MSZIP blocks
+    return generate_scene(materials=4, depth=2, children=3, vertices=400, animation_sets=1)
+
+@pytest.mark.parametrize('compressed_format, binary', [('tzip', False), ('bzip', True)])
+def test_compressed_files_parse_like_uncompressed(tmp_path, scene, compressed_format, binary):
+    plain_file = tmp_path / 'plain.x'
+    compressed_file = tmp_path / 'compressed.x'
+    write_scene(str(plain_file), *scene, binary)
+    write_scene(str(compressed_file), *scene, binary, compressed=True)
+    assert compressed_file.read_bytes()[8:12] == compressed_format.encode()
+    assert compressed_file.stat().st_size < plain_file.stat().st_size // 2
+
+    compressed = parse(compressed_file)
+    assert compressed.file_format == compressed_format.encode()
+    assert_same_scene(parse(plain_file), compressed)
+
+def test_text_and_binary_parse_the_same(tmp_path, scene):
+    # the generator's values are all exact at the 6 places text keeps, so
+    # they only differ by binary files holding float32s
+    parsers = {}
+    for file_format, (binary, compressed) in FORMATS.items():
+        x_file = tmp_path / f'{file_format}.x'
+        write_scene(str(x_file), *scene, binary, compressed=compressed)
+        parsers[file_format] = parse(x_file)
+    assert_same_scene(parsers['txt'], parsers['tzip'])
+    assert_same_scene(parsers['bin'], parsers['bzip'])
+    assert_same_scene(parsers['txt'], parsers['bin'], float32=True)
+
+@pytest.mark.parametrize('block_size', [7, 1000, 1 << 15])
+def test_mszip_blocks(tmp_path, block_size):
+    # tokens and numbers cut by block boundaries, and blocks that lean on
+    # the one before for their matches
+    data = b'xof 0303txt 0032' + b''.join(b'Frame F%d { 1.000000, 2.500000; }\n' % (i % 50) for i in range(3000))
+    compressed = mszip_compress(data, block_size)
+    x_file = tmp_path / 'blocks.x'
+    x_file.write_bytes(compressed)
+    with open(x_file, 'rb') as file:
+        file.seek(16)
+        assert MSZipReader(file).read() == data[16:]
+
+@pytest.mark.parametrize('compressed', [False, True], ids=['bin', 'bzip'])
+def test_binary_output_round_trips(tmp_path, compressed):
+    frames, materials, animations = generate_scene(materials=4, depth=2, children=2, vertices=100)
+    x_file = tmp_path / 'scene.x'
+    write_scene(str(x_file), frames, materials, animations, binary=True, compressed=compressed)
+    problems, _ = roundtrip.check_file(str(x_file), str(tmp_path / 'work'), {}, True, 1, 1e-5, {}, False)
+    assert problems == []
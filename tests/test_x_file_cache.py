@@ -0,0 +1,17 @@
+import pytest
+from x_file_cache import XFileCache
+from x_file_generator import generate_scene
+
+@pytest.mark.parametrize('corrupt', [
+    lambda data: data[:len(data) // 2],
+    lambda data: b'PK\x03\x04' + bytes(64),
+], ids=['truncated', 'garbage'])
+def test_corrupt_entry_is_a_miss(tmp_path, corrupt):
+    cache = XFileCache(str(tmp_path))
+    frames, materials, animations = generate_scene(materials=2, depth=1, children=2, vertices=16)
+    cache.store('key', frames, materials, animations)
+    assert cache.load('key') is not None
+
+    path = tmp_path / 'key.npz'
+    path.write_bytes(corrupt(path.read_bytes()))
+    assert cache.load('key') is None
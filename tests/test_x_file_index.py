@@ -0,0 +1,44 @@
+import pytest
+from scene_checks import assert_same_values
+from x_file_generator import generate_scene, write_scene
+from x_file_parser import XFileParser
+
+FORMATS = [(False, False), (True, False), (False, True), (True, True)]
+
+def scene_paths(frames, prefix=''):
+    # ('Frame', path, frame) and ('Mesh', path, mesh) for everything parsed
+    for frame in frames:
+        path = prefix + frame.name
+        yield 'Frame', path, frame
+        for mesh in frame.meshes:
+            yield 'Mesh', f"{path}/{mesh.name}", mesh
+        yield from scene_paths(frame.frames, path + '/')
+
+@pytest.mark.parametrize('binary, compressed', FORMATS, ids=['txt', 'bin', 'tzip', 'bzip'])
+def test_index_agrees_with_a_full_parse(tmp_path, binary, compressed):
+    frames, materials, animations = generate_scene(materials=3, depth=2, children=2, vertices=32, animation_sets=1)
+    x_file = tmp_path / 'scene.x'
+    write_scene(str(x_file), frames, materials, animations, binary, compressed=compressed)
+    parser = XFileParser(str(x_file))
+    parser.parse()
+
+    index = XFileParser(str(x_file))
+    index.index()
+    kinds = {path: block.kind for path, block in index.block_paths.items()}
+    expected = list(scene_paths(parser.frames))
+    assert {path: kind for kind, path, _ in expected}.items() <= kinds.items()
+    assert sorted(path for path, kind in kinds.items() if kind == 'AnimationSet') == sorted(parser.animations)
+
+    for kind, path, value in expected:
+        loaded = index.get_frame(path) if kind == 'Frame' else index.get_mesh(path)
+        assert_same_values(value, loaded, path)
+
+def test_get_mesh_checks_the_block_kind(tmp_path):
+    frames, materials, animations = generate_scene(materials=1, depth=1, children=1, vertices=16)
+    x_file = tmp_path / 'scene.x'
+    write_scene(str(x_file), frames, materials, animations)
+    parser = XFileParser(str(x_file))
+    with pytest.raises(ValueError):
+        parser.get_mesh('Frame_World')
+    with pytest.raises(KeyError):
+        parser.get_frame('Frame_World/Missing')
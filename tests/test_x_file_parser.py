@@ -0,0 +1,90 @@
+import json
+import pytest
+from scene_checks import assert_same_scene
+from x_file_generator import generate_scene, write_scene
+import worker_pools
+import x_file_parser
+from x_file_parser import XFileParser
+from x_file_tokenizer import XTokenizer
+
+def test_frames_json_is_valid(tmp_path):
+    frames, materials, animations = generate_scene(materials=2, depth=2, children=2, vertices=16)
+    x_file = tmp_path / 'scene.x'
+    write_scene(str(x_file), frames, materials, animations)
+    parser = XFileParser(str(x_file))
+    parser.parse()
+    json_file = tmp_path / 'scene_frames.json'
+    parser.export_to_json(str(json_file))
+
+    def names(frame):
+        return [frame['name'], frame['nickname'], [names(child) for child in frame.get('children', [])]]
+
+    with open(json_file, encoding='utf-8') as f:
+        world = json.load(f)
+    leaves = [[f'Frame_Obj{i}_{j}', f'Obj{i}_{j}', []] for i in range(2) for j in range(2)]
+    assert names(world) == ['Frame_World', 'World', [
+        ['Frame_Obj0', 'Obj0', leaves[:2]],
+        ['Frame_Obj1', 'Obj1', leaves[2:]],
+    ]]
+    assert world['collision'] == 'True'
+
+@pytest.mark.parametrize('binary', [False, True], ids=['text', 'binary'])
+def test_template_declarations_are_skipped(tmp_path, binary):
+    frames, materials, animations = generate_scene(materials=3, depth=2, children=2, vertices=16, animation_sets=1)
+    plain_file = tmp_path / 'plain.x'
+    templated_file = tmp_path / 'templated.x'
+    write_scene(str(plain_file), frames, materials, animations, binary)
+    write_scene(str(templated_file), frames, materials, animations, binary, templates=True)
+
+    plain = XFileParser(str(plain_file))
+    plain.parse()
+    templated = XFileParser(str(templated_file))
+    templated.parse()
+    assert_same_scene(plain, templated)
+    # the index doesn't take the declarations for blocks either
+    assert [block.kind for block in templated.index()] == [block.kind for block in plain.index()]
+    assert templated.get_mesh('Frame_World/Frame_Obj1/Obj1').name == 'Obj1'
+
+def parse_in_parallel(x_file, monkeypatch):
+    monkeypatch.setattr(x_file_parser, 'PARALLEL_MIN_BYTES', 0)
+    # a pool job per mesh
+    monkeypatch.setattr(x_file_parser, 'MESH_BATCH_BYTES', 1)
+    pools = []
+    process_pool = worker_pools.process_pool
+    def counted_pool(workers):
+        pools.append(workers)
+        return process_pool(workers)
+    monkeypatch.setattr(worker_pools, 'process_pool', counted_pool)
+    parser = XFileParser(str(x_file), workers=2)
+    parser.parse()
+    assert pools == [2]
+    return parser
+
+@pytest.mark.parametrize('binary, compressed', [(False, False), (True, False), (False, True), (True, True)],
+                         ids=['txt', 'bin', 'tzip', 'bzip'])
+def test_parallel_parse_matches_serial(tmp_path, monkeypatch, binary, compressed):
+    frames, materials, animations = generate_scene(materials=3, depth=2, children=2, vertices=64, animation_sets=1)
+    x_file = tmp_path / 'scene.x'
+    write_scene(str(x_file), frames, materials, animations, binary, compressed=compressed)
+    serial = XFileParser(str(x_file), workers=1)
+    serial.parse()
+    assert_same_scene(serial, parse_in_parallel(x_file, monkeypatch))
+
+@pytest.mark.parametrize('chunk_size', [61, 256, 4099, 1 << 20])
+def test_parallel_parse_around_comments_and_chunks(tmp_path, monkeypatch, chunk_size):
+    # placeholders next to comments, and with small chunks, on either side
+    # of where the tokenizer cuts the rest of the file
+    frames, materials, animations = generate_scene(materials=3, depth=2, children=2, vertices=64)
+    x_file = tmp_path / 'scene.x'
+    write_scene(str(x_file), frames, materials, animations)
+    data = x_file.read_bytes()
+    data = data.replace(b'Mesh Obj0 {', b'// before a mesh\n\tMesh Obj0 { // after its brace')
+    data = data.replace(b'Frame Frame_Obj0_0 {', b'# after a mesh\n\t\tFrame Frame_Obj0_0 { # after a frame')
+    data = data.replace(b'Frame Frame_Obj1_1 {', b'Frame Frame_Obj1_1 {// straight after a brace')
+    x_file.write_bytes(data)
+
+    monkeypatch.setattr(XTokenizer.__init__, '__defaults__', (chunk_size,))
+    serial = XFileParser(str(x_file), workers=1)
+    serial.parse()
+    assert [mesh.name for frame in serial.frames[0].frames for mesh in frame.meshes] == ['Obj0', 'Obj1']
+    assert_same_scene(serial, parse_in_parallel(x_file, monkeypatch))
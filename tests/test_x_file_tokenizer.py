@@ -0,0 +1,24 @@
+import io
+from x_file_generator import generate_scene, write_scene
+from x_file_parser import XFileParser
+from x_file_tokenizer import XTokenizer
+
+def test_comments_are_skipped():
+    tokenizer = XTokenizer(io.BytesIO(b'Mesh m { // a comment\n 1;2;# another\n3.0;}\n'))
+    tokens = []
+    while tokenizer.peek_token() is not None:
+        tokens.append(tokenizer.next_token())
+    assert tokens == [b'Mesh', b'm', b'{', b'1', b'2', b'3.0', b'}']
+
+def test_comment_markers_inside_texture_filenames(tmp_path):
+    frames, materials, animations = generate_scene(materials=2, depth=1, children=1, vertices=16)
+    materials[0].texture_filename = 'tex//a.bmp'
+    materials[1].texture_filename = 'tex_#1.bmp'
+    x_file = tmp_path / 'scene.x'
+    write_scene(str(x_file), frames, materials, animations)
+    # a comment after the string still goes
+    x_file.write_bytes(x_file.read_bytes().replace(b'"tex//a.bmp";', b'"tex//a.bmp"; // comment'))
+
+    parser = XFileParser(str(x_file))
+    parser.parse()
+    assert [material.texture_filename for material in parser.materials] == ['tex//a.bmp', 'tex_#1.bmp']
@@ -0,0 +1,114 @@
+import shutil
+import numpy as np
+import pytest
+from pxr import Usd, UsdGeom, Sdf, Vt
+from usd_exporter import USDExporter
+import worker_pools
+import x_file_writer
+from x_file_generator import generate_scene, write_scene
+from x_file_parser import XFileParser
+from x_file_text import render_mesh
+from x_file_writer import USDToXConverter
+
+POINTS = [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0)]
+FACE_VERTEX_INDICES = [0, 1, 2, 0, 2, 3]
+VERTEX_NORMALS = [(0, 0, 1), (0, 1, 0), (1, 0, 0), (0, 0, -1)]
+VERTEX_UVS = [(0, 0), (1, 0), (1, 1), (0, 1)]
+
+def write_stage(path, normals, normals_interpolation, uvs, uv_indices, uv_interpolation):
+    stage = Usd.Stage.CreateNew(str(path))
+    UsdGeom.Xform.Define(stage, '/Frame_World')
+    mesh = UsdGeom.Mesh.Define(stage, '/Frame_World/Quad')
+    mesh.CreatePointsAttr(POINTS)
+    mesh.CreateFaceVertexCountsAttr([3, 3])
+    mesh.CreateFaceVertexIndicesAttr(FACE_VERTEX_INDICES)
+    mesh.CreateNormalsAttr(normals)
+    mesh.SetNormalsInterpolation(normals_interpolation)
+    st = UsdGeom.PrimvarsAPI(mesh).CreatePrimvar('st', Sdf.ValueTypeNames.TexCoord2fArray, uv_interpolation)
+    st.Set(Vt.Vec2fArray(uvs))
+    if uv_indices is not None:
+        st.SetIndices(Vt.IntArray(uv_indices))
+    stage.Save()
+
+@pytest.mark.parametrize('normals, normals_interpolation, uvs, uv_indices, uv_interpolation', [
+    # our own exporter
+    (VERTEX_NORMALS, 'vertex', VERTEX_UVS, None, 'vertex'),
+    # Blender
+    ([VERTEX_NORMALS[i] for i in FACE_VERTEX_INDICES], 'faceVarying', [VERTEX_UVS[i] for i in FACE_VERTEX_INDICES], None, 'faceVarying'),
+    # indexed UVs
+    (VERTEX_NORMALS, 'varying', VERTEX_UVS, FACE_VERTEX_INDICES, 'faceVarying'),
+], ids=['vertex', 'face_varying', 'indexed'])
+def test_normals_and_uvs_are_spread_to_corners(tmp_path, normals, normals_interpolation, uvs, uv_indices, uv_interpolation):
+    usd_file = tmp_path / 'quad.usda'
+    write_stage(usd_file, normals, normals_interpolation, uvs, uv_indices, uv_interpolation)
+    converter = USDToXConverter(str(usd_file))
+    _, _, corner_normals, _, corner_uvs, _, _, _ = converter.read_mesh(converter.stage.GetPrimAtPath('/Frame_World/Quad'))
+    assert np.array_equal(corner_normals, np.array(VERTEX_NORMALS)[FACE_VERTEX_INDICES])
+    assert np.array_equal(corner_uvs, np.array(VERTEX_UVS)[FACE_VERTEX_INDICES])
+
+def test_uniform_normals_are_spread_to_corners(tmp_path):
+    usd_file = tmp_path / 'quad.usda'
+    write_stage(usd_file, VERTEX_NORMALS[:2], 'uniform', VERTEX_UVS, None, 'vertex')
+    converter = USDToXConverter(str(usd_file))
+    corner_normals = converter.read_mesh(converter.stage.GetPrimAtPath('/Frame_World/Quad'))[2]
+    assert np.array_equal(corner_normals, np.repeat(VERTEX_NORMALS[:2], 3, axis=0))
+
+def test_flipped_uvs_are_only_rounded_once():
+    # 1 - v rounded to float32 first would be written as 0.618863
+    uvs = np.array(VERTEX_UVS, dtype=np.float32)[FACE_VERTEX_INDICES]
+    uvs[0, 1] = 0.38113752
+    mesh = x_file_writer.build_mesh('Quad', np.array(POINTS, dtype=np.float32), np.array(VERTEX_NORMALS, dtype=np.float32)[FACE_VERTEX_INDICES],
+                                    FACE_VERTEX_INDICES, uvs, np.ones((4, 3), dtype=np.float32), None, [], 0.0)
+    assert '0.000000;0.618862;' in render_mesh(mesh, 'Quad', 0)
+
+def test_materials_are_read_from_our_own_shader(tmp_path):
+    frames, materials, animations = generate_scene(materials=4, depth=1, children=1, vertices=16)
+    usd_file = tmp_path / 'scene.usdc'
+    USDExporter(frames, materials, animations).export(str(usd_file))
+    converter = USDToXConverter(str(usd_file))
+    converter.extract_materials()
+    assert [material.name for material in converter.materials] == [material.name for material in materials]
+    for read, written in zip(converter.materials, materials):
+        assert read.texture_filename == written.texture_filename
+        assert read.power == pytest.approx(written.power, rel=1e-6)
+        assert read.emissive_color == pytest.approx(written.emissive_color)
+        if not written.texture_filename:
+            assert read.face_color == pytest.approx(written.face_color[:3])
+
+def usd_scene(tmp_path):
+    # a generated scene as a .usd file, with the _frames.json for writing it back out
+    frames, materials, animations = generate_scene(materials=3, depth=2, children=3, vertices=64)
+    x_file = tmp_path / 'scene.x'
+    write_scene(str(x_file), frames, materials, animations)
+    parser = XFileParser(str(x_file))
+    parser.parse()
+    usd_file = tmp_path / 'scene.usdc'
+    USDExporter(parser.frames, parser.materials, parser.animations).export(str(usd_file))
+    return usd_file
+
+def write_x(usd_file, output_x_file, workers):
+    shutil.copyfile(usd_file.with_name('scene_frames.json'), output_x_file.with_name(output_x_file.stem + '_frames.json'))
+    USDToXConverter(str(usd_file), workers=workers).convert(str(output_x_file))
+    return output_x_file.read_bytes()
+
+def test_small_scenes_are_rendered_without_a_pool(tmp_path, monkeypatch):
+    usd_file = usd_scene(tmp_path)
+    def no_pool(workers):
+        raise AssertionError("started a pool for a small scene")
+    monkeypatch.setattr(worker_pools, 'process_pool', no_pool)
+    write_x(usd_file, tmp_path / 'out.x', 4)
+
+def test_pool_renders_the_same_file(tmp_path, monkeypatch):
+    usd_file = usd_scene(tmp_path)
+    serial = write_x(usd_file, tmp_path / 'serial.x', 1)
+    monkeypatch.setattr(x_file_writer, 'PARALLEL_MIN_FACES', 0)
+    assert write_x(usd_file, tmp_path / 'parallel.x', 2) == serial
+
+    # the daemon keeps one pool for every conversion
+    started = []
+    executor = worker_pools.ProcessPoolExecutor
+    monkeypatch.setattr(worker_pools, 'ProcessPoolExecutor', lambda workers: started.append(workers) or executor(workers))
+    with worker_pools.keep_pools():
+        assert write_x(usd_file, tmp_path / 'kept1.x', 2) == serial
+        assert write_x(usd_file, tmp_path / 'kept2.x', 2) == serial
+    assert started == [2]
@@ -1,38 +1,128 @@
-from pxr import Usd, UsdGeom, Gf, Sdf, UsdShade, UsdSkel, Vt, Tf
-import json
+from pxr import Sdf, Gf, Vt
+import hashlib, json, logging, os
+import numpy as np
+import instrumentation
+from scene_model import build_scene, MATERIAL, FRAME_BEGIN, MESH, FRAME_END, ANIMATION_SET
+
+log = logging.getLogger(__name__)
+
+# The stage is authored straight into an Sdf layer inside one change block,
+# so nothing is recomposed until the whole file has been written
+
+MATERIALS_PATH = Sdf.Path('/Materials')
+PROTOTYPES_PATH = Sdf.Path('/Prototypes')
 
 class USDExporter:
-    def __init__(self, frames, materials, animations):
+    def __init__(self, frames, materials, animations, instance_meshes=False, payload_faces=None):
         self.frames = frames
         self.materials = materials
         self.animations = animations
+        # identical meshes are written once and referenced wherever they're used
+        self.instance_meshes = instance_meshes
+        # prototype name by mesh id, and the mesh each prototype is written from
+        self.prototypes = {}
+        self.prototype_meshes = {}
+        # children of the top frame with at least this many faces under them
+        # are written to their own layers and loaded as payloads
+        self.payload_faces = payload_faces
+        self.payload_layers = []
 
         self.textureList = []
         self.skipAnimations = True
 
-    def export(self, output_usd_file):
-        stage = Usd.Stage.CreateNew(output_usd_file)
-        self.create_materials(stage)
-        self.process_frames(stage, self.frames, None)
-        if not self.skipAnimations:
-            self.add_animation_sets(stage, self.animations)
+    def export(self, output_usd_file, events=None):
+        # .usda is text, .usdc and .usd are binary crate files and .usdz
+        # is a package holding a crate file and its textures.
+        # events is a stream from XFileParser.events() to write from as the
+        # file is parsed, in place of the frames, materials and animations
+        # given to the constructor. Instancing and payloads have to see
+        # every mesh first, so for those the scene is gathered up beforehand.
+        if events is not None and (self.instance_meshes or self.payload_faces is not None):
+            self.frames, self.materials, self.animations = build_scene(events)
+            events = None
+
+        if output_usd_file.endswith('.usdz'):
+            layer_file = output_usd_file.removesuffix('.usdz') + '.usdc'
+        else:
+            layer_file = output_usd_file
+
+        with instrumentation.stage('build usd'):
+            layer = Sdf.Layer.CreateNew(layer_file)
+            with Sdf.ChangeBlock():
+                if events is not None:
+                    self.author_events(layer, events)
+                else:
+                    self.create_materials(layer, MATERIALS_PATH, self.materials)
+                    if self.instance_meshes:
+                        self.find_prototypes(self.frames)
+                    self.process_frames(layer, self.frames, Sdf.Path.absoluteRootPath, MATERIALS_PATH, self.payload_faces is not None)
+                if not self.skipAnimations:
+                    self.add_animation_sets(layer, self.animations)
         
         if len(self.textureList):
-            print("Copy the following files into this directory:")
+            log.info("Copy the following files into this directory:")
             self.textureList.sort()
             for texture in self.textureList:
-                print("  -  "+texture)
-
-        stage.GetRootLayer().Save()
+                log.info("  -  %s", texture)
+
+        with instrumentation.stage('save layer'):
+            layer.Save()
+            for payload_layer in self.payload_layers:
+                payload_layer.Save()
+
+            if layer_file != output_usd_file:
+                # the crate file and payloads only exist to be packed, so
+                # they go whether or not packing worked
+                try:
+                    self.package(layer_file, output_usd_file)
+                finally:
+                    os.remove(layer_file)
+                    for payload_layer in self.payload_layers:
+                        os.remove(payload_layer.realPath)
+                    if self.payload_layers:
+                        try:
+                            os.rmdir(os.path.dirname(self.payload_layers[0].realPath))
+                        except OSError:
+                            pass  # something else is still in there
+        instrumentation.count('save layer', bytes=os.path.getsize(output_usd_file))
 
         # Save specular colors to JSON
-        self.save_specular_colors_to_json(output_usd_file.removesuffix('.usd') +'_speculars.json')
+        self.save_specular_colors_to_json(os.path.splitext(output_usd_file)[0] +'_speculars.json')
     
+    def package(self, layer_file, output_usd_file):
+        # Zips the layer, its payloads and whichever textures are next to it
+        # into a .usdz. Textures are packed under the paths the layers give
+        # them, so nothing needs rewriting. Missing ones are left out and
+        # still resolve next to the .usdz once they're copied there.
+        directory = os.path.dirname(os.path.abspath(layer_file))
+        textures = []
+        missing = []
+        for texture in self.textureList:
+            texture = texture.strip('"')
+            inside = not os.path.isabs(texture) and not os.path.normpath(texture).startswith('..')
+            if inside and os.path.isfile(os.path.join(directory, texture)):
+                textures.append(texture)
+            else:
+                missing.append(texture)
+        if missing:
+            log.warning("These textures weren't found next to %s so aren't packed into it: %s",
+                        output_usd_file, ', '.join(missing))
+
+        # the layer has to come first
+        writer = Sdf.ZipFileWriter.CreateNew(output_usd_file)
+        writer.AddFile(layer_file, os.path.basename(layer_file))
+        for payload_layer in self.payload_layers:
+            writer.AddFile(payload_layer.realPath, os.path.relpath(payload_layer.realPath, directory).replace(os.sep, '/'))
+        for texture in textures:
+            writer.AddFile(os.path.join(directory, texture), os.path.normpath(texture).replace(os.sep, '/'))
+        if not writer.Save():
+            raise ValueError(f"Couldn't package {output_usd_file}")
+
     def save_specular_colors_to_json(self, json_file):
         specular_colors = {material.name: material.specular_color for material in self.materials}
         with open(json_file, 'w') as f:
             json.dump(specular_colors, f, indent=4)
-        print(f"Specular color file created: '{json_file}'")
+        log.info("Specular color file created: '%s'", json_file)
 
     
     def add_to_texture_list(self, filename):
@@ -41,249 +131,378 @@ class USDExporter:
         else:
             self.textureList.append(filename)
 
-    def create_materials(self, stage):
+    def create_materials(self, layer, material_root, materials, texture_folder=''):
         
-        for material in self.materials:
+        for material in materials:
             
-            mat_path = f'/Materials/{material.name}'
-            usd_material = UsdShade.Material.Define(stage, mat_path)
+            mat_path = material_root.AppendChild(material.name)
+            usd_material = define_prim(layer, mat_path, 'Material')
             
             # Creating the shader
-            shader_path = f'{mat_path}/Shader'
-            usd_shader = UsdShade.Shader.Define(stage, shader_path)
-            usd_shader.CreateIdAttr('UsdPreviewSurface')
+            shader_path = mat_path.AppendChild('Shader')
+            usd_shader = define_prim(layer, shader_path, 'Shader')
+            set_attribute(usd_shader, 'info:id', Sdf.ValueTypeNames.Token, 'UsdPreviewSurface', uniform=True)
             
             # Setting shader parameters
-            usd_shader.CreateInput('diffuseColor', Sdf.ValueTypeNames.Float3).Set(Gf.Vec3f(*material.face_color[:3]))
+            diffuse = set_attribute(usd_shader, 'inputs:diffuseColor', Sdf.ValueTypeNames.Float3, Gf.Vec3f(*material.face_color[:3]))
 
-            #usd_shader.CreateInput('specularColor', Sdf.ValueTypeNames.Float3).Set(Gf.Vec3f(*material.specular_color))
-            usd_shader.CreateInput('customSpecularColor', Sdf.ValueTypeNames.Float3).Set(Gf.Vec3f(*material.specular_color))
+            #set_attribute(usd_shader, 'inputs:specularColor', Sdf.ValueTypeNames.Float3, Gf.Vec3f(*material.specular_color))
+            set_attribute(usd_shader, 'inputs:customSpecularColor', Sdf.ValueTypeNames.Float3, Gf.Vec3f(*material.specular_color))
             
-            usd_shader.CreateInput('emissiveColor', Sdf.ValueTypeNames.Float3).Set(Gf.Vec3f(*material.emissive_color))
-            usd_shader.CreateInput('roughness', Sdf.ValueTypeNames.Float).Set(1.0 / material.power)
+            set_attribute(usd_shader, 'inputs:emissiveColor', Sdf.ValueTypeNames.Float3, Gf.Vec3f(*material.emissive_color))
+            set_attribute(usd_shader, 'inputs:roughness', Sdf.ValueTypeNames.Float, 1.0 / material.power if material.power else 0.0)
             
             if material.texture_filename:
-                texture_path = f'{mat_path}/Texture'
-                usd_texture = UsdShade.Shader.Define(stage, texture_path)
-                usd_texture.CreateIdAttr('UsdUVTexture')
-                usd_texture.CreateInput('file', Sdf.ValueTypeNames.Asset).Set(material.texture_filename.strip('"'))
+                texture_path = mat_path.AppendChild('Texture')
+                usd_texture = define_prim(layer, texture_path, 'Shader')
+                set_attribute(usd_texture, 'info:id', Sdf.ValueTypeNames.Token, 'UsdUVTexture', uniform=True)
+                set_attribute(usd_texture, 'inputs:file', Sdf.ValueTypeNames.Asset, Sdf.AssetPath(texture_folder + material.texture_filename.strip('"')))
                 self.add_to_texture_list(material.texture_filename) #just a helper so you know the textures the file uses
-                usd_texture.CreateOutput('rgb', Sdf.ValueTypeNames.Float3)
-                usd_shader.CreateInput('diffuseColor', Sdf.ValueTypeNames.Color3f).ConnectToSource(usd_texture.ConnectableAPI(), 'rgb')
+                set_attribute(usd_texture, 'outputs:rgb', Sdf.ValueTypeNames.Float3)
+                diffuse.connectionPathList.explicitItems = [texture_path.AppendProperty('outputs:rgb')]
 
             # Binding shader to material
-            usd_material.CreateSurfaceOutput().ConnectToSource(usd_shader.ConnectableAPI(), 'surface')
-
-    def process_frames(self, stage, frames, parent):
+            set_attribute(usd_shader, 'outputs:surface', Sdf.ValueTypeNames.Token)
+            surface = set_attribute(usd_material, 'outputs:surface', Sdf.ValueTypeNames.Token)
+            surface.connectionPathList.explicitItems = [shader_path.AppendProperty('outputs:surface')]
+
+    def author_events(self, layer, events):
+        # Writes each material, frame and mesh as the parser hands it over,
+        # keeping only the materials and animations. A frame's transform
+        # comes after it opens, so it's set when the frame ends.
+        xform_paths = [Sdf.Path.absoluteRootPath]
+        for event in events:
+            with instrumentation.stage('build usd'):
+                kind = event[0]
+                if kind == MATERIAL:
+                    self.materials.append(event[1])
+                    self.create_materials(layer, MATERIALS_PATH, [event[1]])
+                elif kind == FRAME_BEGIN:
+                    xform_path = xform_paths[-1].AppendChild(event[1].name)
+                    define_prim(layer, xform_path, 'Xform')
+                    xform_paths.append(xform_path)
+                elif kind == MESH:
+                    self.author_mesh(layer, event[1], xform_paths[-1].AppendChild(event[1].name), MATERIALS_PATH)
+                elif kind == FRAME_END:
+                    set_transform(layer.GetPrimAtPath(xform_paths.pop()), event[1].transform_matrix)
+                elif kind == ANIMATION_SET:
+                    self.animations[event[1]] = event[2]
+            # let the mesh go before the next one is parsed
+            del event
+
+    def process_frames(self, layer, frames, parent_path, material_root, split_children=False):
         for frame in frames:
-            frame_name = frame['name']
-            transform_matrix = frame['transform_matrix']
-            meshes = frame['meshes']
-
-            if parent:
-                xform = UsdGeom.Xform.Define(stage, parent.GetPath().AppendChild(frame_name))
-            else:
-                xform = UsdGeom.Xform.Define(stage, f'/{frame_name}')
+            xform_path = parent_path.AppendChild(frame.name)
+            xform = define_prim(layer, xform_path, 'Xform')
+            set_transform(xform, frame.transform_matrix)
 
-            if transform_matrix:
-                transform_matrix_parts = [x.strip() for x in transform_matrix.split(',')]
-                transform_matrix_parts = list(map(float, transform_matrix_parts))
-                matrix = Gf.Matrix4d(*transform_matrix_parts)
-                xform.AddTransformOp().Set(matrix)
+            for mesh in frame.meshes:
+                self.add_mesh(layer, mesh, xform_path, material_root)
 
+            for child in frame.frames:
+                if split_children and count_faces(child) >= self.payload_faces:
+                    self.add_payload(layer, child, xform_path.AppendChild(child.name))
+                else:
+                    self.process_frames(layer, [child], xform_path, material_root)
+
+    def add_payload(self, layer, frame, xform_path):
+        # The frame goes into a layer of its own, next to the root one, with
+        # a copy of the materials it uses as bindings can't reach outside it
+        root_file = layer.realPath
+        folder = os.path.splitext(os.path.basename(root_file))[0] + '_payloads'
+        asset_path = f"./{folder}/{frame.name}{os.path.splitext(root_file)[1]}"
+        os.makedirs(os.path.join(os.path.dirname(root_file), folder), exist_ok=True)
+        payload_layer = Sdf.Layer.CreateNew(os.path.join(os.path.dirname(root_file), asset_path))
+        self.payload_layers.append(payload_layer)
+
+        payload_root = Sdf.Path.absoluteRootPath.AppendChild(frame.name)
+        used = {name for mesh in iter_meshes([frame]) for name in mesh.materials}
+        material_root = payload_root.AppendChild('Materials')
+        # textures are found relative to the layer, which is a folder down
+        self.create_materials(payload_layer, material_root, [material for material in self.materials if material.name in used], '../')
+        self.process_frames(payload_layer, [frame], Sdf.Path.absoluteRootPath, material_root)
+        payload_layer.defaultPrim = frame.name
+
+        xform = define_prim(layer, xform_path, 'Xform')
+        xform.payloadList.Prepend(Sdf.Payload(asset_path))
+
+    def find_prototypes(self, frames):
+        # Meshes whose geometry, UVs, colours and materials all match share
+        # one prototype. Only meshes of the same size and materials are
+        # hashed to tell them apart.
+        candidates = {}
+        for mesh in iter_meshes(frames):
+            candidates.setdefault(mesh_shape(mesh), []).append(mesh)
+        groups = {}
+        for meshes in candidates.values():
+            if len(meshes) > 1:
+                for mesh in meshes:
+                    groups.setdefault(mesh_key(mesh), []).append(mesh)
+
+        shared = [meshes for meshes in groups.values() if len(meshes) > 1]
+        for meshes in shared:
+            name = meshes[0].name
+            suffix = 1
+            while name in self.prototype_meshes:
+                name = f"{meshes[0].name}_{suffix}"
+                suffix += 1
+            self.prototype_meshes[name] = meshes[0]
             for mesh in meshes:
-                self.add_mesh(stage, mesh, xform)
-
-            self.process_frames(stage, frame['frames'], xform)
-
-    def add_mesh(self, stage, mesh, xform):
-        mesh_name = mesh['name']
-        mesh_path = xform.GetPath().AppendChild(mesh_name)
-        usd_mesh = UsdGeom.Mesh.Define(stage, mesh_path)
-
-        usd_mesh.GetPointsAttr().Set([Gf.Vec3f(*vertex) for vertex in mesh['vertices']])
-        usd_mesh.GetFaceVertexIndicesAttr().Set([index for face in mesh['faces'] for index in face])
-        usd_mesh.GetFaceVertexCountsAttr().Set([len(face) for face in mesh['faces']])
-
-        if mesh['normals']:
-            usd_mesh.GetNormalsAttr().Set([Gf.Vec3f(*normal) for normal in mesh['normals']])
-            usd_mesh.SetNormalsInterpolation('vertex')
+                self.prototypes[id(mesh)] = name
+        if shared:
+            log.info("Instancing %d meshes from %d prototypes", sum(len(meshes) for meshes in shared), len(shared))
+
+    def add_mesh(self, layer, mesh, xform_path, material_root):
+        mesh_path = xform_path.AppendChild(mesh.name)
+        name = self.prototypes.get(id(mesh))
+        if name is None:
+            self.author_mesh(layer, mesh, mesh_path, material_root)
+            return
 
-        if mesh['uvs']:
+        # Prototypes go under an abstract /Prototypes prim, in each layer that uses them
+        prototype_path = PROTOTYPES_PATH.AppendChild(name)
+        if not layer.GetPrimAtPath(prototype_path):
+            Sdf.CreatePrimInLayer(layer, PROTOTYPES_PATH).specifier = Sdf.SpecifierClass
+            self.author_mesh(layer, self.prototype_meshes[name], prototype_path, material_root)
+        usd_mesh = define_prim(layer, mesh_path, 'Mesh')
+        usd_mesh.instanceable = True
+        usd_mesh.referenceList.Prepend(Sdf.Reference(primPath=prototype_path))
+
+    def author_mesh(self, layer, mesh, mesh_path, material_root):
+        usd_mesh = define_prim(layer, mesh_path, 'Mesh')
+
+        # Vt arrays are built straight from the contiguous numpy buffers,
+        # one copy per attribute
+        set_attribute(usd_mesh, 'points', Sdf.ValueTypeNames.Point3fArray, Vt.Vec3fArray.FromNumpy(mesh.vertices))
+        set_attribute(usd_mesh, 'faceVertexIndices', Sdf.ValueTypeNames.IntArray, Vt.IntArray.FromNumpy(mesh.faces.reshape(-1).astype(np.int32)))
+        set_attribute(usd_mesh, 'faceVertexCounts', Sdf.ValueTypeNames.IntArray, Vt.IntArray.FromNumpy(np.full(len(mesh.faces), 3, dtype=np.int32)))
+
+        if len(mesh.normals):
+            if np.array_equal(mesh.normal_faces, mesh.faces):
+                set_attribute(usd_mesh, 'normals', Sdf.ValueTypeNames.Normal3fArray, Vt.Vec3fArray.FromNumpy(mesh.normals), interpolation='vertex')
+            else:
+                # normals numbered apart from the vertices go on each face corner
+                corner_normals = np.ascontiguousarray(mesh.normals[mesh.normal_faces.reshape(-1)])
+                set_attribute(usd_mesh, 'normals', Sdf.ValueTypeNames.Normal3fArray, Vt.Vec3fArray.FromNumpy(corner_normals), interpolation='faceVarying')
 
-            primvar_api = UsdGeom.PrimvarsAPI(usd_mesh.GetPrim())
-            uv_set = primvar_api.CreatePrimvar("st", Sdf.ValueTypeNames.TexCoord2fArray, UsdGeom.Tokens.varying)
+        if len(mesh.uvs):
             #flip UV
             # Adjust UV coordinates to fix vertical mirroring
-            adjusted_uvs = []
-            for uv in mesh['uvs']:
-                u, v = uv
-                adjusted_uv = [u, 1.0 - v]  # Flip V coordinate
-                adjusted_uvs.append(adjusted_uv)
-            uv_set.Set([Gf.Vec2f(*uv) for uv in adjusted_uvs])
-
-        if mesh['colors']:
-            primvar_api = UsdGeom.PrimvarsAPI(usd_mesh.GetPrim())
-            color_set = primvar_api.CreatePrimvar("displayColor", Sdf.ValueTypeNames.Color3fArray,"vertex")
-            color_set.Set([Gf.Vec3f(color[0], color[1], color[2]) for color in mesh['colors']])
-
-        if 'materials' in mesh:
-            if len(mesh['materials']['materials']) > 0:
-                if len(mesh['materials']['material_indices']) == 1:
-                    material_path = f"/Materials/{mesh['materials']['materials'][0]}"
-                    material = UsdShade.Material.Get(stage, material_path)
-                    usd_shader = UsdShade.Shader.Get(stage, f'{material_path}/Shader')
-                    UsdShade.MaterialBindingAPI(usd_mesh).Bind(material)
-                else:
-                    # Group face indices by material index
-                    material_faces = {}
-                    for face_index, material_index in enumerate(mesh['materials']['material_indices']):
-                        if material_index not in material_faces:
-                            material_faces[material_index] = []
-                        material_faces[material_index].append(face_index)
-                    
-                    # Apply materials to face subsets
-                    for material_index, face_indexes in material_faces.items():
-                        if material_index < len(mesh['materials']['materials']):
-                            material_name = mesh['materials']['materials'][material_index]
-                            material_path = f'/Materials/{material_name}'
-                            
-                            # Get or create material and shader
-                            material = UsdShade.Material.Get(stage, material_path)
-                            usd_shader = UsdShade.Shader.Get(stage, f'{material_path}/Shader')
-                            
-                            # Create face subset and bind material
-                            face_subset = UsdGeom.Subset.Define(stage, mesh_path.AppendChild(f'MaterialSubset_{material_index}'))
-                            face_subset.CreateElementTypeAttr(UsdGeom.Tokens.face)
-                            face_subset.CreateIndicesAttr(face_indexes)
-
-                            # Bind material to the subset
-                            subset_binding_api = UsdShade.MaterialBindingAPI(face_subset.GetPrim())
-                            subset_binding_api.Bind(material)
+            adjusted_uvs = mesh.uvs.copy()
+            adjusted_uvs[:, 1] = 1.0 - mesh.uvs[:, 1].astype(np.float64)  # Flip V coordinate
+            set_attribute(usd_mesh, 'primvars:st', Sdf.ValueTypeNames.TexCoord2fArray, Vt.Vec2fArray.FromNumpy(adjusted_uvs), interpolation='varying')
+
+        if len(mesh.colors):
+            set_attribute(usd_mesh, 'primvars:displayColor', Sdf.ValueTypeNames.Color3fArray, Vt.Vec3fArray.FromNumpy(mesh.colors), interpolation='vertex')
+
+        if len(mesh.materials) > 0:
+            if len(mesh.material_indices) == 1:
+                bind_material(usd_mesh, material_root.AppendChild(mesh.materials[0]))
+            else:
+                # Apply materials to face subsets, one per material index in
+                # the order they first appear
+                used_indices, first_faces = np.unique(mesh.material_indices, return_index=True)
+                for material_index in used_indices[np.argsort(first_faces)]:
+                    if material_index < len(mesh.materials):
+                        material_name = mesh.materials[material_index]
+
+                        # Create face subset and bind material
+                        face_indexes = np.flatnonzero(mesh.material_indices == material_index).astype(np.int32)
+                        face_subset = define_prim(layer, mesh_path.AppendChild(f'MaterialSubset_{material_index}'), 'GeomSubset')
+                        set_attribute(face_subset, 'elementType', Sdf.ValueTypeNames.Token, 'face', uniform=True)
+                        set_attribute(face_subset, 'indices', Sdf.ValueTypeNames.IntArray, Vt.IntArray.FromNumpy(face_indexes))
+
+                        # Bind material to the subset
+                        bind_material(face_subset, material_root.AppendChild(material_name))
         else:
-            print(f"{mesh['name']} doesn't have materials")
+            log.info("%s doesn't have materials", mesh.name)
         
-    def add_animation_sets(self, stage, animations):
+    def add_animation_sets(self, layer, animations):
         for anim_set_name, anim_set_data in animations.items():
-            self.create_usd_skeleton(stage, anim_set_name, anim_set_data)
-
-    def create_usd_skeleton(self, stage, anim_set_name, anim_set_data):
-        root_path = f"/{anim_set_name}"
-        skeleton = UsdSkel.Skeleton.Define(stage, root_path + "/Skeleton")
-        bone_names = set()
-
-        for anim_name, anim_list in anim_set_data['animations'].items():
-            for animation in anim_list:
-                bone_names.add(animation.bone_name)
-
-        joints = list(bone_names)
-        skeleton.CreateJointsAttr().Set(joints)
+            self.create_usd_skeleton(layer, anim_set_name, anim_set_data)
+
+    def create_usd_skeleton(self, layer, anim_set_name, anim_set_data):
+        root_path = Sdf.Path(f"/{anim_set_name}")
+        define_prim(layer, root_path, '')
+        skeleton = define_prim(layer, root_path.AppendChild("Skeleton"), 'Skeleton')
+        # joints in the order they first appear, so the output is repeatable
+        joints = list(dict.fromkeys(
+            key.bone_name for keys in anim_set_data['animations'].values() for key in keys
+        ))
+        set_attribute(skeleton, 'joints', Sdf.ValueTypeNames.TokenArray, joints, uniform=True)
 
         # Use identity matrices for the bind transforms and rest transforms
-        transforms = [Gf.Matrix4d(1.0) for _ in joints]
-        skeleton.CreateBindTransformsAttr().Set(transforms)
-        skeleton.CreateRestTransformsAttr().Set(transforms)
+        transforms = Vt.Matrix4dArray([Gf.Matrix4d(1.0) for _ in joints])
+        set_attribute(skeleton, 'bindTransforms', Sdf.ValueTypeNames.Matrix4dArray, transforms, uniform=True)
+        set_attribute(skeleton, 'restTransforms', Sdf.ValueTypeNames.Matrix4dArray, transforms, uniform=True)
 
         # Create the animation and set the joint names
-        anim = UsdSkel.Animation.Define(stage, root_path + "/Anim")
-        anim.CreateJointsAttr().Set(joints)
+        anim_path = root_path.AppendChild("Anim")
+        anim = define_prim(layer, anim_path, 'SkelAnimation')
+        set_attribute(anim, 'joints', Sdf.ValueTypeNames.TokenArray, joints, uniform=True)
 
         # Create a mapping of joint names to indices
         joint_indices = {joint_name: index for index, joint_name in enumerate(joints)}
 
-        # Initialize rotation, scale, and position data
-        rotation_times = set()
-        scale_times = set()
-        position_times = set()
-
-        # Collect keyframes for each joint
-        rotation_keyframes = {joint: [] for joint in joints}
-        scale_keyframes = {joint: [] for joint in joints}
-        position_keyframes = {joint: [] for joint in joints}
-
-        for joint_name in joints:
-            for anim_name, anim_list in anim_set_data['animations'].items():
-                for animation in anim_list:
-                    if animation.bone_name == joint_name:
-                        for keyframe in animation.keyframes:
-                            frame = keyframe.frame
-                            if animation.type == 'Rotation':
-                                rotation_times.add(frame)
-                                rotation_keyframes[joint_name].append((frame, Gf.Quatf(
-                                    keyframe.values[3], keyframe.values[0], keyframe.values[1], keyframe.values[2]
-                                )))
-                            elif animation.type == 'Scale':
-                                scale_times.add(frame)
-                                scale_keyframes[joint_name].append((frame, Gf.Vec3f(
-                                    keyframe.values[0], keyframe.values[1], keyframe.values[2]
-                                )))
-                            elif animation.type == 'Position':
-                                position_times.add(frame)
-                                position_keyframes[joint_name].append((frame, Gf.Vec3f(
-                                    keyframe.values[0], keyframe.values[1], keyframe.values[2]
-                                )))
-
-        # Sort times and keyframes
-        rotation_times = sorted(rotation_times)
-        scale_times = sorted(scale_times)
-        position_times = sorted(position_times)
-
-        # Ensure all joints have values for all time steps
-        def ensure_values_for_all_times(joint_keyframes, times, default_value):
-            values = {time: default_value for time in times}
-            for frame, value in joint_keyframes:
-                values[frame] = value
-            return [values[time] for time in times]
-        
+        # Gather each joint's keys per channel, a joint can have several
+        # AnimationKey blocks of the same type across animations
+        channels = {'Rotation': {}, 'Scale': {}, 'Position': {}}
+        for keys in anim_set_data['animations'].values():
+            for key in keys:
+                if key.type in channels and len(key.frames):
+                    channels[key.type].setdefault(joint_indices[key.bone_name], []).append(key)
+
+        # Each channel becomes a dense (times, joints, dim) array, with the
+        # joints that have no key at a time interpolated from their neighbours
+        # and joints without keys at all left at their rest value. The file's
+        # quaternion values are already in USD's (i, j, k, real) layout.
         end_time = 0
+        channel_attrs = (
+            ('Rotation', 'rotations', Sdf.ValueTypeNames.QuatfArray, Vt.QuatfArray, (0.0, 0.0, 0.0, 1.0), np.float32),
+            ('Scale', 'scales', Sdf.ValueTypeNames.Half3Array, Vt.Vec3hArray, (1.0, 1.0, 1.0), np.float16),
+            ('Position', 'translations', Sdf.ValueTypeNames.Float3Array, Vt.Vec3fArray, (0.0, 0.0, 0.0), np.float32),
+        )
+        for key_type, attr_name, value_type, array_type, rest_value, dtype in channel_attrs:
+            joint_keys = channels[key_type]
+            if not joint_keys:
+                continue
+            times = np.unique(np.concatenate([key.frames for keys in joint_keys.values() for key in keys]))
+            samples = np.empty((len(times), len(joints), len(rest_value)), dtype=np.float32)
+            samples[:] = rest_value
+
+            for joint_index, keys in joint_keys.items():
+                frames, values = merge_keys(keys, len(rest_value))
+                if key_type == 'Rotation':
+                    samples[:, joint_index] = sample_rotations(frames, values, times)
+                else:
+                    samples[:, joint_index] = sample_linear(frames, values, times)
 
-        # Set the rotation values and times
-        for time in rotation_times:
-            rotation_values_per_joint = [
-                ensure_values_for_all_times(rotation_keyframes[joint_name], rotation_times, Gf.Quatf(1.0, 0.0, 0.0, 0.0))
-                for joint_name in joints
-            ]
-            for joint_index, values in enumerate(rotation_values_per_joint):
-                vt_rotation_values = Vt.QuatfArray(values)
-                anim.GetRotationsAttr().Set(vt_rotation_values, time)
-                if time > end_time: end_time = time
-
-        # Set the scale values and times
-        for time in scale_times:
-            scale_values_per_joint = [
-                ensure_values_for_all_times(scale_keyframes[joint_name], scale_times, Gf.Vec3f(1.0, 1.0, 1.0))
-                for joint_name in joints
-            ]
-            for joint_index, values in enumerate(scale_values_per_joint):
-                vt_scale_values = Vt.Vec3fArray(values)
-                anim.GetScalesAttr().Set(vt_scale_values, time)
-                if time > end_time: end_time = time
-
-        # Set the position values and times
-        for time in position_times:
-            position_values_per_joint = [
-                ensure_values_for_all_times(position_keyframes[joint_name], position_times, Gf.Vec3f(0.0, 0.0, 0.0))
-                for joint_name in joints
-            ]
-            for joint_index, values in enumerate(position_values_per_joint):
-                vt_position_values = Vt.Vec3fArray(values)
-                anim.GetTranslationsAttr().Set(vt_position_values, time)
-                if time > end_time: end_time = time
+            samples = samples.astype(dtype)
+            attr = set_attribute(anim, attr_name, value_type)
+            for time, values in zip(times.tolist(), samples):
+                layer.SetTimeSample(attr.path, time, array_type.FromNumpy(values))
+            end_time = max(end_time, int(times[-1]))
 
         # Bind the skeleton to the animation
-        skel_anim_binding = UsdSkel.BindingAPI.Apply(stage.GetPrimAtPath(root_path + "/Skeleton"))
-        skel_anim_binding.CreateAnimationSourceRel().AddTarget(anim.GetPath())
+        apply_schema(skeleton, 'SkelBindingAPI')
+        animation_source = Sdf.RelationshipSpec(skeleton, 'skel:animationSource', custom=False)
+        animation_source.targetPathList.Prepend(anim_path)
 
         # Set animation preview timeline
-        stage.SetStartTimeCode(0)
-        stage.SetEndTimeCode(end_time)
+        layer.startTimeCode = 0
+        layer.endTimeCode = end_time
 
         # Handle play once / loop option
         # for anim_name in anim_set_data['animations']:
         #     play_once_val = anim_set_data['play_once'][anim_name]
         #     if play_once_val:
-        #         anim.GetPrim().SetMetadata("playMode", "playOnce")
+        #         anim.SetInfo("playMode", "playOnce")
         #     else:
-        #         anim.GetPrim().SetMetadata("playMode", "loop")
-
-        return skeleton
\ No newline at end of file
+        #         anim.SetInfo("playMode", "loop")
+
+        return skeleton
+
+# the mesh arrays add_mesh writes out
+MESH_KEY_ARRAYS = ('vertices', 'faces', 'normals', 'uvs', 'colors', 'material_indices')
+
+def iter_meshes(frames):
+    for frame in frames:
+        yield from frame.meshes
+        yield from iter_meshes(frame.frames)
+
+def count_faces(frame):
+    return sum(len(mesh.faces) for mesh in iter_meshes([frame]))
+
+def mesh_shape(mesh):
+    return tuple(len(getattr(mesh, name)) for name in MESH_KEY_ARRAYS) + tuple(mesh.materials)
+
+def mesh_key(mesh):
+    # A digest of everything add_mesh writes apart from the mesh's name
+    digest = hashlib.blake2b(digest_size=20)
+    for name in MESH_KEY_ARRAYS:
+        array = np.ascontiguousarray(getattr(mesh, name))
+        digest.update(f"{name}{array.dtype.str}{array.shape}".encode())
+        digest.update(array.tobytes())
+    digest.update('\0'.join(mesh.materials).encode())
+    return digest.digest()
+
+def define_prim(layer, path, type_name):
+    # Like Usd's Define: a def with the given type, ancestors made as needed
+    prim = Sdf.CreatePrimInLayer(layer, path)
+    prim.specifier = Sdf.SpecifierDef
+    if type_name:
+        prim.typeName = type_name
+    parent = prim.nameParent
+    while parent and parent.path != Sdf.Path.absoluteRootPath and parent.specifier == Sdf.SpecifierOver:
+        parent.specifier = Sdf.SpecifierDef
+        parent = parent.nameParent
+    return prim
+
+def set_attribute(prim, name, value_type, value=None, uniform=False, interpolation=None):
+    # Creates the attribute, or reuses it if the prim was defined twice
+    attr = prim.attributes.get(name)
+    if attr is None:
+        variability = Sdf.VariabilityUniform if uniform else Sdf.VariabilityVarying
+        attr = Sdf.AttributeSpec(prim, name, value_type, variability)
+    if value is not None:
+        attr.default = value
+    if interpolation:
+        attr.SetInfo('interpolation', interpolation)
+    return attr
+
+def set_transform(xform, matrix):
+    if matrix is not None:
+        set_attribute(xform, 'xformOp:transform', Sdf.ValueTypeNames.Matrix4d, Gf.Matrix4d(matrix.tolist()))
+        set_attribute(xform, 'xformOpOrder', Sdf.ValueTypeNames.TokenArray, ['xformOp:transform'], uniform=True)
+
+def bind_material(prim, material_path):
+    binding = prim.relationships.get('material:binding')
+    if binding is None:
+        binding = Sdf.RelationshipSpec(prim, 'material:binding', custom=False)
+    binding.targetPathList.explicitItems = [material_path]
+
+def apply_schema(prim, schema):
+    schemas = prim.GetInfo('apiSchemas')
+    if schema not in schemas.prependedItems:
+        prim.SetInfo('apiSchemas', Sdf.TokenListOp.Create(prependedItems=list(schemas.prependedItems) + [schema]))
+
+def merge_keys(keys, dim):
+    # One sorted run of keys for a joint, a later key wins a repeated frame
+    frames = np.concatenate([key.frames for key in keys])
+    values = np.concatenate([key.values[:, :dim] for key in keys])
+    order = np.argsort(frames, kind='stable')
+    frames, values = frames[order], values[order]
+    last = np.append(frames[1:] != frames[:-1], True)
+    return frames[last], values[last]
+
+def sample_linear(frames, values, times):
+    # Linear interpolation per component, holding the first and last keys
+    return np.stack([np.interp(times, frames, values[:, i]) for i in range(values.shape[1])], axis=-1)
+
+def sample_rotations(frames, values, times):
+    # Spherical interpolation between the keys either side of each time
+    values = values.astype(np.float64)
+    if len(frames) == 1:
+        return np.repeat(values, len(times), axis=0)
+    upper = np.clip(np.searchsorted(frames, times, side='right'), 1, len(frames) - 1)
+    lower = upper - 1
+    span = (frames[upper] - frames[lower]).astype(np.float64)
+    t = np.divide(times - frames[lower], span, out=np.zeros(len(times)), where=span > 0)
+    t = np.clip(t, 0.0, 1.0)[:, None]
+
+    start, end = values[lower], values[upper]
+    # take the short way round
+    dot = np.sum(start * end, axis=1)
+    end = np.where((dot < 0)[:, None], -end, end)
+    dot = np.abs(dot)[:, None]
+
+    angle = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_angle = np.sin(angle)
+    close = sin_angle < 1e-6
+    safe_sin = np.where(close, 1.0, sin_angle)
+    start_weight = np.where(close, 1.0 - t, np.sin((1.0 - t) * angle) / safe_sin)
+    end_weight = np.where(close, t, np.sin(t * angle) / safe_sin)
+    result = start * start_weight + end * end_weight
+
+    length = np.linalg.norm(result, axis=1, keepdims=True)
+    return result / np.where(length > 0, length, 1.0)
@@ -0,0 +1,334 @@
+import json, logging, os, re, shutil, tempfile
+from decimal import Decimal
+import numpy as np
+import instrumentation
+from scene_model import scene_events, MATERIAL, FRAME_BEGIN, MESH, FRAME_END, ANIMATION_SET
+
+log = logging.getLogger(__name__)
+
+# Writes the same .usda USDExporter does, as text, without pxr. The prims,
+# properties and numbers come out byte for byte as pxr's .usda writer lays
+# them out, so it's only a quicker way to the same file. Instancing, payloads
+# and crate files still need USDExporter, and animations are left out as
+# USDExporter leaves them out too.
+#
+# Frames and meshes are written as they're parsed into a spooled body, with
+# /Materials put in front once every material has been seen, as materials
+# can be defined inside meshes.
+
+INDENT = '    '
+# prim names pxr accepts
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*\Z')
+# bodies bigger than this go to a temporary file rather than memory
+SPOOL_BYTES = 1 << 24
+# values formatted per % operation, which bounds the size of the argument tuple
+VALUES_PER_CHUNK = 1 << 18
+# significant digits less one, each float32 is tried at, as a column
+DIGITS = np.arange(9)[:, None]
+# values shortest_float32 rounds at a time, each takes 9 of every temporary
+SHORTEST_CHUNK = 1 << 16
+
+class USDAExporter:
+    def __init__(self, frames, materials, animations):
+        self.frames = frames
+        self.materials = materials
+        self.animations = animations
+        self.textureList = []
+
+        # text for the body not written yet, held while a frame waits on
+        # its transform, and how many frames are waiting
+        self.parts = []
+        self.waiting = 0
+        # [frame, index of its header in parts (None once written), names of its children]
+        self.open_frames = []
+        self.root_names = set()
+
+    def export(self, output_usd_file, events=None):
+        # events is a stream from XFileParser.events(), as for USDExporter
+        if not output_usd_file.endswith('.usda'):
+            raise ValueError(f"{output_usd_file} isn't a .usda file, only USDExporter can write it")
+        if events is None:
+            events = scene_events(self.frames, self.materials, self.animations)
+        self.materials, self.animations = [], {}
+
+        with tempfile.SpooledTemporaryFile(SPOOL_BYTES, 'w+', encoding='utf-8', newline='') as body:
+            with instrumentation.stage('build usd'):
+                for event in events:
+                    with instrumentation.stage('build usd'):
+                        self.add_event(event)
+                        if self.parts and not self.waiting:
+                            body.write(''.join(self.parts))
+                            self.parts.clear()
+                    # let the mesh go before the next one is parsed
+                    del event
+                materials = self.render_materials()
+
+            if len(self.textureList):
+                log.info("Copy the following files into this directory:")
+                self.textureList.sort()
+                for texture in self.textureList:
+                    log.info("  -  %s", texture)
+
+            with instrumentation.stage('save layer'):
+                with open(output_usd_file, 'w', encoding='utf-8', newline='') as file:
+                    file.write("#usda 1.0\n\n")
+                    file.write(materials)
+                    body.seek(0)
+                    shutil.copyfileobj(body, file, 1 << 20)
+        instrumentation.count('save layer', bytes=os.path.getsize(output_usd_file))
+
+        self.save_specular_colors_to_json(os.path.splitext(output_usd_file)[0] +'_speculars.json')
+
+    def save_specular_colors_to_json(self, json_file):
+        specular_colors = {material.name: material.specular_color for material in self.materials}
+        with open(json_file, 'w') as f:
+            json.dump(specular_colors, f, indent=4)
+        log.info("Specular color file created: '%s'", json_file)
+
+    def add_event(self, event):
+        kind = event[0]
+        if kind == MATERIAL:
+            self.materials.append(event[1])
+        elif kind == FRAME_BEGIN:
+            self.add_child(event[1].name)
+            # the header goes in once the transform is known
+            self.parts.append(None)
+            self.waiting += 1
+            self.open_frames.append([event[1], len(self.parts) - 1, set()])
+        elif kind == MESH:
+            self.add_child(event[1].name)
+            self.parts.append(render_mesh(event[1], len(self.open_frames)))
+            if not self.open_frames:
+                self.parts.append("\n")
+        elif kind == FRAME_END:
+            open_frame = self.open_frames[-1]
+            if open_frame[1] is not None:
+                self.write_header(open_frame, len(self.open_frames) - 1, bool(open_frame[2]))
+            self.open_frames.pop()
+            self.parts.append(INDENT * len(self.open_frames) + "}\n")
+            if not self.open_frames:
+                self.parts.append("\n")
+        elif kind == ANIMATION_SET:
+            self.animations[event[1]] = event[2]
+
+    def add_child(self, name):
+        # Starts a prim under the innermost frame, or the root. A frame's
+        # transform usually comes before its children, so its header can go
+        # in with the first of them; if it hasn't turned up by then, the
+        # header waits for the frame's end.
+        check_name(name)
+        names = self.open_frames[-1][2] if self.open_frames else self.root_names
+        if name in names:
+            # pxr would merge the two, text can't hold them both
+            raise ValueError(f"There's more than one {name} in the same frame, convert to .usdc instead")
+        if self.open_frames:
+            parent = self.open_frames[-1]
+            if parent[1] is not None and parent[0].transform_matrix is not None:
+                self.write_header(parent, len(self.open_frames) - 1, True)
+            if names:
+                self.parts.append("\n")
+        names.add(name)
+
+    def write_header(self, open_frame, depth, has_children):
+        frame, index, _ = open_frame
+        indent = INDENT * depth
+        lines = [f'{indent}def Xform "{frame.name}"\n{indent}{{\n']
+        if frame.transform_matrix is not None:
+            lines.append(f"{indent}{INDENT}matrix4d xformOp:transform = {render_matrix(frame.transform_matrix)}\n")
+            lines.append(f'{indent}{INDENT}uniform token[] xformOpOrder = ["xformOp:transform"]\n')
+            if has_children:
+                lines.append("\n")
+        self.parts[index] = ''.join(lines)
+        open_frame[1] = None
+        self.waiting -= 1
+
+    def render_materials(self):
+        # A later material of the same name overwrites the earlier one's
+        # values, as it does in pxr
+        materials = {material.name: material for material in self.materials}
+        if not materials:
+            return ''
+        parts = ['def "Materials"\n{\n']
+        for i, material in enumerate(materials.values()):
+            check_name(material.name)
+            if i:
+                parts.append("\n")
+            parts.append(self.render_material(material))
+        parts.append("}\n\n")
+        return ''.join(parts)
+
+    def render_material(self, material):
+        path = f"/Materials/{material.name}"
+        lines = [
+            f'{INDENT}def Material "{material.name}"\n{INDENT}{{\n',
+            f"{INDENT * 2}token outputs:surface.connect = <{path}/Shader.outputs:surface>\n\n",
+            f'{INDENT * 2}def Shader "Shader"\n{INDENT * 2}{{\n',
+            f'{INDENT * 3}uniform token info:id = "UsdPreviewSurface"\n',
+            f"{INDENT * 3}float3 inputs:customSpecularColor = {render_tuple(material.specular_color)}\n",
+            f"{INDENT * 3}float3 inputs:diffuseColor = {render_tuple(material.face_color[:3])}\n",
+        ]
+        if material.texture_filename:
+            lines.append(f"{INDENT * 3}float3 inputs:diffuseColor.connect = <{path}/Texture.outputs:rgb>\n")
+        lines.append(f"{INDENT * 3}float3 inputs:emissiveColor = {render_tuple(material.emissive_color)}\n")
+        lines.append(f"{INDENT * 3}float inputs:roughness = {render_float(1.0 / material.power if material.power else 0.0)}\n")
+        lines.append(f"{INDENT * 3}token outputs:surface\n{INDENT * 2}}}\n")
+        if material.texture_filename:
+            self.add_to_texture_list(material.texture_filename)
+            lines.append(f'\n{INDENT * 2}def Shader "Texture"\n{INDENT * 2}{{\n')
+            lines.append(f'{INDENT * 3}uniform token info:id = "UsdUVTexture"\n')
+            texture_file = material.texture_filename.strip('"')
+            lines.append(f"{INDENT * 3}asset inputs:file = {render_asset(texture_file)}\n")
+            lines.append(f"{INDENT * 3}float3 outputs:rgb\n{INDENT * 2}}}\n")
+        lines.append(f"{INDENT}}}\n")
+        return ''.join(lines)
+
+    def add_to_texture_list(self, filename):
+        if filename not in self.textureList:
+            self.textureList.append(filename)
+
+def check_name(name):
+    if not isinstance(name, str) or not IDENTIFIER.match(name):
+        raise ValueError(f"{name!r} can't be used as a USD prim name")
+
+def render_mesh(mesh, depth):
+    # The prim USDExporter.author_mesh makes, its properties in the
+    # alphabetical order pxr writes them in
+    indent = INDENT * depth
+    inner = indent + INDENT
+    lines = [f'{indent}def Mesh "{mesh.name}"\n{indent}{{\n']
+    lines.append(f"{inner}int[] faceVertexCounts = [{render_ints(np.full(len(mesh.faces), 3))}]\n")
+    lines.append(f"{inner}int[] faceVertexIndices = [{render_ints(mesh.faces)}]\n")
+
+    subsets = []
+    if len(mesh.materials) > 0:
+        if len(mesh.material_indices) == 1:
+            lines.append(f"{inner}rel material:binding = </Materials/{mesh.materials[0]}>\n")
+        else:
+            used_indices, first_faces = np.unique(mesh.material_indices, return_index=True)
+            for material_index in used_indices[np.argsort(first_faces)]:
+                if material_index < len(mesh.materials):
+                    subsets.append((material_index, mesh.materials[material_index]))
+    else:
+        log.info("%s doesn't have materials", mesh.name)
+
+    normals = mesh.normals
+    interpolation = 'vertex'
+    if len(normals) and not np.array_equal(mesh.normal_faces, mesh.faces):
+        normals, interpolation = normals[mesh.normal_faces.reshape(-1)], 'faceVarying'
+    # V is flipped, as USDExporter does
+    uvs = mesh.uvs.copy()
+    uvs[:, 1] = 1.0 - mesh.uvs[:, 1].astype(np.float64)
+
+    # every float in the mesh is rounded in one go
+    arrays = (mesh.vertices, normals, mesh.colors, uvs)
+    numbers, decimals = shortest_float32(np.concatenate([array.reshape(-1) for array in arrays]))
+    ends = np.cumsum([array.size for array in arrays]).tolist()
+    points, normals, colors, uvs = (render_rows(numbers[end - array.size:end], decimals[end - array.size:end], array.shape[1])
+                                    for array, end in zip(arrays, ends))
+
+    if len(mesh.normals):
+        lines.append(f"{inner}normal3f[] normals = [{normals}] (\n{inner}{INDENT}interpolation = \"{interpolation}\"\n{inner})\n")
+    lines.append(f"{inner}point3f[] points = [{points}]\n")
+    if len(mesh.colors):
+        lines.append(f"{inner}color3f[] primvars:displayColor = [{colors}] (\n{inner}{INDENT}interpolation = \"vertex\"\n{inner})\n")
+    if len(mesh.uvs):
+        lines.append(f"{inner}texCoord2f[] primvars:st = [{uvs}] (\n{inner}{INDENT}interpolation = \"varying\"\n{inner})\n")
+
+    for material_index, material_name in subsets:
+        face_indexes = np.flatnonzero(mesh.material_indices == material_index)
+        lines.append(f'\n{inner}def GeomSubset "MaterialSubset_{material_index}"\n{inner}{{\n')
+        lines.append(f'{inner}{INDENT}uniform token elementType = "face"\n')
+        lines.append(f"{inner}{INDENT}int[] indices = [{render_ints(face_indexes)}]\n")
+        lines.append(f"{inner}{INDENT}rel material:binding = </Materials/{material_name}>\n{inner}}}\n")
+    lines.append(f"{indent}}}\n")
+    return ''.join(lines)
+
+def render_ints(values):
+    return ', '.join(map(str, np.asarray(values).reshape(-1).tolist()))
+
+def render_rows(numbers, decimals, dim):
+    # "(x, y, z), ..." from shortest_float32()'s results, dim to a row.
+    # Numbers are written out to their decimal places with %.*f, apart from
+    # the few pxr gives an exponent.
+    if not len(numbers):
+        return ''
+    args = np.empty(2 * len(numbers), dtype=object)
+    args[0::2] = decimals.tolist()
+    args[1::2] = numbers.tolist()
+    magnitude = np.abs(numbers)
+    exponents = np.flatnonzero((magnitude < 1e-6) & (magnitude != 0) | (magnitude >= 1e15) & np.isfinite(numbers))
+
+    if len(exponents):
+        formats = ['%.*f'] * len(numbers)
+        for i in exponents.tolist():
+            formats[i] = '%s'
+            args[2 * i] = double_text(args[2 * i + 1])
+        args = np.delete(args, 2 * exponents + 1)
+        rows = ('(' + ', '.join(formats[i:i + dim]) + ')' for i in range(0, len(formats), dim))
+        return ', '.join(rows) % tuple(args.tolist())
+
+    row = '(' + ', '.join(['%.*f'] * dim) + ')'
+    rows_per_chunk = max(1, VALUES_PER_CHUNK // dim)
+    parts = []
+    for start in range(0, len(numbers) // dim, rows_per_chunk):
+        chunk = args[2 * dim * start:2 * dim * (start + rows_per_chunk)]
+        parts.append(', '.join([row] * (len(chunk) // (2 * dim))) % tuple(chunk.tolist()))
+    return ', '.join(parts)
+
+def render_tuple(values):
+    return render_rows(*shortest_float32(values), len(values))
+
+def render_float(value):
+    return render_tuple([value])[1:-1]
+
+def render_matrix(matrix):
+    return '( ' + ', '.join('(' + ', '.join(map(double_text, row)) + ')' for row in np.asarray(matrix, dtype=np.float64).tolist()) + ' )'
+
+def double_text(value):
+    # A double as pxr writes it: the shortest digits that read back, in full
+    # from 1e-6 up to 1e15 and with a plain exponent beyond
+    if not np.isfinite(value):
+        return repr(value)
+    number = Decimal(repr(value)).normalize()
+    if -6 <= number.adjusted() < 15:
+        return format(number, 'f')
+    return format(number, 'e').replace('e+', 'e')
+
+def render_asset(path):
+    return f"@@@{path}@@@" if '@' in path else f"@{path}@"
+
+def shortest_float32(values):
+    # Each float32 value as the float64 nearest to the shortest decimal that
+    # reads back as it, and that decimal's places after the point. Every
+    # value is rounded to 1 to 9 significant digits at once and the fewest
+    # that read back are kept; the few too big or small for exact powers of
+    # ten go through numpy one by one.
+    values = np.asarray(values, dtype=np.float32).reshape(-1)
+    x = values.astype(np.float64)
+    result = x.copy()
+    decimals = np.zeros(len(x), dtype=np.int64)
+    magnitude = np.abs(x)
+    rest = [np.flatnonzero(np.isfinite(x) & (x != 0) & ((magnitude < 1e-14) | (magnitude >= 1e22)))]
+    todo = np.flatnonzero((magnitude >= 1e-14) & (magnitude < 1e22))
+    with np.errstate(all='ignore'):
+        for start in range(0, len(todo), SHORTEST_CHUNK):
+            indices = todo[start:start + SHORTEST_CHUNK]
+            subset = x[indices]
+            shift = DIGITS - np.floor(np.log10(np.abs(subset))).astype(np.int64)
+            scale = 10.0 ** np.abs(shift)
+            rounded = np.where(shift >= 0, np.round(subset * scale) / scale, np.round(subset / scale) * scale)
+            reads_back = rounded.astype(np.float32) == values[indices]
+            fewest = reads_back.argmax(axis=0)
+            found = reads_back[fewest, np.arange(len(indices))]
+            result[indices[found]] = rounded[fewest[found], np.flatnonzero(found)]
+            places = np.maximum(shift[fewest[found], np.flatnonzero(found)], 0)
+            # rounding up to the next power of ten leaves a zero on the end
+            mantissas = np.round(np.abs(result[indices[found]]) * 10.0 ** places)
+            places -= (mantissas % 10 == 0) & (places > 0)
+            decimals[indices[found]] = places
+            rest.append(indices[~found])
+    for i in np.concatenate(rest).tolist():
+        text = np.format_float_scientific(values[i], unique=True)
+        result[i] = float(text)
+        decimals[i] = max(0, -Decimal(text).normalize().as_tuple().exponent)
+    return result, decimals
@@ -0,0 +1,40 @@
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Process pools for the parser and the writer. Each conversion normally
+# starts its own pool and shuts it down when it's done. Inside keep_pools(),
+# as in the conversion daemon, a pool is started once for each number of
+# workers and reused by every conversion after, so its processes only pay
+# for starting Python and importing numpy the first time.
+
+# pools by number of workers while keep_pools() is open, None otherwise
+kept_pools = None
+
+@contextlib.contextmanager
+def keep_pools():
+    global kept_pools
+    kept_pools = {}
+    try:
+        yield
+    finally:
+        pools, kept_pools = kept_pools, None
+        for pool in pools.values():
+            pool.shutdown()
+
+@contextlib.contextmanager
+def process_pool(workers):
+    if kept_pools is None:
+        with ProcessPoolExecutor(workers) as pool:
+            yield pool
+        return
+    pool = kept_pools.get(workers)
+    if pool is None:
+        pool = kept_pools[workers] = ProcessPoolExecutor(workers)
+    try:
+        yield pool
+    except BrokenProcessPool:
+        # a worker died, the next conversion starts a new pool
+        kept_pools.pop(workers, None)
+        pool.shutdown(wait=False)
+        raise
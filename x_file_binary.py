@@ -0,0 +1,427 @@
+import re, struct, uuid, zlib
+import numpy as np
+from x_file_tokenizer import decode
+
+# Binary (0303bin) and MSZIP compressed (tzip/bzip) DirectX .x support.
+# XBinaryTokenizer reads the same things as XTokenizer so XFileParser can
+# drive either one; number lists come back as numpy views into the file data.
+
+TOKEN_NAME = 1
+TOKEN_STRING = 2
+TOKEN_INTEGER = 3
+TOKEN_GUID = 5
+TOKEN_INTEGER_LIST = 6
+TOKEN_FLOAT_LIST = 7
+TOKEN_OBRACE = 10
+TOKEN_CBRACE = 11
+TOKEN_COMMA = 19
+TOKEN_SEMICOLON = 20
+TOKEN_TEMPLATE = 31
+
+SYMBOLS = {
+    10: b'{', 11: b'}', 12: b'(', 13: b')', 14: b'[', 15: b']',
+    16: b'<', 17: b'>', 18: b'.', 19: b',', 20: b';',
+}
+KEYWORDS = {
+    TOKEN_TEMPLATE: b'template', 40: b'WORD', 41: b'DWORD', 42: b'FLOAT', 43: b'DOUBLE',
+    44: b'CHAR', 45: b'UCHAR', 46: b'SWORD', 47: b'SDWORD', 48: b'void',
+    49: b'string', 50: b'unicode', 51: b'cstring', 52: b'array',
+}
+SEPARATORS = (b',', b';')
+SYMBOL_IDS = {symbol: token_id for token_id, symbol in SYMBOLS.items()}
+KEYWORD_IDS = {keyword: token_id for token_id, keyword in KEYWORDS.items()}
+# template declarations are written from text, split into these
+DECLARATION_RE = re.compile(r'\w+|[^\s\w]')
+
+class MSZipReader:
+    # File-like reader that inflates the MSZIP blocks of a tzip/bzip file as
+    # they're needed. Each block is raw deflate data that may refer back into
+    # the previous block, so that block is used as the dictionary.
+    def __init__(self, file):
+        self.file = file
+        # uncompressed size of the whole file, including the 16 byte header
+        self.size = struct.unpack('<I', file.read(4))[0]
+        self.history = None
+        self.buffer = b''
+
+    def read_block(self):
+        head = self.file.read(4)
+        if len(head) < 4:
+            return None
+        uncompressed_size, compressed_size = struct.unpack('<HH', head)
+        data = self.file.read(compressed_size)
+        if data[:2] != b'CK':
+            raise ValueError("Unsupported compressed .x format, expected an MSZIP block")
+
+        if self.history:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=self.history)
+        else:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        block = decompressor.decompress(data[2:]) + decompressor.flush()
+        if len(block) != uncompressed_size:
+            raise ValueError(f"Corrupt MSZIP block: expected {uncompressed_size} bytes but got {len(block)}")
+        self.history = block
+        return block
+
+    def read(self, size=-1):
+        blocks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            block = self.read_block()
+            if block is None:
+                break
+            blocks.append(block)
+            length += len(block)
+        data = b''.join(blocks)
+        if size < 0:
+            self.buffer = b''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+# uncompressed bytes in each MSZIP block
+MSZIP_BLOCK_SIZE = 1 << 15
+
+def mszip_compress(data, block_size=MSZIP_BLOCK_SIZE):
+    # The tzip or bzip form of a whole txt or bin .x file. Each block is
+    # compressed with the one before as its dictionary, as MSZipReader
+    # expects.
+    compressed_format = {b'txt ': b'tzip', b'bin ': b'bzip'}[data[8:12]]
+    parts = [data[:8], compressed_format, data[12:16], struct.pack('<I', len(data))]
+    history = None
+    for start in range(16, len(data), block_size):
+        block = data[start:start + block_size]
+        if history:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=history)
+        else:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = b'CK' + compressor.compress(block) + compressor.flush()
+        parts.append(struct.pack('<HH', len(block), len(deflated)) + deflated)
+        history = block
+    return b''.join(parts)
+
+class XBinaryTokenizer:
+    def __init__(self, data, float_size=32):
+        self.data = data
+        self.offset = 0
+        self.float_dtype = np.dtype('<f4') if float_size == 32 else np.dtype('<f8')
+        self.lookahead = None
+        # the integer or float list being read from, and how far into it we are
+        self.numbers = None
+        self.number_pos = 0
+
+    def read_raw_token(self):
+        # Returns a structural token as bytes, a number list as an array, or
+        # None at the end of the data
+        data = self.data
+        if self.offset + 2 > len(data):
+            return None
+        token_id, = struct.unpack_from('<H', data, self.offset)
+        self.offset += 2
+
+        if token_id == TOKEN_NAME:
+            count, = struct.unpack_from('<I', data, self.offset)
+            self.offset += 4 + count
+            return bytes(data[self.offset - count:self.offset])
+        elif token_id == TOKEN_STRING:
+            count, = struct.unpack_from('<I', data, self.offset)
+            self.offset += 4 + count
+            value = bytes(data[self.offset - count:self.offset])
+            self.offset += 2  # the ; or , terminating the string
+            return b'"' + value + b'"'
+        elif token_id == TOKEN_INTEGER:
+            self.offset += 4
+            return np.frombuffer(data, dtype='<u4', count=1, offset=self.offset - 4)
+        elif token_id == TOKEN_INTEGER_LIST or token_id == TOKEN_FLOAT_LIST:
+            count, = struct.unpack_from('<I', data, self.offset)
+            dtype = np.dtype('<u4') if token_id == TOKEN_INTEGER_LIST else self.float_dtype
+            values = np.frombuffer(data, dtype=dtype, count=count, offset=self.offset + 4)
+            self.offset += 4 + count * dtype.itemsize
+            return values
+        elif token_id == TOKEN_GUID:
+            self.offset += 16
+            return b'<guid>'
+        elif token_id in SYMBOLS:
+            return SYMBOLS[token_id]
+        elif token_id in KEYWORDS:
+            return KEYWORDS[token_id]
+        raise ValueError(f"Unknown binary .x token {token_id} at offset {self.offset - 2}")
+
+    def read_item(self):
+        if self.lookahead is not None:
+            token, self.lookahead = self.lookahead, None
+            return token
+        while True:
+            token = self.read_raw_token()
+            if not (isinstance(token, bytes) and token in SEPARATORS):
+                return token
+
+    def peek_token(self):
+        # Any numbers left over in front of the next token are skipped
+        self.numbers = None
+        while True:
+            token = self.read_item()
+            if token is None or isinstance(token, bytes):
+                self.lookahead = token
+                return token
+
+    def next_token(self):
+        token = self.peek_token()
+        if token is None:
+            raise ValueError("Unexpected end of .x file")
+        self.lookahead = None
+        return token
+
+    def take_numbers(self, count):
+        # Returns the next count numbers as a list of array slices
+        parts = []
+        while count:
+            if self.numbers is None or self.number_pos >= len(self.numbers):
+                token = self.read_item()
+                if not isinstance(token, np.ndarray):
+                    raise ValueError(f"Expected {count} more numbers but found {token!r}")
+                self.numbers = token
+                self.number_pos = 0
+            part = self.numbers[self.number_pos:self.number_pos + count]
+            self.number_pos += len(part)
+            count -= len(part)
+            parts.append(part)
+        return parts
+
+    def read_int(self):
+        return int(self.take_numbers(1)[0][0])
+
+    def read_float(self):
+        return float(self.take_numbers(1)[0][0])
+
+    def read_floats(self, count):
+        return [float(value) for part in self.take_numbers(count) for value in part]
+
+    def read_array(self, count, dim, dtype=np.float32):
+        parts = self.take_numbers(count * dim)
+        if len(parts) == 1 and parts[0].dtype == dtype:
+            # a view straight into the file data
+            return parts[0].reshape(count, dim)
+        if not parts:
+            return np.empty((0, dim), dtype=dtype)
+        return np.concatenate([part.astype(dtype) for part in parts]).reshape(count, dim)
+
+    def read_faces(self, count):
+        # Triangle lists normally sit in one integer list: check the vertex
+        # counts of the whole block at once
+        if count == 0:
+            return np.empty((0, 3), dtype=np.uint32)
+        if self.numbers is None or self.number_pos >= len(self.numbers):
+            token = self.read_item()
+            if not isinstance(token, np.ndarray):
+                raise ValueError(f"Expected face data but found {token!r}")
+            self.numbers = token
+            self.number_pos = 0
+        values = self.numbers[self.number_pos:self.number_pos + count * 4]
+        if len(values) == count * 4:
+            block = values.reshape(count, 4)
+            if (block[:, 0] == 3).all():
+                self.number_pos += count * 4
+                return block[:, 1:]
+
+        faces = []
+        for _ in range(count):
+            size = self.read_int()
+            faces.append([int(value) for part in self.take_numbers(size) for value in part])
+        return faces
+
+    def read_keys(self, count):
+        # Each key is an integer list for the frame and dim, then the values
+        if count and self.lookahead is None and (self.numbers is None or self.number_pos >= len(self.numbers)):
+            keys = self.read_key_records(count)
+            if keys is not None:
+                return keys
+
+        frames = np.empty(count, dtype=np.int32)
+        values = np.empty((count, 0), dtype=np.float32)
+        for i in range(count):
+            frames[i] = self.read_int()
+            dim = self.read_int()
+            if i == 0:
+                values = np.empty((count, dim), dtype=np.float32)
+            elif dim != values.shape[1]:
+                raise ValueError("Animation keys of different sizes in one AnimationKey aren't supported")
+            values[i] = np.concatenate(self.take_numbers(dim))
+        return frames, values
+
+    def read_key_records(self, count):
+        # When every key has exactly one [frame, dim] list and one list of
+        # values, they're fixed size records and can be read in one go
+        data = self.data
+        if self.offset + 14 > len(data):
+            return None
+        token_id, list_count, _, dim = struct.unpack_from('<HIII', data, self.offset)
+        if token_id != TOKEN_INTEGER_LIST or list_count != 2:
+            return None
+        record = np.dtype([
+            ('int_token', '<u2'), ('int_count', '<u4'), ('frame', '<u4'), ('dim', '<u4'),
+            ('float_token', '<u2'), ('float_count', '<u4'), ('values', self.float_dtype, (dim,)),
+        ])
+        if self.offset + record.itemsize * count > len(data):
+            return None
+        records = np.frombuffer(data, dtype=record, count=count, offset=self.offset)
+        if not ((records['int_token'] == TOKEN_INTEGER_LIST).all() and (records['int_count'] == 2).all()
+                and (records['dim'] == dim).all() and (records['float_token'] == TOKEN_FLOAT_LIST).all()
+                and (records['float_count'] == dim).all()):
+            return None
+        self.offset += record.itemsize * count
+        return records['frame'].astype(np.int32), records['values'].astype(np.float32)
+
+    def expect(self, expected):
+        token = self.next_token()
+        if token != expected:
+            raise ValueError(f"Expected {expected.decode()} but found {token.decode('shift_jis', errors='ignore')}")
+
+    def read_name(self):
+        return decode(self.next_token())
+
+    def read_string(self):
+        return decode(self.next_token().strip(b'"'))
+
+    def read_block_name(self):
+        token = self.next_token()
+        if token == b'{':
+            return None
+        self.expect(b'{')
+        return decode(token)
+
+    def skip_block(self):
+        depth = 1
+        while depth:
+            token = self.next_token()
+            if token == b'{':
+                depth += 1
+            elif token == b'}':
+                depth -= 1
+
+class XBinaryWriter:
+    # Writes the binary token stream for the blocks USDToXConverter emits
+    def __init__(self, file):
+        self.file = file
+
+    def header(self):
+        self.file.write(b'xof 0303bin 0032')
+
+    def name(self, value):
+        value = value.encode('shift_jis')
+        self.file.write(struct.pack('<HI', TOKEN_NAME, len(value)) + value)
+
+    def open_block(self, keyword, name=None):
+        self.name(keyword)
+        if name:
+            self.name(name)
+        self.file.write(struct.pack('<H', TOKEN_OBRACE))
+
+    def close_block(self):
+        self.file.write(struct.pack('<H', TOKEN_CBRACE))
+
+    def reference(self, name):
+        self.file.write(struct.pack('<H', TOKEN_OBRACE))
+        self.name(name)
+        self.file.write(struct.pack('<H', TOKEN_CBRACE))
+
+    def string(self, value):
+        value = value.encode('shift_jis')
+        self.file.write(struct.pack('<HI', TOKEN_STRING, len(value)) + value + struct.pack('<H', TOKEN_SEMICOLON))
+
+    def ints(self, values):
+        values = np.ascontiguousarray(values, dtype='<u4').reshape(-1)
+        self.file.write(struct.pack('<HI', TOKEN_INTEGER_LIST, len(values)))
+        self.file.write(values.tobytes())
+
+    def floats(self, values):
+        values = np.ascontiguousarray(values, dtype='<f4').reshape(-1)
+        self.file.write(struct.pack('<HI', TOKEN_FLOAT_LIST, len(values)))
+        self.file.write(values.tobytes())
+
+    def faces(self, faces):
+        # nFaces followed by 3;a,b,c for each face, as one integer list
+        data = np.empty((len(faces), 4), dtype='<u4')
+        data[:, 0] = 3
+        data[:, 1:] = faces
+        self.ints(np.concatenate(([len(faces)], data.reshape(-1))))
+
+    def indexed_colors(self, colors):
+        # IndexedColor mixes a DWORD with four floats, so every entry needs
+        # its own integer and float list
+        record = np.dtype([
+            ('int_token', '<u2'), ('int_count', '<u4'), ('index', '<u4'),
+            ('float_token', '<u2'), ('float_count', '<u4'), ('rgba', '<f4', (4,)),
+        ])
+        records = np.zeros(len(colors), dtype=record)
+        records['int_token'] = TOKEN_INTEGER_LIST
+        records['int_count'] = 1
+        records['index'] = np.arange(len(colors))
+        records['float_token'] = TOKEN_FLOAT_LIST
+        records['float_count'] = 4
+        records['rgba'][:, :3] = colors
+        records['rgba'][:, 3] = 1.0
+        self.file.write(records.tobytes())
+
+    def template(self, name, guid, members):
+        # members is the declaration as it reads in a text file, e.g.
+        # "FLOAT x; FLOAT y; FLOAT z;" or "[...]"
+        self.file.write(struct.pack('<H', TOKEN_TEMPLATE))
+        self.open_block(name)
+        self.file.write(struct.pack('<H', TOKEN_GUID) + uuid.UUID(guid).bytes_le)
+        for token in DECLARATION_RE.findall(members):
+            encoded = token.encode()
+            if encoded in KEYWORD_IDS:
+                self.file.write(struct.pack('<H', KEYWORD_IDS[encoded]))
+            elif encoded in SYMBOL_IDS:
+                self.file.write(struct.pack('<H', SYMBOL_IDS[encoded]))
+            elif token.isdigit():
+                self.file.write(struct.pack('<HI', TOKEN_INTEGER, int(token)))
+            else:
+                self.name(token)
+        self.close_block()
+
+    def material(self, material):
+        self.open_block("Material", material.name)
+        self.floats([*material.face_color[:3], 1.0, material.power, *material.specular_color[:3], *material.emissive_color[:3]])
+        if material.texture_filename:
+            self.open_block("TextureFilename")
+            self.string(material.texture_filename)
+            self.close_block()
+        self.close_block()
+
+    def mesh(self, mesh, org_name):
+        self.open_block("Mesh", org_name)
+        self.ints([len(mesh.vertices)])
+        self.floats(mesh.vertices)
+        self.faces(mesh.faces)
+
+        self.open_block("MeshMaterialList")
+        if len(mesh.materials) == 1:
+            self.ints([1, 1, 0])
+        else:
+            self.ints(np.concatenate(([len(mesh.materials), len(mesh.faces)], mesh.material_indices)))
+        for material in mesh.materials:
+            self.reference(material)
+        self.close_block()
+
+        if len(mesh.normals) > 0:
+            self.open_block("MeshNormals")
+            self.ints([len(mesh.normals)])
+            self.floats(mesh.normals)
+            self.faces(mesh.normal_faces)
+            self.close_block()
+
+        if len(mesh.colors):
+            self.open_block("MeshVertexColors")
+            self.ints([len(mesh.colors)])
+            self.indexed_colors(mesh.colors)
+            self.close_block()
+
+        if len(mesh.uvs):
+            self.open_block("MeshTextureCoords")
+            self.ints([len(mesh.uvs)])
+            self.floats(mesh.uvs)
+            self.close_block()
+
+        self.close_block()
@@ -0,0 +1,177 @@
+import hashlib, json, logging, os, tempfile, zipfile
+from collections import defaultdict
+import numpy as np
+from scene_model import Material, Mesh, Frame, AnimationKey
+
+log = logging.getLogger(__name__)
+
+# An on-disk cache of parsed .x files. Entries are keyed by a hash of the file
+# contents and the parser version, and stored as .npz files: the mesh and
+# matrix arrays as they are, plus a JSON header describing how they fit
+# together. Least recently used entries are dropped once the directory goes
+# over its size limit.
+
+DEFAULT_MAX_BYTES = 1 << 30
+MESH_ARRAYS = ('vertices', 'faces', 'normals', 'normal_faces', 'uvs', 'colors', 'material_indices')
+# dtype and row shape of each concatenated array, face indices are narrowed
+# back down per mesh when loading
+ARRAY_KINDS = {
+    'matrices': (np.float64, (4, 4)),
+    'vertices': (np.float32, (3,)),
+    'faces': (np.uint32, (3,)),
+    'normals': (np.float32, (3,)),
+    'normal_faces': (np.uint32, (3,)),
+    'uvs': (np.float32, (2,)),
+    'colors': (np.float32, (3,)),
+    'material_indices': (np.uint16, ()),
+    'key_frames': (np.int32, ()),
+    'key_values': (np.float32, ()),
+}
+
+class XFileCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, filename, version):
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{version}\0".encode())
+        with open(filename, 'rb') as file:
+            while chunk := file.read(1 << 20):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        # Returns (frames, materials, animations), or None on a miss
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                header = json.loads(data['header'].tobytes())
+                arrays = {name: data[name] for name in data.files if name != 'header'}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            if os.path.exists(path):
+                log.warning("Ignoring unreadable cache entry %s: %s", path, e)
+            return None
+
+        # touching the entry marks it as recently used
+        os.utime(path)
+        materials = [unpack_material(material) for material in header['materials']]
+        reader = ArrayReader(arrays)
+        frames = [unpack_frame(frame, reader) for frame in header['frames']]
+        animations = unpack_animations(header['animations'], reader)
+        return frames, materials, animations
+
+    def store(self, key, frames, materials, animations):
+        # Every array of a kind goes into one concatenated array, as an npz
+        # member costs far more to open than to read
+        parts = {name: [] for name in ARRAY_KINDS}
+        header = {
+            'materials': [pack_material(material) for material in materials],
+            'frames': [pack_frame(frame, parts) for frame in frames],
+            'animations': pack_animations(animations, parts),
+        }
+        arrays = {name: concatenate(values, ARRAY_KINDS[name]) for name, values in parts.items()}
+        arrays['header'] = np.frombuffer(json.dumps(header).encode(), dtype=np.uint8)
+
+        # written to a temporary file first so a reader never sees half an entry
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                np.savez(file, **arrays)
+            os.replace(temp_path, self.path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def pack_material(material):
+    return {name: getattr(material, name) for name in Material.__slots__}
+
+def unpack_material(packed):
+    # colours go back to tuples, as the parser makes them
+    return Material(**{name: tuple(value) if isinstance(value, list) else value for name, value in packed.items()})
+
+def concatenate(values, shape):
+    dtype, dim = shape
+    if not values:
+        return np.empty((0,) + dim, dtype=dtype)
+    return np.concatenate([np.asarray(value, dtype=dtype).reshape((-1,) + dim) for value in values])
+
+def pack_frame(frame, parts):
+    # The header keeps how many rows each array had, in the order written
+    packed = {'name': frame.name, 'matrix': frame.transform_matrix is not None, 'meshes': [], 'frames': []}
+    if packed['matrix']:
+        parts['matrices'].append(frame.transform_matrix)
+    for mesh in frame.meshes:
+        counts = {}
+        for name in MESH_ARRAYS:
+            value = getattr(mesh, name)
+            parts[name].append(value)
+            counts[name] = len(value)
+        packed['meshes'].append({'name': mesh.name, 'materials': mesh.materials, 'counts': counts})
+    packed['frames'] = [pack_frame(child, parts) for child in frame.frames]
+    return packed
+
+class ArrayReader:
+    # Hands out consecutive slices of the concatenated arrays
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.offsets = dict.fromkeys(arrays, 0)
+
+    def take(self, name, count):
+        offset = self.offsets[name]
+        self.offsets[name] = offset + count
+        return self.arrays[name][offset:offset + count]
+
+def unpack_frame(packed, reader):
+    matrix = reader.take('matrices', 1)[0] if packed['matrix'] else None
+    frame = Frame(packed['name'], matrix)
+    for mesh in packed['meshes']:
+        values = {name: reader.take(name, count) for name, count in mesh['counts'].items()}
+        frame.meshes.append(Mesh(mesh['name'], materials=mesh['materials'], **values))
+    frame.frames = [unpack_frame(child, reader) for child in packed['frames']]
+    return frame
+
+def pack_animations(animations, parts):
+    packed = {}
+    for set_name, animation_set in animations.items():
+        packed_set = packed[set_name] = {'play_once': animation_set['play_once'], 'animations': {}}
+        for name, keys in animation_set['animations'].items():
+            packed_set['animations'][name] = [[key.type, key.bone_name, len(key.frames), key.values.shape[1]] for key in keys]
+            for key in keys:
+                parts['key_frames'].append(key.frames)
+                parts['key_values'].append(key.values)
+    return packed
+
+def unpack_animations(packed, reader):
+    animations = {}
+    for set_name, animation_set in packed.items():
+        keys = defaultdict(list)
+        for name, entries in animation_set['animations'].items():
+            keys[name] = []
+            for key_type, bone_name, count, dim in entries:
+                frames = reader.take('key_frames', count)
+                values = reader.take('key_values', count * dim).reshape(count, dim)
+                keys[name].append(AnimationKey(key_type, bone_name, frames, values))
+        animations[set_name] = {'animations': keys, 'play_once': animation_set['play_once']}
+    return animations
@@ -0,0 +1,272 @@
+import numpy as np
+from scene_model import Material, Mesh, Frame, AnimationKey
+from x_file_binary import XBinaryWriter, mszip_compress
+from x_file_text import format_rows, render_materials, render_mesh, render_transform
+
+# Makes Recettear-style .x files of any size, for benchmarks and round trip
+# checks. Scenes come from a seeded random generator, so the same settings
+# always make the same file. Like the game's files, every frame's contents
+# sit at the frame's own indent, other than those of the non-colliding
+# frames, which are indented one further.
+
+# Recettear's Frame_World flips the whole scene
+WORLD_MATRIX = np.diag([-1.0, -1.0, -1.0, 1.0])
+# AnimationKey type numbers and the values each key holds
+KEY_TYPES = ((0, 'Rotation', 4), (1, 'Scale', 3), (2, 'Position', 3))
+# the template declarations exporters put at the top of a file, as
+# (name, guid, members)
+TEMPLATES = (
+    ('Header', '3D82AB43-62DA-11cf-AB39-0020AF71E433', ('WORD major;', 'WORD minor;', 'DWORD flags;')),
+    ('Vector', '3D82AB5E-62DA-11cf-AB39-0020AF71E433', ('FLOAT x;', 'FLOAT y;', 'FLOAT z;')),
+    ('Coords2d', 'F6F23F44-7686-11cf-8F52-0040333594A3', ('FLOAT u;', 'FLOAT v;')),
+    ('Matrix4x4', 'F6F23F45-7686-11cf-8F52-0040333594A3', ('array FLOAT matrix[16];',)),
+    ('ColorRGBA', '35FF44E0-6C7C-11cf-8F52-0040333594A3', ('FLOAT red;', 'FLOAT green;', 'FLOAT blue;', 'FLOAT alpha;')),
+    ('ColorRGB', 'D3E16E81-7835-11cf-8F52-0040333594A3', ('FLOAT red;', 'FLOAT green;', 'FLOAT blue;')),
+    ('TextureFilename', 'A42790E1-7810-11cf-8F52-0040333594A3', ('STRING filename;',)),
+    ('Material', '3D82AB4D-62DA-11cf-AB39-0020AF71E433', ('ColorRGBA faceColor;', 'FLOAT power;', 'ColorRGB specularColor;', 'ColorRGB emissiveColor;', '[...]')),
+    ('MeshFace', '3D82AB5F-62DA-11cf-AB39-0020AF71E433', ('DWORD nFaceVertexIndices;', 'array DWORD faceVertexIndices[nFaceVertexIndices];')),
+    ('Mesh', '3D82AB44-62DA-11cf-AB39-0020AF71E433', ('DWORD nVertices;', 'array Vector vertices[nVertices];', 'DWORD nFaces;', 'array MeshFace faces[nFaces];', '[...]')),
+    ('FrameTransformMatrix', 'F6F23F41-7686-11cf-8F52-0040333594A3', ('Matrix4x4 frameMatrix;',)),
+    ('Frame', '3D82AB46-62DA-11cf-AB39-0020AF71E433', ('[...]',)),
+)
+
+def generate_scene(seed=0, materials=8, textures=True, depth=2, children=3, meshes_per_frame=1,
+                   vertices=200, faces=None, colors=True, materials_per_mesh=2, animation_sets=0,
+                   animated_frames=4, keys=30):
+    # Returns the frames, materials and animations of a scene, as
+    # XFileParser would read them. Each frame has `children` child frames
+    # down to `depth` levels under Frame_World, and `meshes_per_frame`
+    # grid meshes of about `vertices` vertices. Meshes use up to
+    # `materials_per_mesh` of the materials, in runs of faces.
+    rng = np.random.default_rng(seed)
+
+    material_list = []
+    for i in range(materials):
+        texture = f"tex_{i:03d}.bmp" if textures and i % 4 != 3 else None
+        face_color = tuple(np.round(rng.uniform(0.2, 1.0, 3), 6).tolist()) + (1.0,)
+        material_list.append(Material(f"Material_{i:03d}", face_color, float(rng.integers(1, 50)),
+                                      (0.0, 0.0, 0.0), tuple(np.round(rng.uniform(0.0, 0.3, 3), 6).tolist()), texture))
+    material_names = [material.name for material in material_list]
+
+    def make_frame(name, level):
+        frame = Frame(name, make_transform(rng) if level else WORLD_MATRIX.copy())
+        short_name = name.removeprefix('Frame_')
+        if level:
+            for i in range(meshes_per_frame):
+                mesh_name = short_name if i == 0 else f"{short_name}_{i}"
+                frame.meshes.append(make_mesh(rng, mesh_name, vertices, faces, colors, material_names, materials_per_mesh))
+        if level < depth:
+            for i in range(children):
+                frame.frames.append(make_frame(f"Frame_Obj{i}" if level == 0 else f"{name}_{i}", level + 1))
+        return frame
+
+    frames = [make_frame('Frame_World', 0)]
+
+    animations = {}
+    animated = [frame.name for frame in iter_frames(frames[0].frames)][:animated_frames]
+    for set_index in range(animation_sets):
+        animation_set = {'animations': {}, 'play_once': {}}
+        for bone_index, bone_name in enumerate(animated):
+            animation_name = f"Anim_{set_index}_{bone_index}"
+            animation_set['animations'][animation_name] = make_keys(rng, bone_name, keys)
+            animation_set['play_once'][animation_name] = bool(set_index % 2)
+        animations[f"AnimationSet_{set_index}"] = animation_set
+
+    return frames, material_list, animations
+
+def make_transform(rng):
+    # A rotation about Y with a translation, row-major like FrameTransformMatrix
+    angle = rng.uniform(-np.pi, np.pi)
+    matrix = np.identity(4)
+    matrix[0, 0] = matrix[2, 2] = np.cos(angle)
+    matrix[0, 2] = -np.sin(angle)
+    matrix[2, 0] = np.sin(angle)
+    matrix[3, :3] = rng.uniform(-50.0, 50.0, 3)
+    return np.round(matrix, 6)
+
+def make_mesh(rng, name, vertices, faces, colors, material_names, materials_per_mesh):
+    # A bumpy grid, two triangles to each square, with per-vertex normals,
+    # UVs and colours. Values are rounded to the 6 places .x text keeps.
+    width = max(2, int(np.sqrt(vertices)))
+    height = max(2, vertices // width)
+    u, v = np.meshgrid(np.linspace(0.0, 1.0, width), np.linspace(0.0, 1.0, height))
+    positions = np.column_stack((u.ravel() * 10.0, rng.uniform(-0.5, 0.5, width * height), v.ravel() * 10.0))
+    normals = rng.normal(size=(width * height, 3)) * 0.2 + (0.0, 1.0, 0.0)
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+
+    corner = (np.arange(height - 1)[:, None] * width + np.arange(width - 1)).ravel()
+    triangles = np.concatenate((
+        np.column_stack((corner, corner + width, corner + 1)),
+        np.column_stack((corner + 1, corner + width, corner + width + 1)),
+    ))
+    triangles = triangles[rng.permutation(len(triangles))[:faces]]
+
+    used = rng.choice(len(material_names), min(materials_per_mesh, len(material_names)), replace=False)
+    materials = [material_names[i] for i in used]
+    if len(materials) == 1:
+        material_indices = [0]
+    else:
+        material_indices = np.sort(rng.integers(0, len(materials), len(triangles)))
+
+    return Mesh(name, np.round(positions, 6), triangles, np.round(normals, 6), triangles,
+                np.column_stack((u.ravel(), v.ravel())).round(6),
+                rng.uniform(0.3, 1.0, (width * height, 3)).round(6) if colors else None,
+                material_indices, materials)
+
+def make_keys(rng, bone_name, keys):
+    frames = np.sort(rng.choice(np.arange(keys * 4), keys, replace=False))
+    rotations = rng.normal(size=(keys, 4))
+    rotations /= np.linalg.norm(rotations, axis=1, keepdims=True)
+    return [
+        AnimationKey('Rotation', bone_name, frames, rotations.round(6)),
+        AnimationKey('Scale', bone_name, frames, rng.uniform(0.5, 1.5, (keys, 3)).round(6)),
+        AnimationKey('Position', bone_name, frames, rng.uniform(-10.0, 10.0, (keys, 3)).round(6)),
+    ]
+
+def iter_frames(frames):
+    for frame in frames:
+        yield frame
+        yield from iter_frames(frame.frames)
+
+def write_scene(filename, frames, materials, animations, binary=False, non_colliding=(), templates=False, compressed=False):
+    # Writes the scene as a text .x file, or a binary one. Frames named in
+    # non_colliding get their contents indented, as the writer does for
+    # frames with collision off in _frames.json. With templates, the file
+    # starts with the standard template declarations like most exporters'.
+    # compressed writes it MSZIP compressed, as tzip or bzip.
+    write_uncompressed_scene(filename, frames, materials, animations, binary, non_colliding, templates)
+    if compressed:
+        with open(filename, 'rb') as file:
+            data = file.read()
+        with open(filename, 'wb') as file:
+            file.write(mszip_compress(data))
+
+def write_uncompressed_scene(filename, frames, materials, animations, binary, non_colliding, templates):
+    if binary:
+        with open(filename, 'wb') as file:
+            writer = XBinaryWriter(file)
+            writer.header()
+            if templates:
+                for name, guid, members in TEMPLATES:
+                    writer.template(name, guid, ' '.join(members))
+            writer.open_block("Header")
+            writer.ints([1, 0, 1])
+            writer.close_block()
+            for material in materials:
+                writer.material(material)
+            for frame in frames:
+                write_binary_frame(writer, frame)
+            for name, animation_set in animations.items():
+                write_binary_animation_set(writer, name, animation_set)
+        return
+
+    with open(filename, 'w', encoding='shift_jis') as file:
+        file.write("xof 0303txt 0032\n\n")
+        if templates:
+            file.write(render_templates())
+        file.write("Header {\n\t1; 0; 1;\n}\n\n")
+        file.write(render_materials(materials))
+        for frame in frames:
+            write_frame(file, frame, 0, set(non_colliding))
+        for name, animation_set in animations.items():
+            file.write(render_animation_set(name, animation_set))
+
+def render_templates():
+    parts = []
+    for name, guid, members in TEMPLATES:
+        parts.append(f"template {name} {{\n <{guid}>\n")
+        parts.extend(f" {member}\n" for member in members)
+        parts.append("}\n\n")
+    return ''.join(parts)
+
+def write_frame(file, frame, indent, non_colliding):
+    indent_str = '\t' * indent
+    file.write(f"{indent_str}Frame {frame.name} {{\n")
+    if frame.transform_matrix is not None:
+        file.write(render_transform(frame.transform_matrix, indent))
+    if frame.name in non_colliding:
+        indent += 1
+    for mesh in frame.meshes:
+        file.write(render_mesh(mesh, mesh.name, indent))
+    for child in frame.frames:
+        write_frame(file, child, indent, non_colliding)
+    file.write(f"{indent_str}}}\n\n")
+
+def write_binary_frame(writer, frame):
+    writer.open_block("Frame", frame.name)
+    if frame.transform_matrix is not None:
+        writer.open_block("FrameTransformMatrix")
+        writer.floats(frame.transform_matrix)
+        writer.close_block()
+    for mesh in frame.meshes:
+        writer.mesh(mesh, mesh.name)
+    for child in frame.frames:
+        write_binary_frame(writer, child)
+    writer.close_block()
+
+def key_type_number(key_type):
+    return next(number for number, name, _ in KEY_TYPES if name == key_type)
+
+def render_animation_set(name, animation_set):
+    parts = [f"AnimationSet {name} {{\n"]
+    for animation_name, keys in animation_set['animations'].items():
+        parts.append(f"\tAnimation {animation_name} {{\n\t\t{{{keys[0].bone_name}}}\n")
+        play_once = animation_set['play_once'].get(animation_name)
+        if play_once is not None:
+            parts.append(f"\t\tAnimationOptions {{\n\t\t\t{0 if play_once else 1};\n\t\t\t0;\n\t\t}}\n")
+        for key in keys:
+            dim = key.values.shape[1]
+            parts.append(f"\t\tAnimationKey {{\n\t\t\t{key_type_number(key.type)};\n\t\t\t{len(key.frames)};\n")
+            row = "\t\t\t%d;" + str(dim) + ";" + ",".join(["%.6f"] * dim)
+            parts.append(format_rows(np.column_stack((key.frames, key.values)), row + ";;,\n", row + ";;;\n"))
+            parts.append("\t\t}\n")
+        parts.append("\t}\n")
+    parts.append("}\n\n")
+    return ''.join(parts)
+
+def write_binary_animation_set(writer, name, animation_set):
+    writer.open_block("AnimationSet", name)
+    for animation_name, keys in animation_set['animations'].items():
+        writer.open_block("Animation", animation_name)
+        writer.reference(keys[0].bone_name)
+        play_once = animation_set['play_once'].get(animation_name)
+        if play_once is not None:
+            writer.open_block("AnimationOptions")
+            writer.ints([0 if play_once else 1, 0])
+            writer.close_block()
+        for key in keys:
+            writer.open_block("AnimationKey")
+            writer.ints([key_type_number(key.type), len(key.frames)])
+            for frame, values in zip(key.frames.tolist(), key.values):
+                writer.ints([frame, len(values)])
+                writer.floats(values)
+            writer.close_block()
+        writer.close_block()
+    writer.close_block()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a synthetic Recettear-style .x file")
+    parser.add_argument('output', help="the .x file to write")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--materials', type=int, default=8, help="materials in the file")
+    parser.add_argument('--no-textures', dest='textures', action='store_false', help="no TextureFilename blocks")
+    parser.add_argument('--depth', type=int, default=2, help="levels of frames under Frame_World")
+    parser.add_argument('--children', type=int, default=3, help="child frames per frame")
+    parser.add_argument('--meshes', type=int, default=1, help="meshes per frame")
+    parser.add_argument('--vertices', type=int, default=200, help="vertices per mesh")
+    parser.add_argument('--faces', type=int, help="faces per mesh, at most about twice the vertices")
+    parser.add_argument('--no-colors', dest='colors', action='store_false', help="no MeshVertexColors blocks")
+    parser.add_argument('--mesh-materials', type=int, default=2, help="materials per mesh")
+    parser.add_argument('--animation-sets', type=int, default=0)
+    parser.add_argument('--keys', type=int, default=30, help="keys per AnimationKey")
+    parser.add_argument('--binary', action='store_true', help="write a binary .x file")
+    parser.add_argument('--non-colliding', nargs='*', default=[], metavar='FRAME', help="frames to indent as non-colliding")
+    parser.add_argument('--templates', action='store_true', help="start the file with the standard template declarations")
+    parser.add_argument('--compressed', action='store_true', help="MSZIP compress the file (tzip, or bzip with --binary)")
+    args = parser.parse_args()
+
+    frames, materials, animations = generate_scene(
+        args.seed, args.materials, args.textures, args.depth, args.children, args.meshes, args.vertices,
+        args.faces, args.colors, args.mesh_materials, args.animation_sets, keys=args.keys)
+    write_scene(args.output, frames, materials, animations, args.binary, args.non_colliding, args.templates, args.compressed)
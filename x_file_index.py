@@ -0,0 +1,153 @@
+import struct
+import numpy as np
+from x_file_tokenizer import decode
+from x_file_binary import TOKEN_NAME, TOKEN_STRING, TOKEN_INTEGER, TOKEN_GUID, TOKEN_INTEGER_LIST, TOKEN_FLOAT_LIST, TOKEN_OBRACE, TOKEN_CBRACE, TOKEN_TEMPLATE
+
+# A structural pre-pass over a .x file that records where the blocks we care
+# about start and end, without decoding any of their numbers.
+
+INDEXED_BLOCKS = (b'Frame', b'Mesh', b'MeshMaterialList', b'AnimationSet', b'Material')
+
+# bytes the text scan has to look at: braces, and the starts of strings and comments
+SPECIAL_BYTES = np.zeros(256, dtype=bool)
+SPECIAL_BYTES[list(b'{}"/#')] = True
+
+class XBlock:
+    __slots__ = ('kind', 'name', 'offset', 'length', 'children')
+
+    def __init__(self, kind, name, offset):
+        self.kind = kind
+        self.name = name
+        # from the block's keyword up to and including its closing brace
+        self.offset = offset
+        self.length = 0
+        self.children = []
+
+    @property
+    def label(self):
+        return self.name if self.name else self.kind
+
+    def __repr__(self):
+        return f"XBlock({self.kind} {self.name or ''} @{self.offset}+{self.length})"
+
+def scan_text(data, start=0):
+    # Yields ('{', offset, keyword, name) for each opening brace, where offset
+    # is the start of the block's keyword, and ('}', end) for each closing one
+    values = np.frombuffer(data, dtype=np.uint8)
+    positions = np.flatnonzero(SPECIAL_BYTES[values[start:]]) + start
+    del values
+
+    skip_until = 0
+    header_start = start
+    for pos in positions.tolist():
+        if pos < skip_until:
+            continue
+        char = data[pos]
+        if char == 0x7b:  # {
+            keyword, name, offset = block_header(data, header_start, pos)
+            yield b'{', offset, keyword, name
+            header_start = pos + 1
+        elif char == 0x7d:  # }
+            yield b'}', pos + 1
+            header_start = pos + 1
+        elif char == 0x22:  # "
+            skip_until = data.find(b'"', pos + 1) + 1
+            header_start = skip_until
+        elif char == 0x23 or data[pos + 1:pos + 2] == b'/':
+            skip_until = data.find(b'\n', pos)
+            if skip_until < 0:
+                skip_until = len(data)
+            header_start = skip_until
+
+# how far back from a brace to look for the block's keyword and name
+HEADER_WINDOW = 128
+
+def block_header(data, start, pos):
+    # The keyword and optional name are the last identifiers before the brace.
+    # Only the tail of the gap is looked at, as it can hold a whole vertex
+    # list. Strings and braces never get in here, the scan stops at those.
+    cut = start < pos - HEADER_WINDOW
+    window = data[pos - HEADER_WINDOW if cut else start:pos]
+    tokens = window.replace(b';', b' ').replace(b',', b' ').split()
+    if cut and tokens and not window[:1].isspace():
+        # the first token may have been cut in half
+        tokens = tokens[1:]
+    if len(tokens) >= 2 and is_identifier(tokens[-2]):
+        return tokens[-2], tokens[-1], pos - len(window) + window.rfind(tokens[-2], 0, window.rfind(tokens[-1]))
+    if tokens and is_identifier(tokens[-1]):
+        return tokens[-1], None, pos - len(window) + window.rfind(tokens[-1])
+    return None, None, pos
+
+def is_identifier(token):
+    return token[:1].isalpha() or token[:1] == b'_'
+
+def scan_binary(data, start=0, float_size=32):
+    offset = start
+    names = []
+    end = len(data)
+    while offset + 2 <= end:
+        token_start = offset
+        token_id, = struct.unpack_from('<H', data, offset)
+        offset += 2
+        if token_id == TOKEN_NAME:
+            count, = struct.unpack_from('<I', data, offset)
+            names.append((bytes(data[offset + 4:offset + 4 + count]), token_start))
+            offset += 4 + count
+            continue
+        elif token_id == TOKEN_TEMPLATE:
+            # template Frame { is a declaration, keyed as it is in text files
+            names = [(b'template', token_start)]
+            continue
+        elif token_id == TOKEN_OBRACE:
+            if len(names) >= 2:
+                yield b'{', names[-2][1], names[-2][0], names[-1][0]
+            elif names:
+                yield b'{', names[-1][1], names[-1][0], None
+            else:
+                yield b'{', token_start, None, None
+        elif token_id == TOKEN_CBRACE:
+            yield b'}', offset
+        elif token_id == TOKEN_STRING:
+            count, = struct.unpack_from('<I', data, offset)
+            offset += 4 + count + 2
+        elif token_id == TOKEN_INTEGER:
+            offset += 4
+        elif token_id == TOKEN_INTEGER_LIST:
+            count, = struct.unpack_from('<I', data, offset)
+            offset += 4 + count * 4
+        elif token_id == TOKEN_FLOAT_LIST:
+            count, = struct.unpack_from('<I', data, offset)
+            offset += 4 + count * (float_size // 8)
+        elif token_id == TOKEN_GUID:
+            offset += 16
+        names = []
+
+def build_index(events):
+    # Turns the scan events into a tree of the indexed blocks
+    roots = []
+    stack = []
+    for event in events:
+        if event[0] == b'{':
+            _, offset, keyword, name = event
+            block = None
+            if keyword in INDEXED_BLOCKS:
+                block = XBlock(decode(keyword), decode(name) if name else None, offset)
+                parent = next((open_block for open_block in reversed(stack) if open_block), None)
+                (parent.children if parent else roots).append(block)
+            stack.append(block)
+        elif stack:
+            block = stack.pop()
+            if block:
+                block.length = event[1] - block.offset
+    return roots
+
+def index_paths(blocks, prefix='', paths=None):
+    # Maps 'Frame_World/Frame_Table/Table' style paths to their blocks, the
+    # first block wins if two share a path
+    if paths is None:
+        paths = {}
+    for block in blocks:
+        path = prefix + block.label
+        paths.setdefault(path, block)
+        index_paths(block.children, path + '/', paths)
+    return paths
@@ -1,378 +1,463 @@
-import re, json
-from collections import namedtuple, defaultdict
-
-print_debug = False
-print_anim_debug = False
-Material = namedtuple('Material', ['name', 'face_color', 'power', 'specular_color', 'emissive_color', 'texture_filename'])
-Keyframe = namedtuple('Keyframe', ['frame', 'dim', 'values'])
-Animation = namedtuple('Animation', ['type', 'bone_name', 'keyframes'])
+import io, json, logging, mmap, os, struct
+from collections import defaultdict
+from multiprocessing import shared_memory
+import numpy as np
+from x_file_tokenizer import XTokenizer
+from x_file_binary import XBinaryTokenizer, MSZipReader, TOKEN_NAME, TOKEN_OBRACE, TOKEN_CBRACE
+from x_file_index import scan_text, scan_binary, build_index, index_paths
+from x_file_cache import XFileCache
+from scene_model import Material, Mesh, Frame, AnimationKey, triangulate, build_scene, scene_events, MATERIAL, FRAME_BEGIN, MESH, FRAME_END, ANIMATION_SET
+import instrumentation
+import worker_pools
+
+log = logging.getLogger(__name__)
+# animation keys are logged on their own, there are a lot of them
+anim_log = logging.getLogger(__name__ + '.animation')
+ANIMATION_KEY_TYPES = {0: 'Rotation', 1: 'Scale', 2: 'Position', 3: 'Matrix', 4: 'Matrix'}
+# bump whenever what parse() produces changes, so cached results are rebuilt
+PARSER_VERSION = 2
+# files smaller than this parse quicker on their own than a pool takes to start
+PARALLEL_MIN_BYTES = 1 << 23
+# mesh data handed to a pool process at a time, small meshes go in batches
+MESH_BATCH_BYTES = 1 << 20
 
 class XFileParser:
-    def __init__(self, filename):
+    def __init__(self, filename, cache=None, workers=1):
         self.filename = filename
+        # an optional XFileCache, or a directory to keep one in
+        self.cache = XFileCache(cache) if isinstance(cache, str) else cache
+        self.workers = workers or os.cpu_count() or 1
         self.frames = []
         self.materials = []
         self.animations = {}
         self.json_root = None
-        self.frame_json = None
-        self.parent_frame_json = None
+        self.file_format = None
+        self.float_size = 32
+        self.blocks = None
+        self.block_paths = None
+        self.index_data = None
+        # futures for the meshes a parallel parse hands to its pool
+        self.mesh_results = None
+
+    def read_header(self, file):
+        header = file.read(16)
+        file_format = header[8:12]
+        if not header.startswith(b'xof ') or file_format not in (b'txt ', b'bin ', b'tzip', b'bzip'):
+            raise ValueError(f"Unsupported .x format in {self.filename}: {header!r}")
+        self.file_format = file_format
+        self.float_size = 64 if header[12:16] == b'0064' else 32
 
     def parse(self):
-        with open(self.filename, 'r', encoding='shift_jis', errors='ignore') as file:
-            lines = iter(file.readlines())
-            self.parse_lines(lines)
-
-    def parse_lines(self, lines):
-        
-        materials_data = []
-        state = 'materials'
-
-        frame_data = {'name': None, 'transform_matrix': None, 'meshes': [], 'frames': []}
-        current_frame = frame_data
-        frame_json = None
-        frame_stack = []
-        mesh_data = None
-
-        for line in lines:
-            line = line.split("//")[0] #ignore any comments
-            line = line.strip()
-
-            if state == 'materials':
-                if line.startswith('Material '):
-                    name = line.split()[1]
-                    if print_debug: print(f"Material: {name}")
-
-                    line = next(lines).strip()
-                    properties = list(filter(None, line.split(';')))
-                    face_color = tuple(map(float, properties[0:4]))
-
-                    line = next(lines).strip()
-                    properties = list(filter(None, line.split(';')))
-                    power = float(properties[0])
-                
-                    line = next(lines).strip()
-                    properties = list(filter(None, line.split(';')))
-                    specular_color = tuple(map(float, properties[0:4]))
-
-                    line = next(lines).strip()
-                    properties = list(filter(None, line.split(';')))
-                    emissive_color = tuple(map(float, properties[0:4]))
-                
-                    line = next(lines).strip()
-                    texture_filename = None
-
-                    if line.startswith('TextureFilename '):
-                        line = next(lines).strip()
-                        texture_filename = line.split('"')[1]
-                        line = next(lines).strip()
-                
-                    materials_data.append(Material(name, face_color, power, specular_color, emissive_color, texture_filename))
-                elif line.startswith('Frame '):
-                    self.materials.extend(materials_data)
-
-                    #create the root frame
-                    frame_name = line.split()[1]
-                    current_frame['name'] = frame_name
-
-                    frame_json = FrameJSON(frame_name)
-                    self.json_root = frame_json
-                    self.parent_frame_json = frame_json
-
-                    state = 'header'
+        if self.cache is not None:
+            with instrumentation.stage('cache'):
+                key = self.cache.key(self.filename, PARSER_VERSION)
+                cached = self.cache.load(key)
+            if cached is not None:
+                log.debug("Loaded %s from the parse cache", self.filename)
+                self.frames, self.materials, self.animations = cached
+                if self.frames:
+                    self.json_root = frame_json(self.frames[0], None)
+                    self.export_to_json(self.filename.removesuffix(".x")+"_frames.json")
+                return
+
+        frames, _, _ = build_scene(self.read_events())
+        self.frames.extend(frames)
+
+        if self.cache is not None:
+            with instrumentation.stage('cache'):
+                self.cache.store(key, self.frames, self.materials, self.animations)
+
+    def events(self):
+        # Parses the file as a stream of events (see scene_model), so each
+        # mesh can be used and dropped as soon as it's read instead of the
+        # whole file being held at once. self.materials and self.animations
+        # still fill up, self.frames doesn't. Files going through the parse
+        # cache are parsed whole first, as that's what it keeps.
+        if self.cache is not None:
+            self.parse()
+            yield from scene_events(self.frames, self.materials, self.animations)
+        else:
+            yield from self.read_events()
+
+    def read_events(self):
+        with instrumentation.stage('parse'):
+            if self.workers > 1 and os.path.getsize(self.filename) >= PARALLEL_MIN_BYTES:
+                yield from self.parallel_events()
+            else:
+                with open(self.filename, 'rb') as file:
+                    self.read_header(file)
 
+                    if self.file_format in (b'tzip', b'bzip'):
+                        file = MSZipReader(file)
+
+                    if self.file_format in (b'txt ', b'tzip'):
+                        yield from self.token_events(XTokenizer(file))
+                    else:
+                        # the whole token stream is kept so number lists can be read in place
+                        with instrumentation.stage('read'):
+                            data = file.read()
+                        instrumentation.count('read', bytes=len(data))
+                        yield from self.token_events(XBinaryTokenizer(data, self.float_size))
+
+    def parallel_events(self):
+        # The meshes in frames are decoded by a pool of processes, each one
+        # reading its block straight from the file, or from shared memory for
+        # compressed files. Meanwhile the rest of the file is parsed here with
+        # those blocks swapped for numbered placeholders, and each frame picks
+        # up its meshes by number, so the events come out as they would serially.
+        meshes = list(frame_meshes(self.index()))
+        binary = self.file_format in (b'bin ', b'bzip')
+        shared = data = None
+        try:
+            if self.index_data is not None:
+                shared = shared_memory.SharedMemory(create=True, size=max(len(self.index_data), 1))
+                shared.buf[:len(self.index_data)] = self.index_data
+                data, start = self.index_data, 0
             else:
-                if line.startswith('Frame '):
-                    frame_name = line.split()[1]
-                    new_frame = {'name': frame_name, 'transform_matrix': None, 'meshes': [], 'frames': []}
-                    current_frame['frames'].append(new_frame)
-                    frame_stack.append(current_frame)
-
-                    frame_json = FrameJSON(frame_name)
-                
-                    if self.parent_frame_json.name == current_frame["name"]:
-                        self.parent_frame_json.children.append(frame_json)
-                        frame_json.parent = self.parent_frame_json
+                with open(self.filename, 'rb') as file:
+                    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                start = 16
+
+            with worker_pools.process_pool(self.workers) as pool:
+                self.mesh_results = []
+                for batch in batch_blocks(meshes, MESH_BATCH_BYTES):
+                    spans = [(block.offset, block.length) for block in batch]
+                    future = pool.submit(decode_mesh_blocks, self.filename, shared and shared.name, spans, binary, self.float_size)
+                    self.mesh_results.extend((future, position) for position in range(len(batch)))
+                skeleton = cut_blocks(data, start, meshes, binary)
+                yield from self.token_events(block_tokenizer(skeleton, binary, self.float_size))
+        finally:
+            self.mesh_results = None
+            if isinstance(data, mmap.mmap):
+                data.close()
+            if shared is not None:
+                shared.close()
+                shared.unlink()
+
+    def index(self):
+        # Finds where every Frame, Mesh, MeshMaterialList, AnimationSet and
+        # Material block is without decoding any of them. Uncompressed files
+        # are memory mapped and scanned in place.
+        with open(self.filename, 'rb') as file, instrumentation.stage('index'):
+            self.read_header(file)
+            binary = self.file_format in (b'bin ', b'bzip')
+
+            if self.file_format in (b'tzip', b'bzip'):
+                with instrumentation.stage('read'):
+                    self.index_data = MSZipReader(file).read()
+                scan = scan_binary(self.index_data, 0, self.float_size) if binary else scan_text(self.index_data)
+                self.blocks = build_index(scan)
+            else:
+                self.index_data = None
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    scan = scan_binary(data, 16, self.float_size) if binary else scan_text(data, 16)
+                    self.blocks = build_index(scan)
+            instrumentation.count('index', bytes=os.fstat(file.fileno()).st_size if self.index_data is None else len(self.index_data))
+
+        self.block_paths = index_paths(self.blocks)
+        return self.blocks
+
+    def get_block(self, path):
+        if self.block_paths is None:
+            self.index()
+        block = self.block_paths.get(path)
+        if block is None:
+            raise KeyError(f"No block at '{path}' in {self.filename}")
+        return block
+
+    def block_tokens(self, block):
+        # A tokenizer over just this block, starting at its keyword
+        if self.index_data is not None:
+            data = self.index_data[block.offset:block.offset + block.length]
+        else:
+            with open(self.filename, 'rb') as file:
+                file.seek(block.offset)
+                data = file.read(block.length)
+
+        tokens = block_tokenizer(data, self.file_format in (b'bin ', b'bzip'), self.float_size)
+        tokens.next_token()
+        return tokens
+
+    def get_mesh(self, path):
+        # Decodes a single mesh, e.g. parser.get_mesh('Frame_World/Frame_Table/Table')
+        block = self.get_block(path)
+        if block.kind != 'Mesh':
+            raise ValueError(f"'{path}' is a {block.kind} block, not a Mesh")
+        return self.parse_mesh(self.block_tokens(block))
+
+    def get_frame(self, path):
+        # Decodes a frame with all its meshes and child frames
+        block = self.get_block(path)
+        if block.kind != 'Frame':
+            raise ValueError(f"'{path}' is a {block.kind} block, not a Frame")
+        json_root = self.json_root
+        frames, _, _ = build_scene(self.frame_events(self.block_tokens(block), None))
+        self.json_root = json_root
+        return frames[0]
+
+    def print_index(self, blocks=None, indent=0):
+        if blocks is None:
+            blocks = self.blocks if self.blocks is not None else self.index()
+        for block in blocks:
+            print(f"{'  ' * indent}{block.kind}: {block.name or ''} ({block.length} bytes)")
+            self.print_index(block.children, indent + 1)
+
+    def token_events(self, tokens):
+        while tokens.peek_token() is not None:
+            token = tokens.next_token()
+
+            if token == b'Material':
+                material = self.parse_material(tokens)
+                self.materials.append(material)
+                yield MATERIAL, material
+
+            elif token == b'Frame':
+                yield from self.frame_events(tokens, None)
+
+            elif token == b'AnimationSet':
+                log.debug("Start animation")
+                name = self.parse_animation_set(tokens)
+                yield ANIMATION_SET, name, self.animations[name]
+
+            elif token == b'template':
+                # a declaration like template Frame { <guid> [...] }, not a frame
+                tokens.read_block_name()
+                tokens.skip_block()
+
+            elif token == b'{':
+                # Header and anything else we don't use
+                tokens.skip_block()
+
+        log.debug("--- process finished ---")
+        if self.json_root is not None:
+            # The file is ready to write
+            self.export_to_json(self.filename.removesuffix(".x")+"_frames.json")
+
+    def parse_material(self, tokens):
+        name = tokens.read_block_name()
+        log.debug("Material: %s", name)
+
+        face_color = tuple(tokens.read_floats(4))
+        power = tokens.read_float()
+        specular_color = tuple(tokens.read_floats(3))
+        emissive_color = tuple(tokens.read_floats(3))
+        texture_filename = None
+
+        while True:
+            token = tokens.next_token()
+            if token == b'}':
+                break
+            elif token == b'TextureFilename':
+                tokens.read_block_name()
+                texture_filename = tokens.read_string()
+                tokens.skip_block()
+            elif token == b'{':
+                tokens.skip_block()
+
+        return Material(name, face_color, power, specular_color, emissive_color, texture_filename)
+
+    def frame_events(self, tokens, parent_json):
+        frame_name = tokens.read_block_name()
+        frame = Frame(frame_name)
+        log.debug("Frame: %s", frame_name)
+
+        frame_json = FrameJSON(frame_name, parent_json)
+        if parent_json is not None:
+            parent_json.children.append(frame_json)
+        elif self.json_root is None:
+            self.json_root = frame_json
+        yield FRAME_BEGIN, frame
+
+        while True:
+            token = tokens.next_token()
+            if token == b'}':
+                break
+
+            elif token == b'Frame':
+                yield from self.frame_events(tokens, frame_json)
+
+            elif token == b'FrameTransformMatrix':
+                tokens.read_block_name()
+                frame.transform_matrix = tokens.read_array(4, 4, np.float64)
+                tokens.skip_block()
+                log.debug("Transform Matrix: %s", frame.transform_matrix)
+
+            elif token == b'Mesh':
+                known_materials = len(self.materials)
+                with instrumentation.stage('parse meshes'):
+                    if self.mesh_results is not None:
+                        # a placeholder for a mesh the pool is decoding,
+                        # let go of once it's picked up
+                        number = int(tokens.read_block_name())
+                        tokens.skip_block()
+                        future, position = self.mesh_results[number]
+                        self.mesh_results[number] = None
+                        mesh, materials = future.result()[position]
+                        self.materials.extend(materials)
                     else:
-                        # Start a new parent structure
-                        self.parent_frame_json = self.parent_frame_json.children[-1]
-
-                        frame_json.parent = self.parent_frame_json
-                        self.parent_frame_json.children.append(frame_json)
-
-                    current_frame = new_frame
-                    state = 'header'
-
-                    if print_debug: print(f"Frame: {frame_name}")
-            
-                elif line.startswith('AnimationSet '):
-                    print("Start animation")
-                    self.parse_animation_set(lines, line)
-
-                elif line.startswith('Mesh '):
-                    mesh_name = line.split()[1]
-                    mesh_data = {'name': mesh_name, 'vertices': [], 'normals': [], 'normal_faces': [], 'uvs': [], 'colors': [], 'faces': [], 'materials': {'material_indices': [], 'materials': []}}
-                    current_frame['meshes'].append(mesh_data)
-                    state = 'vertices_count'
-                    if print_debug: print(f"Mesh: {mesh_name}")
-
-                elif line.startswith('FrameTransformMatrix'):
-                    matrix_data = []
-                    line = next(lines).strip()
-                    while not line.endswith(';;'):
-                        matrix_data.append(line)
-                        line = next(lines).strip()
-                    matrix_data.append(line[:-2].strip())
-                    current_frame['transform_matrix'] = ' '.join(matrix_data)
-                    if print_debug: print(f"Transform Matrix: {current_frame['transform_matrix']}")
-                    state = 'mesh'
-                    continue
-
-                elif state == 'vertices_count' and re.match(r'^\d+;$', line):
-                    vertex_count = int(line[:-1])
-                    state = 'vertices'
-                    if print_debug: print(f"Vertices to process: {vertex_count}")
-
-                elif state == 'vertices':
-                    if line == '}':
-                        state = 'mesh'
-                        continue
-                    vertices = line.split(';')[:-1]
-                    if len(vertices) == 3:
-                        mesh_data['vertices'].append(tuple(map(float, vertices)))
-                    if line.endswith(';;'):
-                        mesh_data['vertices'].append(tuple(map(float, vertices[:3])))
-                        state = 'faces_count'
-
-                elif state == 'faces_count' and re.match(r'^\d+;$', line):
-                    face_count = int(line[:-1])
-                    state = 'faces'
-                    if print_debug: print(f"Faces to process: {face_count}")
-                    continue
-
-                elif state == 'faces':
-                    #face_data = re.findall(r'\d+', line)
-                    face_data = line.split(';')[1]
-                    face_data = face_data.split(',')
-                    if face_data:
-                        mesh_data['faces'].append(list(map(int, face_data)))
-                    if len(mesh_data['faces']) == face_count:
-                        state = 'mesh'
-
-                elif state == 'mesh' and line.startswith('MeshMaterialList'):
-                    mesh_data['materials'] = self.parse_material_list(lines)
-                    if print_debug: print(f"Materials: {mesh_data['materials']}")
-
-                elif state == 'mesh' and line.startswith('MeshNormals'):
-                    state = 'normals_count'
-
-                elif state == 'normals_count' and re.match(r'^\d+;$', line):
-                    normals_count = int(line[:-1])
-                    state = 'normals'
-                    if print_debug: print(f"Normals to process: {normals_count}")
-
-                elif state == 'normals':
-                    if line == '}':
-                        state = 'mesh'
-                        continue
-                    normals = line.split(';')[:-1]
-                    if len(normals) == 3:
-                        mesh_data['normals'].append(tuple(map(float, normals)))
-                    if line.endswith(';;'):
-                        mesh_data['normals'].append(tuple(map(float, normals[:3])))
-                        state = 'normal_faces_count'
-                        #print(mesh_data['normals'])
-                        continue
-
-                elif state == 'normal_faces_count' and re.match(r'^\d+;$', line):
-                    normal_face_count = int(line[:-1])
-                    state = 'normal_faces'
-                    if print_debug: print(f"Normal faces to process: {normal_face_count}")
-                    continue
-
-                elif state == 'normal_faces':
-                    if line == '}':
-                        state = 'mesh'
-                        continue
-                    face_data = line.split(';')[1]
-                    face_data = face_data.split(',')
-                    if face_data:
-                        mesh_data['normal_faces'].append(list(map(int, face_data)))
-
-                elif state == 'mesh' and line.startswith('MeshTextureCoords'):
-                    state = 'uvs_count'
-
-                elif state == 'uvs_count' and re.match(r'^\d+;$', line):
-                    uvs_count = int(line[:-1])
-                    state = 'uvs'
-                    if print_debug: print(f"UVs to process: {uvs_count}")
-
-                elif state == 'uvs':
-                    if line == '}':
-                        state = 'mesh'
-                        continue
-                    uvs = line.split(';')[:-1]
-                    if len(uvs) == 2:
-                        mesh_data['uvs'].append(tuple(map(float, uvs)))
-                    elif line.endswith(';;'):
-                        mesh_data['uvs'].append(tuple(map(float, uvs[:2])))
-
-                elif state == 'mesh' and line.startswith('MeshVertexColors'):
-                    state = 'colors_count'
-
-                elif state == 'colors_count' and re.match(r'^\d+;$', line):
-                    colors_count = int(line[:-1])
-                    state = 'colors'
-                    if print_debug: print(f"Vertex Colours to process: {colors_count}")
-
-                elif state == 'colors':
-                    if line == '}':
-                        state = 'mesh'
-                    colors = list(filter(None, line.split(';')[1:]))
-                    if len(colors) >= 3:
-                        colors = colors[:3]
-                        mesh_data['colors'].append(tuple(map(float, colors)))
-
-                elif line == '}':
-                    if state == 'mesh':
-                        state = None
-
-                        continue
-                    elif frame_stack:
-                        if print_debug: print(f"--- Frame finished: {current_frame['name']}")
-                        current_frame = frame_stack.pop()
-
-                        if self.parent_frame_json.name != current_frame["name"]:
-                            print(f"--- json {self.parent_frame_json.name}")
-                            self.parent_frame_json = self.parent_frame_json.parent
-                        
-                    elif state != 'header':
-                        if print_debug: print(f"--- process finished ---")
-                        if self.json_root is not None:
-                            #print("tree is...")
-                            #print(self.json_root.toJSON())
-                            # The file is ready to write
-                            self.export_to_json(self.filename.removesuffix(".x")+"_frames.json")
-
-                            # record the frames
-                            self.frames.append(frame_data)
+                        mesh = self.parse_mesh(tokens)
+                instrumentation.count('parse meshes', vertices=len(mesh.vertices), faces=len(mesh.faces))
+                # materials defined inside the mesh come first
+                for material in self.materials[known_materials:]:
+                    yield MATERIAL, material
+                yield MESH, mesh
+                del mesh
+
+            elif token == b'AnimationSet':
+                log.debug("Start animation")
+                name = self.parse_animation_set(tokens)
+                yield ANIMATION_SET, name, self.animations[name]
+
+            elif token == b'{':
+                tokens.skip_block()
+
+        log.debug("--- Frame finished: %s", frame_name)
+        yield FRAME_END, frame
+
+    def parse_mesh(self, tokens):
+        mesh_name = tokens.read_block_name()
+        log.debug("Mesh: %s", mesh_name)
+        normals = normal_faces = uvs = colors = None
+        material_indices = materials = None
+
+        vertex_count = tokens.read_int()
+        log.debug("Vertices to process: %d", vertex_count)
+        vertices = tokens.read_array(vertex_count, 3)
+
+        face_count = tokens.read_int()
+        log.debug("Faces to process: %d", face_count)
+        faces = tokens.read_faces(face_count)
+
+        while True:
+            token = tokens.next_token()
+            if token == b'}':
+                break
+
+            elif token == b'MeshMaterialList':
+                material_indices, materials = self.parse_material_list(tokens)
+                log.debug("Materials: %s", materials)
+
+            elif token == b'MeshNormals':
+                tokens.read_block_name()
+                normals_count = tokens.read_int()
+                log.debug("Normals to process: %d", normals_count)
+                normals = tokens.read_array(normals_count, 3)
+                normal_face_count = tokens.read_int()
+                log.debug("Normal faces to process: %d", normal_face_count)
+                normal_faces = tokens.read_faces(normal_face_count)
+                tokens.skip_block()
+
+            elif token == b'MeshTextureCoords':
+                tokens.read_block_name()
+                uvs_count = tokens.read_int()
+                log.debug("UVs to process: %d", uvs_count)
+                uvs = tokens.read_array(uvs_count, 2)
+                tokens.skip_block()
+
+            elif token == b'MeshVertexColors':
+                tokens.read_block_name()
+                colors_count = tokens.read_int()
+                log.debug("Vertex Colours to process: %d", colors_count)
+                # each entry is an index followed by RGBA, only RGB is kept
+                colors = tokens.read_array(colors_count, 5)[:, 1:4]
+                tokens.skip_block()
+
+            elif token == b'{':
+                tokens.skip_block()
+
+        if isinstance(faces, list):
+            # polygons are split into triangles, carrying their material along
+            faces, source_faces = triangulate(faces)
+            if material_indices is not None and len(material_indices) == face_count:
+                material_indices = material_indices[source_faces]
+        if isinstance(normal_faces, list):
+            normal_faces = triangulate(normal_faces)[0]
+
+        return Mesh(mesh_name, vertices, faces, normals, normal_faces, uvs, colors, material_indices, materials)
 
     def export_to_json(self, output_json_file):
         with open(output_json_file, 'w') as f:
             f.write(self.json_root.toJSON())
 
-    def parse_material_list(self, lines):
-        material_data = {'material_indices': [], 'materials': []}
-        material_list_str = ""
+    def parse_material_list(self, tokens):
+        materials = []
+        tokens.read_block_name()
+
+        material_count = tokens.read_int()
+        face_count = tokens.read_int()
+        material_indices = tokens.read_array(face_count, 1, np.uint16).reshape(-1)
+
         while True:
-            line = next(lines).strip()
-            material_list_str += line + " "
-            if line.endswith(';;'):
+            token = tokens.next_token()
+            if token == b'}':
                 break
+            elif token == b'{':
+                # reference to a material defined at the top of the file
+                materials.append(tokens.read_name())
+                tokens.skip_block()
+            elif token == b'Material':
+                material = self.parse_material(tokens)
+                self.materials.append(material)
+                materials.append(material.name)
+
+        if len(materials) != material_count:
+            log.warning("Expected %d materials but found %d", material_count, len(materials))
+
+        return material_indices, materials
+
+    def parse_animation_set(self, tokens):
+        animation_set_name = tokens.read_block_name()
+        anim_log.debug("Animation Set: %s", animation_set_name)
+        animation_set = {'animations': defaultdict(list), 'play_once': {}}
+        self.animations[animation_set_name] = animation_set
 
-        material_list_str = material_list_str[:-2]  # Remove the trailing ";;"
-        parts = material_list_str.split(';')
-        material_count = int(parts[0])
-        face_count = int(parts[1])
-
-        # Correctly parse the material indices
-        indices_str = parts[2].replace(',', ' ')
-        indices = indices_str.split()
-        material_indices = list(map(int, indices))
-
-        material_data['material_indices'] = material_indices[:face_count]
-
-        for _ in range(material_count):
-            line = next(lines).strip()
-            while not line.endswith('}'):
-                line += ' ' + next(lines).strip()
-            material_name = re.search(r'{(.+?)}', line).group(1).strip()
-            material_data['materials'].append(material_name)
-
-        line = next(lines).strip()
-        while line != '}':
-            line = next(lines).strip()
-
-        return material_data
-    
-    def parse_animation_set(self, lines, line):
-        animation_set_name = None
-        animation_name = None
-        key_type = None
-        key_data = []
+        while True:
+            token = tokens.next_token()
+            if token == b'}':
+                break
+            elif token == b'Animation':
+                self.parse_animation(tokens, animation_set)
+            elif token == b'{':
+                tokens.skip_block()
+
+        return animation_set_name
+
+    def parse_animation(self, tokens, animation_set):
+        animation_name = tokens.read_block_name()
+        anim_log.debug("  Animation: %s", animation_name)
+        keys = animation_set['animations'][animation_name] = []
         bone_name = None
-        play_once_val = False
-        stripped_line = line
-
-        state = 'animation_set'
-        while state != 'finished':
-            stripped_line = stripped_line.split('//')[0].strip()
-            
-            if state == 'animation_set' and stripped_line.startswith('AnimationSet '):
-                animation_set_name = stripped_line.split()[1]
-                if print_anim_debug: print("Animation Set: "+animation_set_name)
-                self.animations[animation_set_name] = {'animations': defaultdict(list), 'play_once': {}}
-                state = 'animation'
-            
-            elif state == 'animation' and stripped_line.startswith('Animation '):
-                animation_name = stripped_line.split()[1]
-                if print_anim_debug: print("  Animation: "+animation_name)
-                self.animations[animation_set_name]['animations'][animation_name] = []
-                state = 'bone'
-            
-            elif state == 'bone' and stripped_line.startswith('{') and stripped_line.endswith('}'):
-                bone_name = stripped_line.split('{')[1].split('}')[0]
-                if print_anim_debug: print("    Bone: "+bone_name)
-                state = 'key'
-
-            elif state == 'key' and stripped_line.startswith('AnimationOptions '):
-                play_once_val = stripped_line.removeprefix('AnimationOptions {').split(";")[0].strip() == '0'
-                self.animations[animation_set_name]['play_once'][animation_name] = play_once_val
-                if print_anim_debug: print(f'      Play once: {play_once_val}') 
-
-            elif state == 'key' and stripped_line.startswith('AnimationKey '):
-                key_data = []
-                key_type = None
-            
-            elif stripped_line.startswith('}'):
-                if state == 'key_data':
-                    for entry in key_data:
-                        frame, dim, values = entry.split(';')
-                        self.animations[animation_set_name]['animations'][animation_name].append(Animation(
-                            type=key_type,
-                            bone_name=bone_name,
-                            keyframes=[Keyframe(
-                                frame=int(frame),
-                                dim=int(dim),
-                                values=list(map(float, values.strip().split(',')))
-                            )]
-                        ))
-                    state = 'key'
-                elif state == 'key':
-                    state = 'animation'
-                elif state == 'animation':
-                    state = 'finished'
-                    return
-            
-            elif state == 'key' and stripped_line.endswith(';'):
-                key_type = stripped_line.split(';')[0]
-                if key_type == '0':
-                    key_type = 'Rotation'
-                elif key_type == '1':
-                    key_type = 'Scale'
-                elif key_type == '2':
-                    key_type = 'Position'
-                state = 'key_count'
-                if print_anim_debug: print('    Key for: '+key_type)
-
-            elif state == 'key_count' and stripped_line.endswith(';'):
-                key_count = int(stripped_line.split(';')[0])
-                state = 'key_data'
-
-            elif state == 'key_data' and stripped_line.endswith(';'):
-                key_data.append(stripped_line.split('//')[0].split(';;')[0])
-                if print_anim_debug: print('      '+stripped_line.split('//')[0].split(';;')[0])
-            
-            stripped_line = next(lines)
+
+        while True:
+            token = tokens.next_token()
+            if token == b'}':
+                break
+
+            elif token == b'{':
+                bone_name = tokens.read_name()
+                tokens.skip_block()
+                anim_log.debug("    Bone: %s", bone_name)
+
+            elif token == b'AnimationOptions':
+                tokens.read_block_name()
+                play_once_val = tokens.read_int() == 0
+                tokens.skip_block()
+                animation_set['play_once'][animation_name] = play_once_val
+                anim_log.debug('      Play once: %s', play_once_val)
+
+            elif token == b'AnimationKey':
+                tokens.read_block_name()
+                key_type = tokens.read_int()
+                key_type = ANIMATION_KEY_TYPES.get(key_type, str(key_type))
+                key_count = tokens.read_int()
+                anim_log.debug('    Key for: %s', key_type)
+
+                frames, values = tokens.read_keys(key_count)
+                keys.append(AnimationKey(key_type, bone_name, frames, values))
+                if anim_log.isEnabledFor(logging.DEBUG):
+                    for frame, value in zip(frames.tolist(), values.tolist()):
+                        anim_log.debug('      %d;%d;%s', frame, len(value), value)
+                tokens.skip_block()
 
     # To print parsed data for debugging
     def print_parsed_data(self, frames, materials, indent=0):
@@ -389,21 +474,21 @@ class XFileParser:
                     print(f"{indent_str}  File: {material.texture_filename}")
 
         for frame in frames:
-            print(f"{indent_str}Frame: {frame['name']}")
-            if frame['transform_matrix']:
-                print(f"{indent_str}  Transform Matrix: {frame['transform_matrix']}")
-            for mesh in frame['meshes']:
-                print(f"{indent_str}  Mesh: {mesh['name']}")
-                print(f"{indent_str}    Vertices: {len(mesh['vertices'])}")
-                print(f"{indent_str}    Normals: {len(mesh['normals'])}")
-                print(f"{indent_str}    Face Normals: {len(mesh['normal_faces'])}")
-                print(f"{indent_str}    UVs: {len(mesh['uvs'])}")
-                print(f"{indent_str}    Colors: {len(mesh['colors'])}")
-                print(f"{indent_str}    Faces: {len(mesh['faces'])}")
-                print(f"{indent_str}    Material Indices: {len(mesh['materials']['material_indices'])}")
-                print(f"{indent_str}    Materials: {len(mesh['materials']['materials'])}")
-            if frame['frames']:
-                self.print_parsed_data(frame['frames'], [], indent + 1)
+            print(f"{indent_str}Frame: {frame.name}")
+            if frame.transform_matrix is not None:
+                print(f"{indent_str}  Transform Matrix: {frame.transform_matrix.tolist()}")
+            for mesh in frame.meshes:
+                print(f"{indent_str}  Mesh: {mesh.name}")
+                print(f"{indent_str}    Vertices: {len(mesh.vertices)}")
+                print(f"{indent_str}    Normals: {len(mesh.normals)}")
+                print(f"{indent_str}    Face Normals: {len(mesh.normal_faces)}")
+                print(f"{indent_str}    UVs: {len(mesh.uvs)}")
+                print(f"{indent_str}    Colors: {len(mesh.colors)}")
+                print(f"{indent_str}    Faces: {len(mesh.faces)}")
+                print(f"{indent_str}    Material Indices: {len(mesh.material_indices)}")
+                print(f"{indent_str}    Materials: {len(mesh.materials)}")
+            if frame.frames:
+                self.print_parsed_data(frame.frames, [], indent + 1)
 
 class FrameJSON:
     def __init__(self, name, parent=None):
@@ -414,9 +499,10 @@ class FrameJSON:
         self.children = []
 
     def toJSON(self, indent=0):
+        # strings go through json.dumps so the file is always valid JSON
         toreturn = ("  "*indent)+"{\n"
-        toreturn += f'{("  "*indent)}  "name": "{self.name}",\n'
-        toreturn += f'{("  "*indent)}  "nickname": "{self.nickname}"'
+        toreturn += f'{("  "*indent)}  "name": {json.dumps(self.name)},\n'
+        toreturn += f'{("  "*indent)}  "nickname": {json.dumps(self.nickname)},\n'
         toreturn += f'{("  "*indent)}  "collision": "{self.collision}"'
         if self.children and len(self.children) > 0:
             toreturn += f',\n{("  "*indent)}  "children": ['
@@ -429,8 +515,75 @@ class FrameJSON:
         toreturn += ("  "*indent)+"}"
         return toreturn
 
+def frame_json(frame, parent):
+    # Rebuilds the _frames.json tree frame_events makes, for cached results
+    frame_json_node = FrameJSON(frame.name, parent)
+    for child in frame.frames:
+        frame_json_node.children.append(frame_json(child, frame_json_node))
+    return frame_json_node
+
+def block_tokenizer(data, binary, float_size):
+    return XBinaryTokenizer(data, float_size) if binary else XTokenizer(io.BytesIO(data))
+
+def frame_meshes(blocks, in_frame=False):
+    # The Mesh blocks frame_events would read, in file order
+    for block in blocks:
+        if block.kind == 'Mesh' and in_frame:
+            yield block
+        elif block.kind == 'Frame':
+            yield from frame_meshes(block.children, True)
+
+def mesh_placeholder(number, binary):
+    name = str(number).encode()
+    if binary:
+        return struct.pack('<HI', TOKEN_NAME, 4) + b'Mesh' + struct.pack('<HI', TOKEN_NAME, len(name)) + name + struct.pack('<HH', TOKEN_OBRACE, TOKEN_CBRACE)
+    return b' Mesh ' + name + b' { } '
+
+def cut_blocks(data, start, blocks, binary):
+    # A copy of the data from start on, with each block replaced by a
+    # numbered placeholder
+    parts = []
+    for number, block in enumerate(blocks):
+        parts.append(data[start:block.offset])
+        parts.append(mesh_placeholder(number, binary))
+        start = block.offset + block.length
+    parts.append(data[start:])
+    return b''.join(parts)
+
+def batch_blocks(blocks, batch_bytes):
+    batch, size = [], 0
+    for block in blocks:
+        batch.append(block)
+        size += block.length
+        if size >= batch_bytes:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+def decode_mesh_blocks(filename, shared_name, spans, binary, float_size):
+    # Runs in a pool process. Returns each mesh with any materials defined
+    # inside it, which parse() would have added to the file's materials.
+    if shared_name is not None:
+        shared = shared_memory.SharedMemory(shared_name)
+        try:
+            blocks = [bytes(shared.buf[offset:offset + length]) for offset, length in spans]
+        finally:
+            shared.close()
+    else:
+        with open(filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            blocks = [mapped[offset:offset + length] for offset, length in spans]
+
+    results = []
+    for data in blocks:
+        parser = XFileParser(filename)
+        tokens = block_tokenizer(data, binary, float_size)
+        tokens.next_token()
+        results.append((parser.parse_mesh(tokens), parser.materials))
+    return results
+
 if __name__ == "__main__":
-    print_debug = True
+    logging.basicConfig(level=logging.DEBUG, format='%(message)s')
     parser = XFileParser('train_iwa.x')
     parser.parse()
     parser.print_parsed_data(parser.frames, parser.materials)
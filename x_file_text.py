@@ -0,0 +1,109 @@
+import numpy as np
+
+# Renders the text .x blocks for materials, frame matrices and meshes. This is
+# kept apart from the writer, and from pxr, so meshes can be rendered in
+# worker processes and .x files written without USD.
+
+# rows formatted per % operation, which bounds the size of the argument tuple
+ROWS_PER_CHUNK = 1 << 16
+
+def format_rows(values, row_format, last_row_format):
+    # Renders every row of a 2D array with a % format, the last row with its
+    # own format as Recettear ends lists with ;; rather than ;,
+    values = np.asarray(values)
+    rows = len(values)
+    if rows == 0:
+        return ''
+    values = values.reshape(rows, -1)
+    parts = []
+    for start in range(0, rows - 1, ROWS_PER_CHUNK):
+        chunk = values[start:min(start + ROWS_PER_CHUNK, rows - 1)]
+        parts.append((row_format * len(chunk)) % tuple(chunk.ravel().tolist()))
+    parts.append(last_row_format % tuple(values[-1].tolist()))
+    return ''.join(parts)
+
+def render_materials(materials):
+    parts = []
+    for material in materials:
+        parts.append("Material "+material.name+" {\n")
+        parts.append(f"\t{material.face_color[0]:.6f};{material.face_color[1]:.6f};{material.face_color[2]:.6f};1.0;;\n")
+        parts.append(f"\t{material.power:.6f};\n")
+        parts.append(f"\t{material.specular_color[0]:.6f};{material.specular_color[1]:.6f};{material.specular_color[2]:.6f};;\n")
+        parts.append(f"\t{material.emissive_color[0]:.6f};{material.emissive_color[1]:.6f};{material.emissive_color[2]:.6f};;\n")
+        if material.texture_filename:
+            parts.append("\tTextureFilename {"+"\n\t\t\""+material.texture_filename+"\";\n\t}\n")
+        parts.append("}\n\n")
+    return ''.join(parts)
+
+def render_transform(matrix, indent):
+    indent_str = '\t' * indent
+    row, row1, row2, row3 = matrix
+    return (f"{indent_str}\tFrameTransformMatrix {{\n"
+            f"{indent_str}\t\t{row[0]:0.6f},{row[1]:0.6f},{row[2]:0.6f},{row[3]:0.6f},\n"
+            f"{indent_str}\t\t{row1[0]:0.6f},{row1[1]:0.6f},{row1[2]:0.6f},{row1[3]:0.6f},\n"
+            f"{indent_str}\t\t{row2[0]:0.6f},{row2[1]:0.6f},{row2[2]:0.6f},{row2[3]:0.6f},\n"
+            f"{indent_str}\t\t{row3[0]:0.6f},{row3[1]:0.6f},{row3[2]:0.6f},{row3[3]:0.6f};;\n"
+            f"{indent_str}\t}}\n\n")
+
+def render_mesh(mesh, org_name, indent):
+    # Each section is rendered from its array in one go
+    indent_str = '\t' * indent
+    parts = [f"{indent_str}Mesh {org_name} {{\n"]
+
+    # Vertices
+    parts.append(f"{indent_str}\t{len(mesh.vertices)};\n")
+    parts.append(format_rows(mesh.vertices, f"{indent_str}\t%.6f;%.6f;%.6f;,\n", f"{indent_str}\t%.6f,%.6f,%.6f;;\n\n"))
+
+    # Faces
+    parts.append(f"{indent_str}\t{len(mesh.faces)};\n")
+    parts.append(format_rows(mesh.faces, f"{indent_str}\t3;%d,%d,%d;,\n", f"{indent_str}\t3;%d,%d,%d;;\n\n"))
+
+    # Materials
+    parts.append(indent_str + "\tMeshMaterialList {\n")
+    if len(mesh.materials) == 1:
+        parts.append(f"{indent_str}\t\t1;1;0;;\n")
+        parts.append(f"{indent_str}\t\t"+"{"+mesh.materials[0]+"}\n")
+    else:
+        num_materials = len(mesh.materials)
+        num_faces = len(mesh.faces)
+        parts.append(f"{indent_str}\t\t{num_materials};\n")
+        parts.append(f"{indent_str}\t\t{num_faces};\n")
+
+        # Write material indices for each face, in lines of up to 30
+        indices = list(map(str, mesh.material_indices.tolist()))
+        lines = [','.join(indices[i:i + 30]) for i in range(0, len(indices), 30)]
+        parts.append(indent_str + "\t\t" + (",\n" + indent_str + "\t\t").join(lines) + ";;\n")
+
+        # Write material names
+        for material in mesh.materials:
+            parts.append(indent_str + "\t\t{" + material + "}\n")
+
+    parts.append(indent_str + "\t}\n\n")
+
+    # Normals
+    if len(mesh.normals) > 0:
+        parts.append(f"{indent_str}\tMeshNormals {{\n")
+        parts.append(f"{indent_str}\t\t{len(mesh.normals)};\n")
+        parts.append(format_rows(mesh.normals, f"{indent_str}\t\t%.6f,%.6f,%.6f;,\n", f"{indent_str}\t\t%.6f,%.6f,%.6f;;\n\n"))
+
+        parts.append(f"{indent_str}\t\t{len(mesh.normal_faces)};\n")
+        parts.append(format_rows(mesh.normal_faces, f"{indent_str}\t\t3;%d,%d,%d;,\n", f"{indent_str}\t\t3;%d,%d,%d;;\n"))
+        parts.append(f"{indent_str}\t}}\n\n")
+
+    # Vertex Colors
+    if len(mesh.colors):
+        parts.append(f"{indent_str}\tMeshVertexColors {{\n")
+        parts.append(f"{indent_str}\t\t{len(mesh.colors)};\n")
+        indexed_colors = np.column_stack((np.arange(len(mesh.colors)), mesh.colors))
+        parts.append(format_rows(indexed_colors, f"{indent_str}\t\t%d;%.6f,%.6f,%.6f,1.0;,\n", f"{indent_str}\t\t%d;%.6f,%.6f,%.6f,1.0;;\n"))
+        parts.append(f"{indent_str}\t}}\n\n")
+
+    # Texture Coordinates
+    if len(mesh.uvs):
+        parts.append(f"{indent_str}\tMeshTextureCoords {{\n")
+        parts.append(f"{indent_str}\t\t{len(mesh.uvs)};\n")
+        parts.append(format_rows(mesh.uvs, f"{indent_str}\t\t%.6f;%.6f;,\n", f"{indent_str}\t\t%.6f;%.6f;;\n"))
+        parts.append(f"{indent_str}\t}}\n\n")
+
+    parts.append(f"{indent_str}}}\n")
+    return ''.join(parts)
@@ -0,0 +1,177 @@
+import re
+import numpy as np
+import instrumentation
+
+# Everything in a text .x file is a name, a number, a quoted string or a brace.
+# The ';' and ',' separators carry no information once you know the template
+# layout, so they're treated the same as whitespace. Comments are matched as
+# tokens and dropped, after strings so a // or # inside quotes is kept.
+TOKEN_RE = re.compile(rb'"[^"]*"|(?://|#)[^\n]*|[{}]|[^\s{};,"#/]+|/')
+
+CHUNK_SIZE = 1 << 20
+
+class XTokenizer:
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.tokens = []
+        self.pos = 0
+        self.carry = b''
+        self.eof = False
+
+    def read_chunk(self):
+        # Read the next chunk, cut at the last newline so no token or comment
+        # is split, and tokenize it. Returns None once the file is used up.
+        while not self.eof:
+            with instrumentation.stage('read'):
+                data = self.file.read(self.chunk_size)
+            instrumentation.count('read', bytes=len(data))
+            if data:
+                data = self.carry + data
+                cut = data.rfind(b'\n') + 1
+                if cut == 0:
+                    self.carry = data
+                    continue
+                self.carry = data[cut:]
+                data = data[:cut]
+            else:
+                self.eof = True
+                data = self.carry
+                self.carry = b''
+
+            with instrumentation.stage('tokenize'):
+                tokens = TOKEN_RE.findall(data)
+                if b'//' in data or b'#' in data:
+                    tokens = [token for token in tokens if not is_comment(token)]
+                return tokens
+        return None
+
+    def fill(self):
+        while self.pos >= len(self.tokens):
+            tokens = self.read_chunk()
+            if tokens is None:
+                return False
+            self.tokens = tokens
+            self.pos = 0
+        return True
+
+    def ensure(self, count):
+        # Buffer at least count tokens past the current position so a whole
+        # block can be decoded at once
+        if len(self.tokens) - self.pos >= count:
+            return True
+        pending = self.tokens[self.pos:]
+        while len(pending) < count:
+            tokens = self.read_chunk()
+            if tokens is None:
+                break
+            pending += tokens
+        self.tokens = pending
+        self.pos = 0
+        return len(pending) >= count
+
+    def peek_token(self):
+        if self.pos >= len(self.tokens) and not self.fill():
+            return None
+        return self.tokens[self.pos]
+
+    def next_token(self):
+        if self.pos >= len(self.tokens) and not self.fill():
+            raise ValueError("Unexpected end of .x file")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def read_tokens(self, count):
+        tokens = self.tokens[self.pos:self.pos + count]
+        self.pos += len(tokens)
+        while len(tokens) < count:
+            if not self.fill():
+                raise ValueError("Unexpected end of .x file")
+            more = self.tokens[self.pos:self.pos + count - len(tokens)]
+            self.pos += len(more)
+            tokens += more
+        return tokens
+
+    def expect(self, expected):
+        token = self.next_token()
+        if token != expected:
+            raise ValueError(f"Expected {expected.decode()} but found {token.decode('shift_jis', errors='ignore')}")
+
+    def read_int(self):
+        return int(self.next_token())
+
+    def read_float(self):
+        return float(self.next_token())
+
+    def read_floats(self, count):
+        return list(map(float, self.read_tokens(count)))
+
+    def read_array(self, count, dim, dtype=np.float32):
+        # numpy parses the number tokens itself, no Python float per value
+        if not self.ensure(count * dim):
+            raise ValueError("Unexpected end of .x file")
+        values = np.array(self.tokens[self.pos:self.pos + count * dim], dtype=dtype)
+        self.pos += count * dim
+        return values.reshape(count, dim)
+
+    def read_faces(self, count):
+        # Nearly every face is a triangle: read them as one (count, 4) block
+        # and check the vertex counts. Every face takes at least 4 tokens so
+        # the block never runs past the face list.
+        if self.ensure(count * 4):
+            try:
+                block = np.array(self.tokens[self.pos:self.pos + count * 4], dtype=np.int32).reshape(count, 4)
+            except ValueError:
+                block = None
+            if block is not None and (block[:, 0] == 3).all():
+                self.pos += count * 4
+                return np.ascontiguousarray(block[:, 1:])
+
+        faces = []
+        for _ in range(count):
+            faces.append(list(map(int, self.read_tokens(self.read_int()))))
+        return faces
+
+    def read_keys(self, count):
+        # Animation keys are frame; dim; values;; with the same dim for every
+        # key in a block, so they're read as one (count, dim + 2) block
+        if count == 0:
+            return np.empty(0, dtype=np.int32), np.empty((0, 0), dtype=np.float32)
+        if not self.ensure(2):
+            raise ValueError("Unexpected end of .x file")
+        dim = int(self.tokens[self.pos + 1])
+        block = self.read_array(count, dim + 2, np.float64)
+        if (block[:, 1] != dim).any():
+            raise ValueError("Animation keys of different sizes in one AnimationKey aren't supported")
+        return block[:, 0].astype(np.int32), block[:, 2:].astype(np.float32)
+
+    def read_name(self):
+        return decode(self.next_token())
+
+    def read_string(self):
+        return decode(self.next_token().strip(b'"'))
+
+    def read_block_name(self):
+        # Reads the optional name of a block and its opening brace
+        token = self.next_token()
+        if token == b'{':
+            return None
+        self.expect(b'{')
+        return decode(token)
+
+    def skip_block(self):
+        # Skips to the brace closing the block we're in
+        depth = 1
+        while depth:
+            token = self.next_token()
+            if token == b'{':
+                depth += 1
+            elif token == b'}':
+                depth -= 1
+
+def is_comment(token):
+    return token[:1] == b'#' or token[:2] == b'//'
+
+def decode(value):
+    return value.decode('shift_jis', errors='ignore')
@@ -1,5 +1,6 @@
-from pxr import Gf
-import re, os
+import copy, os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy as np
 
 ###################################
@@ -12,60 +13,69 @@ import numpy as np
 # Uncertain about normals and UVs - it produces a lot more
 
 
-from collections import namedtuple
-from pxr import Usd, UsdGeom, UsdShade
+from pxr import Usd, UsdGeom, UsdShade, Sdf
 import json
+from scene_model import Material, Mesh, Frame
+from x_file_binary import XBinaryWriter
+from x_file_text import render_materials, render_mesh, render_transform
+import instrumentation
+import worker_pools
+import logging
 
-Material = namedtuple('Material', ['name', 'face_color', 'power', 'specular_color', 'emissive_color', 'texture_filename'])
+log = logging.getLogger(__name__)
+
+# scenes with fewer faces than this are rendered quicker in this process
+# than a pool takes to start, about a second's work on one CPU
+PARALLEL_MIN_FACES = 200000
+# where our exporter and Blender put the materials
+MATERIAL_PATHS = ['/Materials', '/root/_materials']
 
 class USDToXConverter:
-    def __init__(self, usd_file):
-        self.stage = Usd.Stage.Open(usd_file)
+    def __init__(self, usd_file, weld_tolerance=0.0, workers=None):
+        self.usd_file = usd_file
+        with instrumentation.stage('usd read'):
+            self.stage = open_stage(usd_file)
+        # corners closer than this in every attribute are merged into one vertex
+        self.weld_tolerance = weld_tolerance
         self.materials = []
         self.frames = []
-
-    def convert(self, output_x_file):
-        self.extract_materials()
-        self.extract_frames()
+        # meshes extracted from instance prototypes, by prototype path
+        self.prototype_meshes = {}
+        # meshes are de-duplicated on a pool of threads and rendered on a
+        # pool of processes, the stage is only read from this one
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = SerialExecutor()
+
+    def convert(self, output_x_file, binary=False):
+        with instrumentation.stage('usd read'):
+            self.extract_materials()
+            self.extract_frames()
 
         # Load specular colors
         specular_colors = self.load_specular_colors_from_json(output_x_file.removesuffix('.x')+'_speculars.json')
-        updated_materials = []
         for material in self.materials:
             if material.name in specular_colors:
-                specular_color = tuple(specular_colors[material.name])
-            else:
-                specular_color = material.specular_color
-            # Create a new Material instance with the updated specular color
-            updated_material = Material(
-                name=material.name,
-                face_color=material.face_color,
-                power=material.power,
-                specular_color=specular_color,
-                emissive_color=material.emissive_color,
-                texture_filename=material.texture_filename
-            )
-            updated_materials.append(updated_material)
-        self.materials = updated_materials
+                material.specular_color = tuple(specular_colors[material.name])
         
-        self.write_x_file(output_x_file)
-        print(".x file created.")
+        with instrumentation.stage('write'):
+            self.write_x_file(output_x_file, binary)
+        instrumentation.count('write', bytes=os.path.getsize(output_x_file))
+        log.info(".x file created.")
 
     def load_specular_colors_from_json(self, json_file):
         if not os.path.exists(json_file):
-            print(f"Specular colors file '{json_file}' not found. Using default values.")
+            log.info("Specular colors file '%s' not found. Using default values.", json_file)
             return {}
         
         try:
             with open(json_file, 'r') as f:
                 return json.load(f)
         except Exception as e:
-            print(f"Error reading specular colors file '{json_file}': {e}. Using default values.")
+            log.warning("Error reading specular colors file '%s': %s. Using default values.", json_file, e)
             return {}
 
     def extract_material_root(self):
-        material_paths = ['/Materials', '/root/_materials']
-        for path in material_paths:
+        for path in MATERIAL_PATHS:
             material_root = self.stage.GetPrimAtPath(path)
             if material_root.IsValid():
                 return material_root
@@ -75,7 +85,8 @@ class USDToXConverter:
         material_root = self.extract_material_root()
 
         for material_prim in material_root.GetChildren():
-            shader = UsdShade.Shader.Get(self.stage, f'{material_prim.GetPath()}/Principled_BSDF')
+            # Blender's shader, or the one USDExporter writes
+            shader = UsdShade.Shader.Get(self.stage, f'{material_prim.GetPath()}/Principled_BSDF') or UsdShade.Shader.Get(self.stage, f'{material_prim.GetPath()}/Shader')
             
             if shader:
                 specular = (0,0,0) #Updated by external JSON file
@@ -86,6 +97,9 @@ class USDToXConverter:
                 if shader.GetInput('diffuseColor').GetConnectedSource():
                     usd_texture = UsdShade.Shader.Get(self.stage, shader.GetInput('diffuseColor').GetConnectedSource()[0].GetPath().pathString)
                     texture_filename = str(usd_texture.GetInput('file').Get()).replace('@','')
+                    if self.usd_file.lower().endswith('.usdz'):
+                        # textures are packed into a folder inside the usdz, the game expects them alongside the .x
+                        texture_filename = os.path.basename(texture_filename)
                     diffuse = (1,1,1,1)
                 else:
                     diffuse = shader.GetInput('diffuseColor').Get()
@@ -100,12 +114,16 @@ class USDToXConverter:
 
     def extract_frames(self):
         root = self.stage.GetPseudoRoot()
-        for child in root.GetChildren():
-            self.parse_frame(child)
+        with make_pool(ThreadPoolExecutor, self.workers) as self.pool:
+            for child in root.GetChildren():
+                self.parse_frame(child)
+            with instrumentation.stage('dedupe'):
+                resolve_meshes(self.frames)
+        self.pool = SerialExecutor()
 
         #remove excess root objects from Blender
-        while self.frames[0]['name'] != 'Frame_World' and len(self.frames) > 0:
-            self.frames = self.frames[0]['frames']
+        while self.frames[0].name != 'Frame_World' and len(self.frames) > 0:
+            self.frames = self.frames[0].frames
 
     def parse_frame(self, prim, parent=None):
         frame_name = prim.GetName()
@@ -113,156 +131,141 @@ class USDToXConverter:
         if frame_name.startswith("Frame_World"):
             frame_name = "Frame_World"
 
-        frame_data = {'name': frame_name, 'transform_matrix': None, 'meshes': [], 'frames': []}
+        frame = Frame(frame_name)
 
         xformable = UsdGeom.Xformable(prim)
         if xformable:
             transform_attr = xformable.GetLocalTransformation()
             if transform_attr:
-                matrix = transform_attr
-                frame_data['transform_matrix'] = matrix
+                frame.transform_matrix = np.array(transform_attr, dtype=np.float64)
 
         if prim.GetTypeName() == 'Xform':
             for child in prim.GetChildren():
-                self.parse_frame(child, frame_data)
+                self.parse_frame(child, frame)
             
             if parent:
-                parent['frames'].append(frame_data)
+                parent.frames.append(frame)
             else:
-                self.frames.append(frame_data)
+                self.frames.append(frame)
         elif prim.GetTypeName() == 'Mesh':
-            mesh = self.extract_mesh(prim)
+            if prim.IsInstance():
+                mesh = self.extract_instance(prim)
+            else:
+                mesh = self.extract_mesh(prim)
             #add the mesh to the parent
-            parent['meshes'].append(mesh)
+            parent.meshes.append(mesh)
+
+    def extract_instance(self, prim):
+        # Instances that don't override anything themselves all read the same
+        # data through their prototype, so it's only extracted once
+        if any(spec.properties for spec in prim.GetPrimStack() if spec.path == prim.GetPath()):
+            return self.extract_mesh(prim)
+        path = prim.GetPrototype().GetPath()
+        if path not in self.prototype_meshes:
+            self.prototype_meshes[path] = self.extract_mesh(prim)
+        return self.prototype_meshes[path], prim.GetName().removesuffix('_001')
 
     def extract_mesh(self, prim):
-        mesh_data = {'name': prim.GetName(), 'vertices': [], 'normals': [], 'normal_faces': [], 'uvs': [], 'colors': [], 'faces': [], 'materials': {'material_indices': [], 'materials': []}}
+        # Returns a future for the mesh, the stage is read here and the rest
+        # is left to the pool
+        mesh_data = self.read_mesh(prim)
+        with instrumentation.stage('dedupe'):
+            return self.pool.submit(build_mesh, *mesh_data, self.weld_tolerance)
+
+    def read_mesh(self, prim):
+        mesh_name = prim.GetName()
         usd_mesh = UsdGeom.Mesh(prim)
 
-        if mesh_data['name'].endswith('_001'):
-            mesh_data['name'] = mesh_data['name'].removesuffix('_001')
-        
-        transform_matrix = np.array([
-            [ 1.0,  0.0,  0.0,  0.0],
-            [ 0.0,  -1.0,  0.0,  0.0],
-            [ 0.0,  0.0,  -1.0,  0.0],
-            [ 0.0,  0.0,  0.0,  1.0]
-        ])
-
-        # Extract vertices
-        #base_vertices = [tuple(np.dot(transform_matrix, np.append(point, 1.0))[:3]) for point in usd_mesh.GetPointsAttr().Get()]
-        base_vertices = usd_mesh.GetPointsAttr().Get()
-        
-        mesh_data['vertices'] = base_vertices
+        if mesh_name.endswith('_001'):
+            mesh_name = mesh_name.removesuffix('_001')
 
-        # Extract normals and apply transformation
-        base_normals = [tuple(np.dot(transform_matrix[:3, :3], normal)) for normal in usd_mesh.GetNormalsAttr().Get()]
+        # Extract vertices and normals, as views of the stage's arrays
+        base_vertices = np.asarray(usd_mesh.GetPointsAttr().Get())
+        base_normals = np.asarray(usd_mesh.GetNormalsAttr().Get())
 
         # Extract faces
         face_vertex_indices = usd_mesh.GetFaceVertexIndicesAttr().Get()
         if face_vertex_indices:
-            faces = [face_vertex_indices[i:i+3] for i in range(0, len(face_vertex_indices), 3)]
-            for face in faces:
-                if len(face) != 3:
-                    print(f"Error: Non-triangulated face or edge found in mesh {mesh_data['name']}.")
-                    exit(1)
-            mesh_data['faces'] = faces
+            face_vertex_indices = np.asarray(face_vertex_indices)
+            if len(face_vertex_indices) % 3:
+                raise ValueError(f"Non-triangulated face or edge found in mesh {mesh_name}.")
         else:
-            print(f"Warning: No face vertex indices found for mesh {mesh_data['name']}")
+            log.warning("No face vertex indices found for mesh %s", mesh_name)
+            face_vertex_indices = np.empty(0, dtype=np.int64)
 
-        # Extract UVs and remap vertices, normals, and colors
-        primvar_api = UsdGeom.PrimvarsAPI(usd_mesh)
+        if base_normals.ndim == 2:
+            base_normals = face_corners(base_normals, usd_mesh.GetNormalsInterpolation(), face_vertex_indices)
 
-        uvs = [(0.0, 0.0)] * len(base_vertices*2)
-        uv_indices = []
+        # Extract UVs and colors
+        primvar_api = UsdGeom.PrimvarsAPI(usd_mesh)
 
+        uvs = None
         if primvar_api.HasPrimvar("st"):
-            uvs = primvar_api.GetPrimvar("st").Get()
-            uv_indices = usd_mesh.GetFaceVertexIndicesAttr().Get()
-
-        if uvs is None:
-            uvs = [(0.0, 0.0)] * len(base_vertices)
-            uv_indices = []
+            st = primvar_api.GetPrimvar("st")
+            # indexed UVs come out one per index
+            uvs = st.ComputeFlattened()
+        if uvs is not None:
+            uvs = face_corners(np.asarray(uvs), st.GetInterpolation(), face_vertex_indices)
 
-        new_vertices = []
-        new_normals = []
-        new_uvs = []
-        new_colors = []
-        vertex_map = {}
-        new_normal_faces = []
-
-        makingup = False
+        colors = None
         if primvar_api.HasPrimvar("displayColor"):
             colors = primvar_api.GetPrimvar("displayColor").Get()
-        
-        if colors is None:
-            makingup = True
-            print(f"For: {mesh_data['name']}")
-            colors = [(1.0, 1.0, 1.0)] * len(base_vertices)
-
-        for face_index, face in enumerate(mesh_data['faces']):
-            new_normal_face = []
-            for i in range(3):
-                vertex_index = face[i]
-                uv_index = face_index * 3 + i  # Adjust index mapping here
-                vertex = base_vertices[vertex_index]
-                normal = base_normals[uv_index]
-
-                if uv_indices:
-                    uv = uvs[uv_index]
-                else:
-                    uv = (0.0, 0.0)
 
-                if makingup:
-                    print(f"getting color {vertex_index}")
-                color = colors[vertex_index]
+        if colors is None:
+            log.debug("No vertex colours for %s, using white", mesh_name)
+            colors = np.ones((len(base_vertices), 3))
+        colors = np.asarray(colors)
 
-                key = (vertex, normal, uv, color)
-                if key in vertex_map:
-                    new_vertex_index = vertex_map[key]
-                else:
-                    new_vertex_index = len(new_vertices)
-                    vertex_map[key] = new_vertex_index
-                    new_vertices.append(vertex)
-                    new_normals.append(normal)
-                    new_uvs.append(uv)
-                    new_colors.append(color)
-
-                face[i] = new_vertex_index
-                new_normal_face.append(new_vertex_index)
-            new_normal_faces.append(new_normal_face)
-
-        mesh_data['vertices'] = new_vertices
-        mesh_data['normals'] = [(norm[0], norm[1], norm[2]) for norm in new_normals]  # Ensure normals are in the correct order
-        mesh_data['uvs'] = [(uv[0], 1.0 - uv[1]) for uv in new_uvs]  # Correctly flip the V coordinate
-        mesh_data['colors'] = new_colors
-        mesh_data['normal_faces'] = new_normal_faces
-
-        # Extract material groups using GeomSubset
+        # Extract material groups using GeomSubset, an instance's subsets are
+        # children of its prototype
         material_binding = UsdShade.MaterialBindingAPI(usd_mesh)
         binding_rel = material_binding.GetDirectBindingRel()
         targets = binding_rel.GetTargets()
-        subsets = UsdGeom.Subset.GetAllGeomSubsets(usd_mesh)
+        subsets = UsdGeom.Subset.GetAllGeomSubsets(UsdGeom.Imageable(prim.GetPrototype()) if prim.IsInstance() else usd_mesh)
+        materials = []
+        subset_indices = None
         if len(subsets) == 0:
             if targets:
-                mesh_data['materials']['materials'].append(str(targets[0]).split("/")[-1])
+                materials.append(str(targets[0]).split("/")[-1])
         else:
-            face_to_material = [0] * len(mesh_data['faces'])
-            for material_index, subset in enumerate(subsets):
+            # the faces of each subset, None where it has none
+            subset_indices = []
+            for subset in subsets:
                 indices = subset.GetIndicesAttr().Get()
+                subset_indices.append(np.asarray(indices) if indices else None)
                 if indices:
-                    for index in indices:
-                        face_to_material[index] = material_index
                     binding_rel = subset.GetPrim().GetRelationship('material:binding')
                     targets = binding_rel.GetTargets()
                     if targets:
-                        mesh_data['materials']['materials'].append(str(targets[0]).split('/')[-1])
-            mesh_data['materials']['material_indices'] = face_to_material
+                        materials.append(str(targets[0]).split('/')[-1])
 
-        return mesh_data
+        return mesh_name, base_vertices, base_normals, face_vertex_indices, uvs, colors, subset_indices, materials
 
-    def write_x_file(self, output_x_file):
-        with open(output_x_file, 'w', encoding='shift_jis') as file:
+    def load_frame_hierarchy(self, output_x_file):
+        # Get the X File heirachy
+        json_file = output_x_file.removesuffix('.x')+'_frames.json'
+        if not os.path.exists(json_file):
+            raise ValueError(f"Missing {json_file}")
+        with open(json_file, 'r') as f:
+            return decode_json_to_frames(json.load(f))
+
+    def write_x_file(self, output_x_file, binary=False):
+        json_hierarchy = self.load_frame_hierarchy(output_x_file)
+
+        if binary:
+            with open(output_x_file, 'wb') as file:
+                writer = XBinaryWriter(file)
+                writer.header()
+                writer.open_block("Header")
+                writer.ints([1, 0, 1])
+                writer.close_block()
+                self.write_binary_materials(writer)
+                self.write_binary_frames(writer, json_hierarchy, self.frames)
+            return
+
+        parallel = self.workers > 1 and count_faces(self.frames) >= PARALLEL_MIN_FACES
+        with open(output_x_file, 'w', encoding='shift_jis') as x_file, worker_pools.process_pool(self.workers) if parallel else SerialExecutor() as pool:
+            file = OrderedWriter(x_file, pool)
             file.write("xof 0303txt 0032\n")
             file.write("""
 Header {
@@ -271,36 +274,22 @@ Header {
 
 """)
             self.write_materials(file)
-
-            # Get the X File heirachy
-            json_hierarchy = None
-            if(os.path.exists(output_x_file.removesuffix('.x')+'_frames.json')):
-                with open(output_x_file.removesuffix('.x')+'_frames.json', 'r') as f:
-                    d = json.load(f)
-                    json_hierarchy = decode_json_to_frames(d)
-            else:
-                print("Error: missing - "+output_x_file.removesuffix('.x')+'_frames.json')
-                exit()
-
             self.write_frames(file, json_hierarchy, self.frames)
+            file.flush()
 
     def write_materials(self, file):
-        for material in self.materials:
-            file.write("Material "+material.name+" {\n")
-            file.write(f"\t{material.face_color[0]:.6f};{material.face_color[1]:.6f};{material.face_color[2]:.6f};1.0;;\n")
-            file.write(f"\t{material.power:.6f};\n")
-            file.write(f"\t{material.specular_color[0]:.6f};{material.specular_color[1]:.6f};{material.specular_color[2]:.6f};;\n")
-            file.write(f"\t{material.emissive_color[0]:.6f};{material.emissive_color[1]:.6f};{material.emissive_color[2]:.6f};;\n")
-            if material.texture_filename:
-                file.write("\tTextureFilename {"+"\n\t\t\""+material.texture_filename+"\";\n\t}\n")
-            file.write("}\n\n")
+        file.write(render_materials(self.materials))
     
+    def write_binary_materials(self, writer):
+        for material in self.materials:
+            writer.material(material)
+
     def find_frame_by_name_or_nickname(self, frames, name, nickname):
         for frame in frames:
-            if frame['name'] == name or frame['name'] == nickname:
+            if frame.name == name or frame.name == nickname:
                 return frame
             #Blender cloned object fix
-            if frame['name'].split("_00")[0] == name or frame['name'].split("_00")[0] == nickname:
+            if frame.name.split("_00")[0] == name or frame.name.split("_00")[0] == nickname:
                 return frame
         return None
 
@@ -311,129 +300,192 @@ Header {
 
         frame = self.find_frame_by_name_or_nickname(frames, json_frame.name, json_frame.nickname)
         if not frame:
-            print(f"Frame not found for JSON Frame: {json_frame.name}/{json_frame.nickname}")  # Debug statement
+            log.warning("Frame not found for JSON Frame: %s/%s", json_frame.name, json_frame.nickname)
             return
             
-        if frame['name'] == "Frame_World":
+        if frame.name == "Frame_World":
             #fix for Blender's import/export
-            frame['transform_matrix'] = Gf.Matrix4d(
-                1.000000, 0.000000, 0.000000, 0.000000, 
-                0.000000, 1.000000, 0.000000, 0.000000, 
-                0.000000, 0.000000, 1.000000, 0.000000, 
-                0.000000, 0.000000, 0.000000, 1.000000
-            )
+            frame.transform_matrix = np.identity(4)
 
         file.write(f"{indent_str}Frame {json_frame.name} {{\n")
-        if frame['transform_matrix']:
-            file.write(f"{indent_str}\tFrameTransformMatrix {{\n")
-
-            matrix = frame['transform_matrix']
-            row = matrix.GetRow(0)
-            row1 = matrix.GetRow(1)
-            row2 = matrix.GetRow(2)
-            row3 = matrix.GetRow(3)
+        if frame.transform_matrix is not None:
+            file.write(render_transform(frame.transform_matrix, indent))
 
-            file.write(f"{indent_str}\t\t{row[0]:0.6f},{row[1]:0.6f},{row[2]:0.6f},{row[3]:0.6f},\n")
-            file.write(f"{indent_str}\t\t{row1[0]:0.6f},{row1[1]:0.6f},{row1[2]:0.6f},{row1[3]:0.6f},\n")
-            file.write(f"{indent_str}\t\t{row2[0]:0.6f},{row2[1]:0.6f},{row2[2]:0.6f},{row2[3]:0.6f},\n")
-            file.write(f"{indent_str}\t\t{row3[0]:0.6f},{row3[1]:0.6f},{row3[2]:0.6f},{row3[3]:0.6f};;\n")
 
-            file.write(f"{indent_str}\t}}\n\n")
-
-
-        print(f"JSON Frame: {json_frame.name}/{json_frame.nickname} is {json_frame.collision}")  # Debug statement
+        log.debug("JSON Frame: %s/%s is %s", json_frame.name, json_frame.nickname, json_frame.collision)
 
         # If specified to indent files correctly, do so
         if json_frame.collision == "False":
             indent += 1
 
-        for mesh in frame['meshes']:
+        for mesh in frame.meshes:
             self.write_mesh(file, mesh, json_frame.name.removeprefix("Frame_"), indent)
 
         for child in json_frame.children:
-            self.write_frames(file, child, frame['frames'], indent)
+            self.write_frames(file, child, frame.frames, indent)
 
         file.write(f"{indent_str}}}\n\n")
 
+    def write_binary_frames(self, writer, json_frame, frames):
+        # Binary files have no indentation, so the collision setting can't be
+        # expressed and the frames are written plainly
+        frame = self.find_frame_by_name_or_nickname(frames, json_frame.name, json_frame.nickname)
+        if not frame:
+            log.warning("Frame not found for JSON Frame: %s/%s", json_frame.name, json_frame.nickname)
+            return
+
+        if frame.name == "Frame_World":
+            #fix for Blender's import/export
+            frame.transform_matrix = np.identity(4)
+
+        writer.open_block("Frame", json_frame.name)
+        if frame.transform_matrix is not None:
+            writer.open_block("FrameTransformMatrix")
+            writer.floats(frame.transform_matrix)
+            writer.close_block()
+
+        for mesh in frame.meshes:
+            writer.mesh(mesh, json_frame.name.removeprefix("Frame_"))
+
+        for child in json_frame.children:
+            self.write_binary_frames(writer, child, frame.frames)
+
+        writer.close_block()
+
     def write_mesh(self, file, mesh, org_name, indent):
-        indent_str = '\t' * indent
-        file.write(f"{indent_str}Mesh {org_name} {{\n")
-
-        # Vertices
-        file.write(f"{indent_str}\t{len(mesh['vertices'])};\n")
-        for vertex in mesh['vertices'][:-1]:
-            file.write(f"{indent_str}\t{vertex[0]:0.6f};{vertex[1]:0.6f};{vertex[2]:0.6f};,\n")
-        file.write(f"{indent_str}\t{mesh['vertices'][-1][0]:0.6f},{mesh['vertices'][-1][1]:0.6f},{mesh['vertices'][-1][2]:0.6f};;\n\n")
-
-        # Faces
-        file.write(f"{indent_str}\t{len(mesh['faces'])};\n")
-        for face in mesh['faces'][:-1]:
-            file.write(f"{indent_str}\t3;{face[0]},{face[1]},{face[2]};,\n")
-        file.write(f"{indent_str}\t3;{mesh['faces'][-1][0]},{mesh['faces'][-1][1]},{mesh['faces'][-1][2]};;\n\n")
-
-        # Materials
-        file.write(indent_str + "\tMeshMaterialList {\n")
-        if len(mesh['materials']['materials']) == 1:
-            file.write(f"{indent_str}\t\t1;1;0;;\n")
-            file.write(f"{indent_str}\t\t"+"{"+mesh['materials']['materials'][0]+"}\n")
-        else:
-            num_materials = len(mesh['materials']['materials'])
-            num_faces = len(mesh['faces'])
-            file.write(f"{indent_str}\t\t{num_materials};\n")
-            file.write(f"{indent_str}\t\t{num_faces};\n")
-
-            # Write material indices for each face, in lines of up to 30
-            material_indices = mesh['materials']['material_indices']
-            indices_str = indent_str + "\t\t"
-            for i, idx in enumerate(material_indices):
-                indices_str += str(idx) + ","
-                if (i + 1) % 30 == 0:
-                    indices_str += "\n" + indent_str + "\t\t"
-            indices_str = indices_str.removesuffix("\n" + indent_str + "\t\t")
-            indices_str = indices_str.removesuffix(",")  + ";;\n"
-            file.write(indices_str)
-            
-            # Write material names
-            for material in mesh['materials']['materials']:
-                file.write(indent_str + "\t\t{" + material + "}\n")
-
-        file.write(indent_str + "\t}\n\n")
-
-        print(f"{indent_str}Mesh {org_name} {{\n")
-        # Normals
-        if len(mesh['normals']) > 0:
-            file.write(f"{indent_str}\tMeshNormals {{\n")
-            file.write(f"{indent_str}\t\t{len(mesh['normals'])};\n")
-            print(f"{indent_str}\t\t{len(mesh['normals'])};\n")
-            for normal in mesh['normals'][:-1]:
-                file.write(f"{indent_str}\t\t{normal[0]:0.6f},{normal[1]:0.6f},{normal[2]:0.6f};,\n")
-            file.write(f"{indent_str}\t\t{mesh['normals'][-1][0]:0.6f},{mesh['normals'][-1][1]:0.6f},{mesh['normals'][-1][2]:0.6f};;\n\n")
-
-            file.write(f"{indent_str}\t\t{len(mesh['normal_faces'])};\n")
-            for face in mesh['normal_faces'][:-1]:
-                file.write(f"{indent_str}\t\t3;{face[0]},{face[1]},{face[2]};,\n")
-            file.write(f"{indent_str}\t\t3;{mesh['normal_faces'][-1][0]},{mesh['normal_faces'][-1][1]},{mesh['normal_faces'][-1][2]};;\n")
-            file.write(f"{indent_str}\t}}\n\n")
-
-        # Vertex Colors
-        if mesh['colors']:
-            file.write(f"{indent_str}\tMeshVertexColors {{\n")
-            file.write(f"{indent_str}\t\t{len(mesh['colors'])};\n")
-            for i, color in enumerate(mesh['colors'][:-1]):
-                file.write(f"{indent_str}\t\t{i};{color[0]:0.6f},{color[1]:0.6f},{color[2]:0.6f},1.0;,\n")
-            file.write(f"{indent_str}\t\t{len(mesh['colors'])-1};{mesh['colors'][-1][0]:0.6f},{mesh['colors'][-1][1]:0.6f},{mesh['colors'][-1][2]:0.6f},1.0;;\n")
-            file.write(f"{indent_str}\t}}\n\n")
-
-        # Texture Coordinates
-        if mesh['uvs']:
-            file.write(f"{indent_str}\tMeshTextureCoords {{\n")
-            file.write(f"{indent_str}\t\t{len(mesh['uvs'])};\n")
-            for uv in mesh['uvs'][:-1]:
-                file.write(f"{indent_str}\t\t{uv[0]:0.6f};{(uv[1]):0.6f};,\n")
-            file.write(f"{indent_str}\t\t{mesh['uvs'][-1][0]:0.6f};{(mesh['uvs'][-1][1]):0.6f};;\n")
-            file.write(f"{indent_str}\t}}\n\n")
-
-        file.write(f"{indent_str}}}\n")
+        log.debug("Mesh %s: %d vertices, %d normals", org_name, len(mesh.vertices), len(mesh.normals))
+        # rendered by the pool, and written out in order once it's done
+        with instrumentation.stage('format'):
+            file.submit(render_mesh, mesh, org_name, indent)
+
+def face_corners(values, interpolation, face_vertex_indices):
+    # Spreads normals or UVs out to one per face corner. Blender writes them
+    # per corner already, our own exporter per vertex. Every face is a
+    # triangle by now.
+    if interpolation == UsdGeom.Tokens.faceVarying:
+        return values
+    if interpolation == UsdGeom.Tokens.uniform:
+        return np.repeat(values, 3, axis=0)
+    if interpolation == UsdGeom.Tokens.constant:
+        return np.repeat(values[:1], len(face_vertex_indices), axis=0)
+    return values[face_vertex_indices]
+
+def build_mesh(mesh_name, base_vertices, base_normals, face_vertex_indices, uvs, colors, subset_indices, materials, weld_tolerance):
+    # The arrays read_mesh gets from the stage, de-duplicated into a Mesh.
+    # Only numpy is used here, so meshes can be built on several threads.
+    transform_matrix = np.array([
+        [ 1.0,  0.0,  0.0,  0.0],
+        [ 0.0,  -1.0,  0.0,  0.0],
+        [ 0.0,  0.0,  -1.0,  0.0],
+        [ 0.0,  0.0,  0.0,  1.0]
+    ])
+
+    base_vertices = np.asarray(base_vertices, dtype=np.float64).reshape(-1, 3)
+    # Apply the transformation to the normals, one matrix multiply for all of them
+    base_normals = np.asarray(base_normals, dtype=np.float64).reshape(-1, 3) @ transform_matrix[:3, :3].T
+    face_vertex_indices = np.asarray(face_vertex_indices, dtype=np.int64)
+    corner_count = len(face_vertex_indices)
+
+    # Every face corner as one row of vertex, normal, uv and colour. UVs
+    # and normals are per corner, colours per vertex.
+    corners = np.zeros((corner_count, 11))
+    corners[:, 0:3] = base_vertices[face_vertex_indices]
+    corners[:, 3:6] = base_normals[:corner_count]
+    if uvs is not None and corner_count:
+        corners[:, 6:8] = np.asarray(uvs, dtype=np.float64).reshape(-1, 2)[:corner_count]
+    corners[:, 8:11] = np.asarray(colors, dtype=np.float64).reshape(-1, 3)[face_vertex_indices]
+    # Identical corners become one vertex, numbered in the order they
+    # first appear. A weld tolerance also merges corners that round to
+    # the same multiple of it. Rows are compared as raw bytes, which is
+    # much quicker to sort, so -0.0 is made 0.0 first.
+    keys = corners if not weld_tolerance else np.round(corners / weld_tolerance)
+    keys = np.ascontiguousarray(keys + 0.0).view(np.dtype((np.void, keys.itemsize * 11))).reshape(-1)
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    new_index = np.empty(len(order), dtype=np.int64)
+    new_index[order] = np.arange(len(order))
+    faces = new_index[inverse.reshape(-1)].reshape(-1, 3)
+    new_corners = corners[first[order]]
+
+    new_vertices = new_corners[:, 0:3]
+    new_normals = new_corners[:, 3:6]
+    new_uvs = new_corners[:, 6:8].copy()
+    new_uvs[:, 1] = 1.0 - new_uvs[:, 1]  # Correctly flip the V coordinate
+    new_colors = new_corners[:, 8:11]
+
+    # Material index per face, from the subset each face is in
+    face_to_material = None
+    if subset_indices is not None:
+        face_to_material = np.zeros(len(faces), dtype=np.uint16)
+        for material_index, indices in enumerate(subset_indices):
+            if indices is not None:
+                face_to_material[indices] = material_index
+
+    return Mesh(mesh_name, new_vertices, faces, new_normals, faces, new_uvs, new_colors, face_to_material, materials)
+
+def resolve_meshes(frames):
+    # Swaps the pool's futures for the meshes they made. Instances are a
+    # future and a name, and get a renamed copy of their prototype's mesh.
+    for frame in frames:
+        for i, pending in enumerate(frame.meshes):
+            if isinstance(pending, tuple):
+                future, name = pending
+                mesh = copy.copy(future.result())
+                mesh.name = name
+            else:
+                mesh = pending.result()
+            frame.meshes[i] = mesh
+            instrumentation.count('dedupe', vertices=len(mesh.vertices), faces=len(mesh.faces))
+        resolve_meshes(frame.frames)
+
+class SerialExecutor:
+    # Stands in for a pool when there's only one worker, running each job
+    # as soon as it's submitted
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+def count_faces(frames):
+    return sum(sum(len(mesh.faces) for mesh in frame.meshes) + count_faces(frame.frames) for frame in frames)
+
+def make_pool(executor, workers):
+    return executor(workers) if workers > 1 else SerialExecutor()
+
+class OrderedWriter:
+    # Writes to a file in order, where some blocks are still being rendered
+    # by a pool. Blocks at the front are written as soon as they're ready.
+    def __init__(self, file, pool):
+        self.file = file
+        self.pool = pool
+        self.blocks = deque()
+
+    def write(self, text):
+        self.blocks.append(text)
+        self.drain()
+
+    def submit(self, fn, *args):
+        self.blocks.append(self.pool.submit(fn, *args))
+
+    def drain(self, wait=False):
+        while self.blocks:
+            block = self.blocks[0]
+            if isinstance(block, Future):
+                if not (wait or block.done()):
+                    return
+                with instrumentation.stage('format'):
+                    block = block.result()
+            self.file.write(block)
+            self.blocks.popleft()
+
+    def flush(self):
+        self.drain(wait=True)
 
 class FrameJSON:
     def __init__(self, name, nickname):
@@ -451,7 +503,34 @@ def decode_json_to_frames(json_data):
         return frame
     return decode_frame(json_data)
 
-
+def open_stage(usd_file):
+    # Only the materials and the Frame_World hierarchy are composed, so the
+    # cameras, lights and extra roots in a Blender export are never read.
+    # Payloads from a split export are all loaded, the .x needs every frame.
+    layer = Sdf.Layer.FindOrOpen(usd_file)
+    if layer is None:
+        raise ValueError(f"Couldn't open {usd_file}")
+    roots = find_prim_specs(layer, 'Frame_World')
+    if not roots:
+        # the frames come from somewhere other than the root layer
+        return Usd.Stage.Open(layer, Usd.Stage.LoadAll)
+    mask = Usd.StagePopulationMask()
+    for path in MATERIAL_PATHS + roots:
+        mask.Add(Sdf.Path(path))
+    return Usd.Stage.OpenMasked(layer, mask, Usd.Stage.LoadAll)
+
+def find_prim_specs(layer, name):
+    # Paths of the topmost prims in the layer named name, or name with a
+    # Blender suffix like Frame_World_001
+    paths = []
+    prims = deque(layer.rootPrims)
+    while prims:
+        prim = prims.popleft()
+        if prim.name.startswith(name):
+            paths.append(str(prim.path))
+        else:
+            prims.extend(prim.nameChildren)
+    return paths
 
 if __name__ == "__main__":
     converter = USDToXConverter('train_iwa_2.usdc')